@@ -2,15 +2,33 @@
 Flask REST API for the schedule notifier.
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
+import functools
+import hmac
+import io
+import json
 import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
 from dotenv import load_dotenv
+import requests
 
-from scraper import BeginHSScraper
-from database import Database
+from scraper import BeginHSScraper, unique_subjects
+from database import Database, school_today
+from matching import ClassMatcher
 from notifier import NotificationService
 from scheduler import ScheduleMonitor
+import metrics
+import tracing
+from profiling import Profiler
+from snapshots import SnapshotStore
+from sharding import ShardMembership
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from user_transfer import read_records
+from http_utils import compress_response, conditional_json, make_etag, parse_db_timestamp
 
 
 # Load environment variables
@@ -20,43 +38,159 @@ load_dotenv()
 DB_PATH = os.getenv('DATABASE_PATH', 'schedule_notifier.db')
 db = Database(DB_PATH)
 
-# Clear schedule-related tables on startup (keep user tokens)
-try:
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM changes_history')
-        cursor.execute('DELETE FROM schedule_cache')
-        print(f"🗑️  Cleared schedule data from database (kept user tokens)")
-except Exception as e:
-    print(f"Note: Could not clear schedule tables: {e}")
-
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for web app
 
 # Initialize services (db already created above)
-notifier = NotificationService(os.getenv('FIREBASE_CREDENTIALS_PATH'))
-scraper = BeginHSScraper()
-monitor = ScheduleMonitor(db, notifier)
+profiler = Profiler.from_env()
+# SCHOOL_SITE_URL points the scrapers at another site, e.g. the local stand-in
+# server used for load testing; NOTIFIER_DRY_RUN skips the actual FCM sends
+SCHOOL_SITE_URL = os.getenv('SCHOOL_SITE_URL') or None
+notifier = NotificationService(
+    os.getenv('FIREBASE_CREDENTIALS_PATH'),
+    dry_run=os.getenv('NOTIFIER_DRY_RUN', 'False').lower() in ('true', '1', 't')
+)
+# Scraped pages are only kept when SNAPSHOT_DB_PATH is set
+SNAPSHOT_DB_PATH = os.getenv('SNAPSHOT_DB_PATH')
+snapshots = SnapshotStore(SNAPSHOT_DB_PATH, os.getenv('SNAPSHOT_CODEC') or None) if SNAPSHOT_DB_PATH else None
+# With MONITOR_SHARDING each process (e.g. gunicorn worker) checks only its
+# share of the classes, coordinated through the database
+shard = None
+if os.getenv('MONITOR_SHARDING', 'False').lower() in ('true', '1', 't'):
+    shard = ShardMembership(
+        db,
+        shard_id=os.getenv('SHARD_ID') or None,
+        heartbeat_seconds=float(os.getenv('SHARD_HEARTBEAT_SECONDS', '30'))
+    )
+# One circuit breaker for all requests to the school website; while it is
+# open, scraping endpoints serve their last good data flagged as stale
+upstream_breaker = None
+if os.getenv('CIRCUIT_BREAKER', 'True').lower() in ('true', '1', 't'):
+    upstream_breaker = CircuitBreaker(
+        'school_site',
+        failure_rate=float(os.getenv('CIRCUIT_FAILURE_RATE', '0.5')),
+        slow_call_seconds=float(os.getenv('CIRCUIT_SLOW_CALL_SECONDS', '10')),
+        open_seconds=float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+    )
+scraper = BeginHSScraper(base_url=SCHOOL_SITE_URL, breaker=upstream_breaker)
+monitor = ScheduleMonitor(
+    db,
+    notifier,
+    spread_fraction=float(os.getenv('CHECK_SPREAD_FRACTION', '0.9')),
+    jitter_fraction=float(os.getenv('CHECK_JITTER_FRACTION', '0.5')),
+    trace_buffer_size=int(os.getenv('TRACE_BUFFER_SIZE', '200')),
+    profiler=profiler,
+    retention_days=int(os.getenv('RETENTION_DAYS', '60')),
+    archive_path=os.getenv('ARCHIVE_PATH') or None,
+    maintenance_hour=int(os.getenv('MAINTENANCE_HOUR', '3')),
+    base_url=SCHOOL_SITE_URL,
+    snapshots=snapshots,
+    shard=shard,
+    parse_workers=int(os.getenv('PARSE_WORKERS', '0')),
+    breaker=upstream_breaker
+)
 
 # Start scheduler immediately (gunicorn will load this once per worker)
-# We use 1 worker in production, so this is safe
+# Without MONITOR_SHARDING every worker checks every class, so use 1 worker
 interval_minutes = int(os.getenv('CHECK_INTERVAL_MINUTES', '20'))
 monitor.start(interval_minutes=interval_minutes)
 print(f"Scheduler started (interval: {interval_minutes}m)")
 
+# By default the live endpoint trusts any snapshot from the last two check cycles
+LIVE_MAX_AGE_SECONDS = float(os.getenv('LIVE_MAX_AGE_SECONDS', str(interval_minutes * 60 * 2)))
+
+# Errors meaning the school website is unreachable (as opposed to a bug)
+UPSTREAM_ERRORS = (CircuitOpenError, requests.RequestException)
+
+# Last good class list: (fetched_at, classes)
+_last_class_list = None
+
+# Admin endpoints are disabled unless a token is configured
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+
+def require_admin(func):
+    """Restrict an endpoint to requests carrying the X-Admin-Token header."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({
+                'success': False,
+                'error': 'Admin endpoints are disabled'
+            }), 404
+        
+        token = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({
+                'success': False,
+                'error': 'Unauthorized'
+            }), 403
+        
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@app.before_request
+def start_request_profile():
+    """Profile selected API requests when PROFILE_MODE allows it."""
+    if profiler.enabled and not request.path.startswith('/api/admin/'):
+        g.profile_session = profiler.start('request', f'{request.method} {request.path}')
+
+
+@app.teardown_request
+def stop_request_profile(exc):
+    profiler.stop(g.pop('profile_session', None))
+
+
+@app.after_request
+def compress(response):
+    """Compress larger responses for clients that accept gzip/brotli."""
+    return compress_response(response)
+
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
-    return jsonify({'status': 'ok', 'message': 'Schedule Notifier API is running'})
+    return jsonify({
+        'status': 'ok',
+        'message': 'Schedule Notifier API is running',
+        'upstream': upstream_breaker.get_status() if upstream_breaker else None
+    })
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Expose internal metrics in the Prometheus text format."""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _upstream_unavailable(error: Exception):
+    """Response for a scraping endpoint that has no earlier data to fall back on."""
+    return jsonify({
+        'success': False,
+        'error': f'School website unavailable: {error}'
+    }), 503
 
 
 @app.route('/api/classes', methods=['GET'])
 def get_classes():
-    """Get list of all available classes."""
+    """
+    Get list of all available classes.
+    While the school website is unavailable the last good list is returned
+    with stale set.
+    """
+    global _last_class_list
     try:
-        classes = scraper.get_class_list()
+        try:
+            classes = scraper.get_class_list()
+            _last_class_list = (time.time(), classes)
+            stale = False
+        except UPSTREAM_ERRORS as e:
+            if _last_class_list is None:
+                return _upstream_unavailable(e)
+            fetched_at, classes = _last_class_list
+            stale = True
         
         # Convert to list of objects for easier frontend handling
         class_list = [
@@ -64,10 +198,14 @@ def get_classes():
             for name, class_id in classes.items()
         ]
         
-        return jsonify({
+        result = {
             'success': True,
-            'classes': class_list
-        })
+            'classes': class_list,
+            'stale': stale
+        }
+        if stale:
+            result['fetched_at'] = datetime.fromtimestamp(fetched_at, timezone.utc).isoformat(timespec='seconds')
+        return jsonify(result)
     
     except Exception as e:
         return jsonify({
@@ -76,26 +214,59 @@ def get_classes():
         }), 500
 
 
-@app.route('/api/schedule/<class_id>', methods=['GET'])
-def get_schedule(class_id):
-    """Get schedule for a specific class with unique subjects and teachers."""
-    try:
-        # Get unique subjects and teachers
-        subjects = scraper.get_unique_subjects(class_id)
-        
-        # Convert to list format
-        subject_list = [
+def _schedule_payload(subjects: dict, cached_at: Optional[datetime] = None) -> dict:
+    """Response body of /api/schedule; cached_at marks a stale fallback."""
+    result = {
+        'success': True,
+        'subjects': [
             {
                 'subject': subject,
                 'teachers': teachers
             }
             for subject, teachers in subjects.items()
-        ]
+        ],
+        'stale': cached_at is not None
+    }
+    if cached_at is not None:
+        result['fetched_at'] = cached_at.isoformat(timespec='seconds')
+    return result
+
+
+@app.route('/api/schedule/<class_id>', methods=['GET'])
+def get_schedule(class_id):
+    """
+    Get schedule for a specific class with unique subjects and teachers.
+    Classes with registered users are served from schedule_cache, which the
+    monitor refreshes every cycle; other classes are scraped. While the
+    school website is unavailable, a scraped class falls back to the
+    timetable last stored, with stale set.
+    """
+    try:
+        # Answer with 304 if the stored timetable didn't change since the client's last request
+        version = db.get_schedule_version(class_id)
+        if version['lessons'] and version['subscribers']:
+            etag = make_etag('schedule', class_id, version['lessons'], version['last_cached'])
+            return conditional_json(
+                lambda: _schedule_payload(unique_subjects(db.get_cached_schedule(class_id))),
+                etag, parse_db_timestamp(version['last_cached'])
+            )
         
-        return jsonify({
-            'success': True,
-            'subjects': subject_list
-        })
+        # Get unique subjects and teachers
+        try:
+            subjects = scraper.get_unique_subjects(class_id)
+            cached_at = None
+        except UPSTREAM_ERRORS as e:
+            lessons = db.get_cached_schedule(class_id)
+            if not lessons:
+                return _upstream_unavailable(e)
+            subjects = unique_subjects(lessons)
+            cached_at = parse_db_timestamp(max(lesson['cached_at'] for lesson in lessons))
+        
+        # A scraped schedule is not versioned in the database, so the content is the version
+        etag = make_etag('schedule', class_id, sorted(
+            (subject, sorted(teachers)) for subject, teachers in subjects.items()
+        ))
+        return conditional_json(_schedule_payload(subjects, cached_at), etag)
     
     except Exception as e:
         import traceback
@@ -222,15 +393,84 @@ def get_user(device_token):
 
 @app.route('/api/changes/<class_id>', methods=['GET'])
 def get_changes(class_id):
-    """Get current schedule changes for a class."""
+    """
+    Get current schedule changes for a class.
+    Optional query param: when=upcoming|today|past to filter by lesson date.
+    """
     try:
-        # Get from database (recent changes)
-        changes = db.get_recent_changes(class_id, limit=50)
+        when = request.args.get('when')
+        if when not in (None, 'upcoming', 'today', 'past'):
+            return jsonify({
+                'success': False,
+                'error': "when must be one of: upcoming, today, past"
+            }), 400
         
+        # Answer with 304 if nothing changed since the client's last poll
+        version = db.get_changes_version(class_id)
+        etag = make_etag('changes', class_id, when, when and school_today(),
+                         version['max_id'], version['count'], version['notified'])
+        last_modified = parse_db_timestamp(version['last_detected'])
+        
+        def load_changes():
+            if when:
+                return db.get_changes_by_date(class_id, when, limit=50)
+            return db.get_recent_changes(class_id, limit=50)
+        
+        # Changes are only loaded from the database if the client needs them
+        return conditional_json(lambda: {
+            'success': True,
+            'changes': load_changes()
+        }, etag, last_modified)
+    
+    except Exception as e:
         return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/feed/<device_token>', methods=['GET'])
+def get_feed(device_token):
+    """
+    Get the changes relevant to a user (those they would be notified about).
+    Query params: limit, before (older page) or since (newer changes, for delta sync),
+    upcoming=true to leave out lessons that already took place.
+    """
+    try:
+        user = db.get_user_by_token(device_token)
+        if not user:
+            return jsonify({
+                'success': False,
+                'error': 'User not found'
+            }), 404
+        
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+        before = request.args.get('before', type=int)
+        since = request.args.get('since', type=int)
+        
+        upcoming_only = request.args.get('upcoming', 'false').lower() in ('true', '1')
+        
+        # The same subject/teacher/slot rules that decide who gets a push
+        matcher = ClassMatcher(db.get_cached_schedule(user['class_id']),
+                               db.get_class_preferences(user['class_id'], user_id=user['id']))
+        changes = db.get_user_feed(user['id'], before=before, since=since, limit=limit,
+                                   upcoming_only=upcoming_only,
+                                   follows=lambda change: bool(matcher.match(change)))
+        
+        response = {
             'success': True,
-            'changes': changes
-        })
+            'changes': changes,
+            'has_more': len(changes) == limit
+        }
+        
+        if since is not None:
+            # Oldest first: continue syncing from the last change returned
+            response['next_since'] = changes[-1]['id'] if changes else since
+        elif changes:
+            # Newest first: page back from the oldest change returned
+            response['next_before'] = changes[-1]['id']
+        
+        return jsonify(response)
     
     except Exception as e:
         return jsonify({
@@ -241,27 +481,32 @@ def get_changes(class_id):
 
 @app.route('/api/changes/live/<class_id>', methods=['GET'])
 def get_live_changes(class_id):
-    """Get live schedule changes directly from the website."""
+    """
+    Get live schedule changes from the monitor's latest snapshot.
+    The website is only scraped when the snapshot is older than max_age seconds.
+    If it is unavailable, the older snapshot is returned with stale set.
+    """
     try:
-        changes = scraper.get_changes(class_id)
+        max_age = request.args.get('max_age', LIVE_MAX_AGE_SECONDS, type=float)
+        try:
+            fetched_at, changes = monitor.get_live_snapshot(class_id, max(max_age, 0))
+            stale = False
+        except UPSTREAM_ERRORS as e:
+            snapshot = monitor.get_last_snapshot(class_id)
+            if snapshot is None:
+                return _upstream_unavailable(e)
+            fetched_at, changes = snapshot
+            stale = True
         
         # Convert dataclasses to dicts
-        change_list = [
-            {
-                'date': change.date,
-                'lesson_number': change.lesson_number,
-                'teacher': change.teacher,
-                'subject': change.subject,
-                'change_type': change.change_type,
-                'description': change.description,
-                'new_room': change.new_room
-            }
-            for change in changes
-        ]
+        change_list = [change.to_dict() for change in changes]
         
         return jsonify({
             'success': True,
-            'changes': change_list
+            'changes': change_list,
+            'fetched_at': datetime.fromtimestamp(fetched_at, timezone.utc).isoformat(timespec='seconds'),
+            'age_seconds': round(time.time() - fetched_at, 1),
+            'stale': stale
         })
     
     except Exception as e:
@@ -271,6 +516,88 @@ def get_live_changes(class_id):
         }), 500
 
 
+# How long an SSE connection stays open before the client is asked to reconnect
+STREAM_MAX_SECONDS = int(os.getenv('STREAM_MAX_SECONDS', '300'))
+STREAM_HEARTBEAT_SECONDS = 15
+# How often streams read new changes from the database. Changes detected by
+# this process wake its streams right away; those detected by other workers
+# or shards arrive with the next poll.
+STREAM_POLL_SECONDS = float(os.getenv('STREAM_POLL_SECONDS', '5'))
+# Each open stream holds a server thread; past this many, clients are told to
+# poll instead, so streams can't starve the REST endpoints of threads
+STREAM_MAX_CLIENTS = int(os.getenv('STREAM_MAX_CLIENTS', '16'))
+_stream_slots = threading.BoundedSemaphore(STREAM_MAX_CLIENTS)
+
+
+def _format_sse(change: dict) -> str:
+    """Format a changes_history row as an SSE 'change' event."""
+    data = json.dumps(change, ensure_ascii=False, default=str)
+    return f"id: {change['id']}\nevent: change\ndata: {data}\n\n"
+
+
+@app.route('/api/changes/stream/<class_id>', methods=['GET'])
+def stream_changes(class_id):
+    """
+    Stream new changes for a class as Server-Sent Events.
+    Clients resume with the Last-Event-ID header (or ?last_event_id=),
+    which is a changes_history ID.
+    With STREAM_MAX_CLIENTS streams open, answers 503; clients should then
+    poll /api/changes/<class_id> and retry the stream later.
+    """
+    if not _stream_slots.acquire(blocking=False):
+        metrics.STREAMS_REJECTED_TOTAL.inc()
+        response = jsonify({
+            'success': False,
+            'error': 'Too many open streams, poll for changes instead',
+            'poll_url': f'/api/changes/{class_id}'
+        })
+        response.headers['Retry-After'] = str(STREAM_MAX_SECONDS)
+        return response, 503
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_id = None
+    
+    def generate():
+        # Subscribe before reading so nothing is missed in between
+        subscription = monitor.events.subscribe(class_id)
+        try:
+            sent_id = last_id
+            if sent_id is None:
+                # New clients only get changes detected from now on
+                sent_id = db.get_changes_version(class_id)['max_id'] or 0
+            yield f"retry: {STREAM_HEARTBEAT_SECONDS * 1000}\n\n"
+            
+            deadline = time.monotonic() + STREAM_MAX_SECONDS
+            last_sent = time.monotonic()
+            while time.monotonic() < deadline:
+                # The database is the source of truth; the subscription only
+                # wakes the stream early for changes detected in this process
+                for change in db.get_changes_since(class_id, sent_id, limit=500):
+                    yield _format_sse(change)
+                    sent_id = change['id']
+                    last_sent = time.monotonic()
+                
+                if time.monotonic() - last_sent >= STREAM_HEARTBEAT_SECONDS:
+                    yield ": keepalive\n\n"
+                    last_sent = time.monotonic()
+                
+                if subscription.get(timeout=STREAM_POLL_SECONDS) is not None:
+                    subscription.drain()
+        finally:
+            monitor.events.unsubscribe(subscription)
+    
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Also runs when the client leaves before the stream started
+    response.call_on_close(_stream_slots.release)
+    return response
+
+
 @app.route('/api/test-notification', methods=['POST'])
 def test_notification():
     """Send a test notification (for debugging)."""
@@ -302,6 +629,225 @@ def test_notification():
         }), 500
 
 
+@app.route('/api/admin/traces/slow', methods=['GET'])
+@require_admin
+def get_slow_traces():
+    """Get the slowest recent check cycles with their span breakdown."""
+    try:
+        limit = request.args.get('limit', 10, type=int)
+        include_spans = request.args.get('spans', 'false').lower() in ('true', '1')
+        
+        traces = []
+        for trace in db.get_slowest_cycle_traces(limit=limit):
+            trace['summary'] = tracing.summarize(trace['spans'])
+            if not include_spans:
+                del trace['spans']
+            traces.append(trace)
+        
+        return jsonify({
+            'success': True,
+            'traces': traces
+        })
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/admin/profile', methods=['POST'])
+@require_admin
+def trigger_profile():
+    """Profile the next check cycles or API requests."""
+    try:
+        if not profiler.enabled:
+            return jsonify({
+                'success': False,
+                'error': 'Profiling is disabled (set PROFILE_MODE)'
+            }), 400
+        
+        data = request.json or {}
+        target = data.get('target', 'cycle')
+        count = int(data.get('count', 1))
+        
+        if target not in ('cycle', 'request') or count < 1:
+            return jsonify({
+                'success': False,
+                'error': "target must be 'cycle' or 'request' and count must be positive"
+            }), 400
+        
+        profiler.request_profiles(target, count)
+        
+        # Cycles only run every interval, so optionally start one right away
+        if target == 'cycle' and data.get('run_now'):
+            monitor.run_now()
+        
+        return jsonify({
+            'success': True,
+            'pending': profiler.pending()
+        })
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@require_admin
+def list_profiles():
+    """List stored profile files."""
+    return jsonify({
+        'success': True,
+        'profiles': profiler.list_profiles(),
+        'pending': profiler.pending()
+    })
+
+
+@app.route('/api/admin/profiles/<path:name>', methods=['GET'])
+@require_admin
+def download_profile(name):
+    """Download a stored .pstats or .memdiff.txt file."""
+    return send_from_directory(os.path.abspath(profiler.output_dir), name, as_attachment=True)
+
+
+@app.route('/api/admin/db-stats', methods=['GET'])
+@require_admin
+def get_db_stats():
+    """Get the database size and row counts."""
+    try:
+        return jsonify({
+            'success': True,
+            'stats': db.get_storage_stats()
+        })
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/admin/shards', methods=['GET'])
+@require_admin
+def get_shards():
+    """Get the live monitor shards and how many classes each owns."""
+    if shard is None:
+        return jsonify({
+            'success': False,
+            'error': 'Sharding is disabled (set MONITOR_SHARDING)'
+        }), 400
+    
+    status = shard.get_status(db.get_all_classes())
+    status['registered'] = db.get_shards()
+    return jsonify({
+        'success': True,
+        **status
+    })
+
+
+@app.route('/api/admin/snapshots', methods=['GET'])
+@require_admin
+def get_snapshot_stats():
+    """Get the snapshot store's page counts and sizes."""
+    if snapshots is None:
+        return jsonify({
+            'success': False,
+            'error': 'Snapshots are disabled (set SNAPSHOT_DB_PATH)'
+        }), 400
+    
+    return jsonify({
+        'success': True,
+        'stats': snapshots.get_stats()
+    })
+
+
+@app.route('/api/admin/snapshots/export', methods=['GET'])
+@require_admin
+def export_snapshots():
+    """
+    Stream stored snapshots as NDJSON, oldest first.
+    Filters: class_id, tab, since (ISO time), distinct (each page once).
+    """
+    if snapshots is None:
+        return jsonify({
+            'success': False,
+            'error': 'Snapshots are disabled (set SNAPSHOT_DB_PATH)'
+        }), 400
+    
+    filters = {
+        'class_id': request.args.get('class_id'),
+        'tab': request.args.get('tab'),
+        'since': request.args.get('since'),
+        'distinct': request.args.get('distinct', 'false').lower() in ('true', '1'),
+    }
+    
+    def generate():
+        for snapshot in snapshots.iter_snapshots(**filters):
+            yield json.dumps(snapshot, ensure_ascii=False) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers={
+        'Content-Disposition': 'attachment; filename=snapshots.ndjson'
+    })
+
+
+@app.route('/api/admin/users/export', methods=['GET'])
+@require_admin
+def export_users():
+    """
+    Stream users and their teacher preferences as NDJSON, one user per line.
+    Filters: class_id.
+    """
+    records = db.iter_user_records(request.args.get('class_id') or None)
+    
+    def generate():
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers={
+        'Content-Disposition': 'attachment; filename=users.ndjson'
+    })
+
+
+@app.route('/api/admin/users/import', methods=['POST'])
+@require_admin
+def import_users():
+    """
+    Import users and their teacher preferences from an NDJSON body (as
+    produced by /api/admin/users/export), read as a stream.
+    Query: merge=true keeps existing preferences the records don't mention.
+    Chunks before an invalid line stay imported; the import can be rerun.
+    """
+    merge = request.args.get('merge', 'false').lower() in ('true', '1')
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8')
+    
+    try:
+        result = db.import_user_records(read_records(lines), merge=merge)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    return jsonify({
+        'success': True,
+        **result
+    })
+
+
+@app.route('/api/admin/maintenance', methods=['POST'])
+@require_admin
+def run_maintenance():
+    """Run database retention and vacuuming now."""
+    result = monitor.run_maintenance()
+    return jsonify({
+        'success': 'error' not in result,
+        'result': result
+    })
+
+
 def start_server(host='0.0.0.0', port=5000, debug=False):
     """Start the Flask server."""
     print(f"Starting Schedule Notifier API on {host}:{port}")
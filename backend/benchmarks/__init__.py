@@ -0,0 +1 @@
+"""Benchmark suite for the backend hot paths. Run with `python -m benchmarks`."""
@@ -0,0 +1,134 @@
+"""
+Run the benchmark suite.
+
+Usage (from backend/):
+    python -m benchmarks                          # run all, print results
+    python -m benchmarks --save baseline.json     # record a baseline
+    python -m benchmarks --compare baseline.json  # exit 1 on regressions
+    python -m benchmarks -k db. --scales 10000    # filter by name and scale
+
+Baselines are only comparable on the same machine, so record them on the
+host (or CI runner) that runs the comparison before deploying.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+from typing import Dict, Optional
+
+from benchmarks import fixtures
+from benchmarks.cases import BENCHMARKS, Case
+
+
+def measure(case: Case, min_runs: int = 5, min_seconds: float = 1.0) -> Dict:
+    """Time case.run() until both min_runs and min_seconds are reached."""
+    case.run()  # Warm-up (lazy imports, caches, SQLite page cache)
+
+    durations = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        deadline = time.perf_counter() + min_seconds
+        while len(durations) < min_runs or time.perf_counter() < deadline:
+            start = time.perf_counter()
+            case.run()
+            durations.append(time.perf_counter() - start)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    median = statistics.median(durations)
+    return {
+        'runs': len(durations),
+        'items': case.items,
+        'median_ms': round(median * 1000, 4),
+        'min_ms': round(min(durations) * 1000, 4),
+        'per_item_us': round(median / case.items * 1_000_000, 3),
+    }
+
+
+def run_all(pattern: Optional[str] = None, scales: Optional[set] = None,
+            min_seconds: float = 1.0) -> Dict[str, Dict]:
+    results = {}
+    for bench in BENCHMARKS:
+        if pattern and pattern not in bench.name:
+            continue
+        for scale in bench.scales:
+            if scale is not None and scales and scale not in scales:
+                continue
+            name = bench.name if scale is None else f'{bench.name}[{scale}]'
+            case = bench.setup(scale)
+            try:
+                results[name] = measure(case, min_seconds=min_seconds)
+            finally:
+                if case.teardown:
+                    case.teardown()
+            print(f"{name:40} {results[name]['median_ms']:>12.3f} ms"
+                  f"  {results[name]['per_item_us']:>12.3f} us/item", file=sys.stderr)
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> int:
+    """Print a comparison table. Returns: Number of regressions."""
+    regressions = 0
+    print(f"{'benchmark':40} {'baseline ms':>12} {'current ms':>12} {'ratio':>7}")
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            print(f"{name:40} {'-':>12} {current['median_ms']:>12.3f}     new")
+            continue
+        ratio = current['median_ms'] / before['median_ms'] if before['median_ms'] else 1.0
+        flag = ''
+        if ratio > threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f"{name:40} {before['median_ms']:>12.3f} {current['median_ms']:>12.3f} {ratio:>7.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scraper, parser, DB and fan-out hot paths')
+    parser.add_argument('-k', dest='pattern', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--scales', help='Comma-separated scales for scaled benchmarks (e.g. 10000)')
+    parser.add_argument('--min-seconds', type=float, default=1.0, help='Minimum timing per benchmark')
+    parser.add_argument('--save', metavar='PATH', help='Write the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH', help='Compare against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Slowdown ratio that counts as a regression (default 1.25)')
+    args = parser.parse_args()
+
+    # Keep per-change log lines out of the timings' output
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scales = {int(value) for value in args.scales.split(',')} if args.scales else None
+    results = run_all(args.pattern, scales, args.min_seconds)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created_at': fixtures.timestamp(),
+                'python': platform.python_version(),
+                'machine': platform.platform(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} results to {args.save}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{regressions} benchmark(s) regressed by more than {args.threshold:.2f}x", file=sys.stderr)
+            sys.exit(1)
+    elif not args.save:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
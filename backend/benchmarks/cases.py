@@ -0,0 +1,245 @@
+"""
+Benchmark cases for the hot paths: page parsing, change-text parsing, subject
+normalization, database reads/writes and notification fan-out.
+
+Each case's setup builds its fixtures and returns a Case whose run() is the
+timed part. Cases with scales are set up once per scale (e.g. user count).
+"""
+
+import itertools
+import random
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+from benchmarks import fixtures
+from matching import ClassMatcher
+from notifier import NotificationService
+from scheduler import ScheduleMonitor
+from scraper import DAYS, parse_class_pages
+
+
+@dataclass
+class Case:
+    run: Callable[[], None]
+    # Items processed per run(), used to report the time per item
+    items: int = 1
+    teardown: Optional[Callable[[], None]] = None
+
+
+@dataclass
+class Benchmark:
+    name: str
+    setup: Callable[..., Case]
+    scales: Sequence[Optional[int]] = (None,)
+
+
+BENCHMARKS: List[Benchmark] = []
+
+DB_SCALES = (10_000, 100_000)
+
+
+def benchmark(name: str, scales: Sequence[Optional[int]] = (None,)):
+    """Register a setup function as a benchmark."""
+    def decorator(setup):
+        BENCHMARKS.append(Benchmark(name, setup, scales))
+        return setup
+    return decorator
+
+
+# Scraper
+
+@benchmark('scraper.get_schedule')
+def bench_get_schedule(scale) -> Case:
+    scraper = fixtures.fixture_scraper(fixtures.school(class_count=300), '1000')
+    return Case(lambda: scraper.get_schedule('1000'))
+
+
+@benchmark('scraper.get_changes')
+def bench_get_changes(scale) -> Case:
+    # get_changes also loads the schedule, so this is two full pages
+    scraper = fixtures.fixture_scraper(fixtures.school(class_count=300, changes_per_class=40), '1000')
+    return Case(lambda: scraper.get_changes('1000'))
+
+
+@benchmark('scraper.parse_change_text')
+def bench_parse_change_text(scale) -> Case:
+    school = fixtures.school(class_count=200)
+    corpus = fixtures.change_corpus(school, 5000)
+
+    # Lesson maps as get_changes builds them: (day, lesson_number, teacher) -> subject
+    lesson_maps: Dict[str, Dict] = {}
+    for class_id, _ in school.classes:
+        lesson_maps[class_id] = {
+            (DAYS[day_index], lesson_number, teacher): subject
+            for lesson_number, row in enumerate(school.timetable(class_id), start=1)
+            for day_index, cell in enumerate(row) for subject, _, teacher in cell
+        }
+    # Mostly the class's own map; every tenth change comes from another class,
+    # which exercises the fuzzy fallbacks
+    maps = list(lesson_maps.values())
+    pairs = [(text, maps[i % len(maps)] if i % 10 else maps[(i + 1) % len(maps)])
+             for i, text in enumerate(corpus)]
+
+    scraper = fixtures.BeginHSScraper()
+
+    def run():
+        for text, lesson_map in pairs:
+            scraper._parse_change_text(text, lesson_map)
+
+    return Case(run, items=len(pairs))
+
+
+@benchmark('scraper.parse_class_pages', scales=(0, 2, 4))
+def bench_parse_class_pages(workers) -> Case:
+    """A cycle's worth of timetable and changes pages, parsed inline (0) or by worker processes."""
+    school = fixtures.school(class_count=40, changes_per_class=10)
+    pages = [fixtures.class_pages(school, class_id) for class_id, _ in school.classes]
+    pool = ProcessPoolExecutor(workers) if workers else None
+
+    def run():
+        if pool is None:
+            for timetable, changes in pages:
+                parse_class_pages(timetable, changes)
+        else:
+            list(pool.map(parse_class_pages, *zip(*pages)))
+
+    return Case(run, items=len(pages), teardown=pool.shutdown if pool else None)
+
+
+@benchmark('scraper.get_unique_subjects')
+def bench_get_unique_subjects(scale) -> Case:
+    school = fixtures.school(class_count=50)
+    lessons = {class_id: fixtures.fixture_scraper(school, class_id, viewstate_kb=0).get_schedule(class_id)
+               for class_id, _ in school.classes}
+
+    scraper = fixtures.BeginHSScraper()
+    # Serve the parsed schedules directly, so only the normalization is timed
+    scraper.get_schedule = lessons.__getitem__
+
+    def run():
+        for class_id in lessons:
+            scraper.get_unique_subjects(class_id)
+
+    return Case(run, items=sum(len(items) for items in lessons.values()))
+
+
+# Database
+
+def _class_teachers(db, sample: int, seed: int = 1) -> List[tuple]:
+    """Pick (class_id, teacher) pairs that have subscribers."""
+    with db.get_connection() as conn:
+        rows = conn.execute('''
+            SELECT DISTINCT u.class_id, tp.teacher_name
+            FROM users u JOIN teacher_preferences tp ON u.id = tp.user_id
+        ''').fetchall()
+    return random.Random(seed).sample([tuple(row) for row in rows], min(sample, len(rows)))
+
+
+@benchmark('db.register_user', scales=DB_SCALES)
+def bench_register_user(scale) -> Case:
+    db = fixtures.populated_database(scale)
+    counter = itertools.count()
+    preferences = {f'subject-{s}': f'teacher-{s}' for s in range(5)}
+
+    def run():
+        for _ in range(50):
+            user_id = db.register_user(f'new-token-{next(counter)}', '1000', 'class')
+            db.set_teacher_preferences(user_id, preferences)
+
+    return Case(run, items=50, teardown=lambda: fixtures.cleanup_database(db))
+
+
+@benchmark('db.get_users_for_teacher', scales=DB_SCALES)
+def bench_get_users_for_teacher(scale) -> Case:
+    db = fixtures.populated_database(scale)
+    pairs = _class_teachers(db, 100)
+
+    def run():
+        for class_id, teacher in pairs:
+            db.get_users_for_teacher(class_id, teacher)
+
+    return Case(run, items=len(pairs), teardown=lambda: fixtures.cleanup_database(db))
+
+
+@benchmark('db.class_reads', scales=DB_SCALES)
+def bench_class_reads(scale) -> Case:
+    """The per-class reads behind the API: recent, unnotified and upcoming changes."""
+    db = fixtures.populated_database(scale)
+    class_ids = random.Random(1).sample(db.get_all_classes(), 50)
+
+    def run():
+        for class_id in class_ids:
+            db.get_recent_changes(class_id)
+            db.get_unnotified_changes(class_id)
+            db.get_changes_by_date(class_id, 'upcoming')
+
+    return Case(run, items=len(class_ids), teardown=lambda: fixtures.cleanup_database(db))
+
+
+@benchmark('db.cycle_reads', scales=DB_SCALES)
+def bench_cycle_reads(scale) -> Case:
+    """The whole-table reads done once per monitor cycle."""
+    db = fixtures.populated_database(scale)
+
+    def run():
+        db.get_all_classes()
+        db.get_class_subscriber_counts()
+
+    return Case(run, teardown=lambda: fixtures.cleanup_database(db))
+
+
+@benchmark('db.user_feed', scales=DB_SCALES)
+def bench_user_feed(scale) -> Case:
+    db = fixtures.populated_database(scale)
+    user_ids = random.Random(1).sample(range(1, scale + 1), 100)
+    with db.get_connection() as conn:
+        class_ids = dict(conn.execute('SELECT id, class_id FROM users').fetchall())
+
+    def run():
+        for user_id in user_ids:
+            # As /api/feed does it
+            class_id = class_ids[user_id]
+            matcher = ClassMatcher(db.get_cached_schedule(class_id),
+                                   db.get_class_preferences(class_id, user_id=user_id))
+            db.get_user_feed(user_id, limit=20, follows=lambda change: bool(matcher.match(change)))
+
+    return Case(run, items=len(user_ids), teardown=lambda: fixtures.cleanup_database(db))
+
+
+@benchmark('db.add_change', scales=DB_SCALES)
+def bench_add_change(scale) -> Case:
+    """Storing a cycle's scraped changes: mostly duplicates, some new."""
+    db = fixtures.populated_database(scale)
+    class_ids = db.get_all_classes()[:50]
+    existing = [row for class_id in class_ids for row in db.get_recent_changes(class_id)]
+    counter = itertools.count()
+
+    def run():
+        for row in existing:
+            db.add_change(row['class_id'], row)
+        for class_id in class_ids:
+            db.add_change(class_id, {**existing[0], 'teacher': f'new-{next(counter)}'})
+
+    return Case(run, items=len(existing) + len(class_ids),
+                teardown=lambda: fixtures.cleanup_database(db))
+
+
+# Notifications
+
+@benchmark('notify.fanout')
+def bench_notify_fanout(scale) -> Case:
+    """Formatting and batching one cycle's notifications (sends are dry runs)."""
+    school = fixtures.school(class_count=20)
+    scraper = fixtures.BeginHSScraper()
+    changes = [scraper._parse_change_text(text, {}) for text in fixtures.change_corpus(school, 200)]
+    changes = [change for change in changes if change]
+    users = [{'device_token': f'token-{n}', 'language': 'he' if n % 5 else 'en'} for n in range(300)]
+
+    monitor = ScheduleMonitor(None, NotificationService(dry_run=True))
+
+    def run():
+        for change in changes:
+            monitor._notify_users(change, users)
+
+    return Case(run, items=len(changes))
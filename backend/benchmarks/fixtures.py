@@ -0,0 +1,105 @@
+"""
+Benchmark fixtures: synthetic pages, change strings and populated databases.
+Pages are rendered by the stand-in server's renderers, so benchmarks parse
+the same markup as a load test without any network I/O.
+"""
+
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+import population
+import standin_server
+from database import Database
+from scraper import BeginHSScraper
+
+
+class FixtureSession:
+    """
+    Stands in for the scraper's requests.Session and answers every request
+    with a pre-rendered page, so only parsing is measured.
+    """
+
+    def __init__(self, pages: Dict[str, bytes]):
+        self.pages = pages
+        self.headers: Dict[str, str] = {}
+
+    def request(self, method: str, url: str, data: Optional[Dict] = None, **kwargs) -> requests.Response:
+        target = (data or {}).get('__EVENTTARGET', '')
+        response = requests.Response()
+        response.status_code = 200
+        response.encoding = 'utf-8'
+        response._content = self.pages.get(target.rsplit('$', 1)[-1], self.pages[''])
+        return response
+
+
+def school(class_count: int = 50, changes_per_class: int = 3) -> standin_server.SyntheticSchool:
+    return standin_server.SyntheticSchool(class_count, changes_per_class, churn_seconds=600)
+
+
+def fixture_scraper(synthetic_school: standin_server.SyntheticSchool, class_id: str,
+                    viewstate_kb: float = 30) -> BeginHSScraper:
+    """Create a scraper whose requests return full pages for one class."""
+    state = standin_server.PageState(b'benchmark', int(viewstate_kb * 1024))
+
+    def page(content: str) -> bytes:
+        return standin_server.render_page(synthetic_school, state, class_id, content).encode('utf-8')
+
+    scraper = BeginHSScraper(async_postback=False)
+    scraper.session = FixtureSession({
+        '': page(''),
+        'ClassesList': page(''),
+        'btnTimeTable': page(standin_server.render_timetable(synthetic_school, class_id)),
+        'btnChanges': page(standin_server.render_changes(synthetic_school, class_id, now=0)),
+    })
+    return scraper
+
+
+def class_pages(synthetic_school: standin_server.SyntheticSchool, class_id: str,
+                viewstate_kb: float = 30) -> Tuple[bytes, bytes]:
+    """Render a class's full timetable and changes pages, as the scraper downloads them."""
+    state = standin_server.PageState(b'benchmark', int(viewstate_kb * 1024))
+    return tuple(
+        standin_server.render_page(synthetic_school, state, class_id, content).encode('utf-8')
+        for content in (standin_server.render_timetable(synthetic_school, class_id),
+                        standin_server.render_changes(synthetic_school, class_id, now=0))
+    )
+
+
+def change_corpus(synthetic_school: standin_server.SyntheticSchool, size: int) -> List[str]:
+    """Collect at least `size` change strings across classes and churn epochs."""
+    corpus: List[str] = []
+    epoch = 0
+    while len(corpus) < size:
+        for class_id, _ in synthetic_school.classes:
+            corpus.extend(synthetic_school.changes(class_id, now=epoch * synthetic_school.churn_seconds))
+        epoch += 1
+    return corpus[:size]
+
+
+def populated_database(user_count: int, users_per_class: int = 40,
+                       months: float = 1, seed: int = 1) -> Database:
+    """
+    Create a temporary database with user_count users and a month of changes,
+    using the synthetic population generator.
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')
+    population.generate(path, population.PopulationConfig(
+        users=user_count, classes=max(1, user_count // users_per_class), months=months, seed=seed
+    ))
+    return Database(path)
+
+
+def cleanup_database(db: Database):
+    """Remove a database created by populated_database()."""
+    directory = os.path.dirname(db.db_path)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+def timestamp() -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%S')
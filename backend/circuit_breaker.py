@@ -0,0 +1,180 @@
+"""
+Circuit breaker for requests to the school website.
+While the site is down or very slow, every scrape would otherwise wait for
+the full request timeout and API workers and the monitor would pile up
+behind it. The breaker tracks the failure and slow-call rates of recent
+requests; past a threshold it opens and requests fail immediately with
+CircuitOpenError, so callers can serve their last good data instead. After
+open_seconds a few half-open probe requests decide whether it closes again.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+T = TypeVar('T')
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit is open."""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Circuit '{name}' is open, next attempt in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Thread-safe circuit breaker over a sliding time window of calls."""
+
+    def __init__(self, name: str = 'upstream', window_seconds: float = 60.0, min_calls: int = 5,
+                 failure_rate: float = 0.5, slow_call_seconds: float = 10.0,
+                 slow_call_rate: float = 0.5, open_seconds: float = 30.0, half_open_calls: int = 1):
+        """
+        Args:
+            name: Label for logs and metrics
+            window_seconds: How far back calls count towards the rates
+            min_calls: Calls needed in the window before the circuit can open
+            failure_rate: Share of failed calls that opens the circuit
+            slow_call_seconds: Calls taking at least this long count as slow
+            slow_call_rate: Share of slow calls that opens the circuit
+            open_seconds: How long the circuit stays open before probing
+            half_open_calls: Successful probes needed to close the circuit
+                             (also the number of probes allowed at once)
+        """
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        # (finished_at, failed, slow) of the calls in the window
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        self._failures = 0
+        self._slow = 0
+        self._probes = 0
+        self._probe_successes = 0
+        metrics.UPSTREAM_CIRCUIT_STATE.set(0, circuit=name)
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def call(self, func: Callable[[], T], is_failure: Optional[Callable[[T], bool]] = None) -> T:
+        """
+        Run func through the breaker.
+        is_failure: Classifies a returned result as a failure (e.g. HTTP 5xx)
+        Raises: CircuitOpenError when the circuit is open; func's own exceptions
+                (which count as failures) otherwise.
+        """
+        self._before_call()
+        start = time.monotonic()
+        try:
+            result = func()
+        except Exception:
+            self._after_call(time.monotonic() - start, failed=True)
+            raise
+        self._after_call(time.monotonic() - start,
+                         failed=is_failure is not None and is_failure(result))
+        return result
+
+    def _before_call(self):
+        with self._lock:
+            if self._state == OPEN:
+                retry_in = self._opened_at + self.open_seconds - time.monotonic()
+                if retry_in > 0:
+                    metrics.UPSTREAM_REJECTED_TOTAL.inc(circuit=self.name)
+                    raise CircuitOpenError(self.name, retry_in)
+                self._set_state(HALF_OPEN)
+                self._probes = 0
+                self._probe_successes = 0
+
+            if self._state == HALF_OPEN:
+                # Only a few probes at a time; everyone else keeps failing fast
+                if self._probes >= self.half_open_calls:
+                    metrics.UPSTREAM_REJECTED_TOTAL.inc(circuit=self.name)
+                    raise CircuitOpenError(self.name, 0)
+                self._probes += 1
+
+    def _after_call(self, duration: float, failed: bool):
+        slow = duration >= self.slow_call_seconds
+        now = time.monotonic()
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes -= 1
+                if failed or slow:
+                    self._open(f"probe {'failed' if failed else f'took {duration:.1f}s'}")
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._reset_window()
+                        self._set_state(CLOSED)
+                return
+
+            if self._state == OPEN:
+                # Started before the circuit opened
+                return
+
+            self._calls.append((now, failed, slow))
+            self._failures += failed
+            self._slow += slow
+            while self._calls and self._calls[0][0] < now - self.window_seconds:
+                _, old_failed, old_slow = self._calls.popleft()
+                self._failures -= old_failed
+                self._slow -= old_slow
+
+            calls = len(self._calls)
+            if calls < self.min_calls:
+                return
+            if self._failures / calls >= self.failure_rate:
+                self._open(f"{self._failures}/{calls} calls failed")
+            elif self._slow / calls >= self.slow_call_rate:
+                self._open(f"{self._slow}/{calls} calls took over {self.slow_call_seconds:.0f}s")
+
+    def _open(self, reason: str):
+        self._opened_at = time.monotonic()
+        self._reset_window()
+        self._set_state(OPEN)
+        logger.warning(f"Circuit '{self.name}' opened: {reason}, retrying in {self.open_seconds:.0f}s")
+
+    def _reset_window(self):
+        self._calls.clear()
+        self._failures = 0
+        self._slow = 0
+
+    def _set_state(self, state: str):
+        if state != self._state and state != OPEN:
+            logger.info(f"Circuit '{self.name}' is {state.replace('_', '-')}")
+        self._state = state
+        metrics.UPSTREAM_CIRCUIT_STATE.set(_STATE_VALUES[state], circuit=self.name)
+
+    def get_status(self) -> Dict:
+        """Get the state and the failure/slow-call rates of the current window."""
+        with self._lock:
+            calls = len(self._calls)
+            status = {
+                'state': self._state,
+                'calls': calls,
+                'failure_rate': round(self._failures / calls, 3) if calls else 0.0,
+                'slow_call_rate': round(self._slow / calls, 3) if calls else 0.0,
+            }
+            if self._state == OPEN:
+                status['retry_in'] = round(max(self._opened_at + self.open_seconds - time.monotonic(), 0), 1)
+            return status
@@ -4,15 +4,77 @@ Uses SQLite for simplicity and portability.
 """
 
 import sqlite3
-from typing import List, Dict, Optional, Tuple
-from datetime import datetime
+import re
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import json
+import functools
+import gzip
+import itertools
+import time
 from contextlib import contextmanager
 
+import metrics
+import tracing
+from normalize import normalize_teacher, teachers_match
+
+
+# The school's timezone, used to decide which lessons are already in the past
+SCHOOL_TIMEZONE = 'Asia/Jerusalem'
+
+_DATE_PATTERN = re.compile(r'(\d{1,2})[./-](\d{1,2})[./-](\d{4}|\d{2})')
+
+
+def to_iso_date(text: str) -> Optional[str]:
+    """
+    Convert a scraped date (e.g. '15.01.2026') to ISO format ('2026-01-15').
+    Returns None if the text does not contain a valid date.
+    """
+    match = _DATE_PATTERN.search(text or '')
+    if not match:
+        return None
+    day, month, year = (int(part) for part in match.groups())
+    if year < 100:
+        year += 2000
+    try:
+        return date(year, month, day).isoformat()
+    except ValueError:
+        return None
+
+
+def school_today() -> str:
+    """Get today's date in the school's timezone, in ISO format."""
+    try:
+        return datetime.now(ZoneInfo(SCHOOL_TIMEZONE)).date().isoformat()
+    except ZoneInfoNotFoundError:
+        return date.today().isoformat()
+
+
+def _timed(func):
+    """Record the latency of a Database method in metrics and the active trace."""
+    span_name = f'db.{func.__name__}'
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with tracing.span(span_name):
+                return func(*args, **kwargs)
+        finally:
+            metrics.DB_OPERATION_SECONDS.observe(
+                time.perf_counter() - start, method=func.__name__
+            )
+    return wrapper
+
 
 class Database:
     """Database manager for the schedule notifier."""
     
+    # Records per executemany batch and transaction in user import/export;
+    # also bounds the IN (...) list of the token lookup
+    TRANSFER_CHUNK_SIZE = 500
+    
     def __init__(self, db_path: str = "schedule_notifier.db"):
         self.db_path = db_path
         self._init_db()
@@ -36,6 +98,13 @@ class Database:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
+            # Must be set before the first table is created to take effect;
+            # older databases are converted by optimize_storage()
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            # Sharded monitors write from several processes; WAL lets readers
+            # and the single writer proceed without blocking each other
+            cursor.execute('PRAGMA journal_mode = WAL')
+            
             # Users table
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -85,6 +154,9 @@ class Database:
                     date TEXT NOT NULL,
                     lesson_number INTEGER NOT NULL,
                     teacher TEXT NOT NULL,
+                    teacher_key TEXT,
+                    subject TEXT DEFAULT '',
+                    lesson_date TEXT,
                     change_type TEXT NOT NULL,
                     description TEXT NOT NULL,
                     new_room TEXT,
@@ -94,12 +166,98 @@ class Database:
                 )
             ''')
             
+            # Cycle traces table (bounded ring buffer, see save_cycle_trace)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cycle_traces (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    started_at TEXT NOT NULL,
+                    duration_ms REAL NOT NULL,
+                    busy_ms REAL NOT NULL,
+                    classes_checked INTEGER DEFAULT 0,
+                    new_changes INTEGER DEFAULT 0,
+                    trace TEXT NOT NULL
+                )
+            ''')
+            
+            # Monitor shards (see sharding.py), one row per live monitor process
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS monitor_shards (
+                    shard_id TEXT PRIMARY KEY,
+                    pid INTEGER,
+                    hostname TEXT,
+                    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    heartbeat_at REAL NOT NULL
+                )
+            ''')
+            
+            # Latest parsed changes per class (see ScheduleMonitor.get_live_snapshot),
+            # shared by all API workers and monitor shards
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS live_snapshots (
+                    class_id TEXT PRIMARY KEY,
+                    fetched_at REAL NOT NULL,
+                    changes TEXT NOT NULL
+                )
+            ''')
+            
+            # Columns added after the first release
+            self._ensure_column(cursor, 'changes_history', 'subject', "TEXT DEFAULT ''")
+            if self._ensure_column(cursor, 'changes_history', 'lesson_date', 'TEXT'):
+                self._backfill_lesson_dates(cursor)
+            # Normalized teacher name, so preferences match scraped names
+            # regardless of spacing and quote variants
+            self._ensure_column(cursor, 'teacher_preferences', 'teacher_key', 'TEXT')
+            self._backfill_teacher_keys(cursor)
+            if self._ensure_column(cursor, 'changes_history', 'teacher_key', 'TEXT'):
+                self._backfill_change_teacher_keys(cursor)
+            
             # Create indexes
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_class ON users(class_id)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_changes_class ON changes_history(class_id, notified)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_schedule_class ON schedule_cache(class_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_traces_duration ON cycle_traces(duration_ms)')
+            # Feed pages: changes of one class in ID order from a cursor ID,
+            # filtered by teacher without reading the rows
+            cursor.execute('DROP INDEX IF EXISTS idx_changes_class_teacher')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_changes_class_id ON changes_history(class_id, id, teacher_key)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_changes_class_date ON changes_history(class_id, lesson_date)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_preferences_teacher_key ON teacher_preferences(teacher_key)')
+    
+    @staticmethod
+    def _ensure_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str) -> bool:
+        """
+        Add a column to an existing table if it is missing.
+        Returns True if the column was added.
+        """
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column in {row['name'] for row in cursor.fetchall()}:
+            return False
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        return True
+    
+    @staticmethod
+    def _backfill_lesson_dates(cursor: sqlite3.Cursor):
+        """Fill lesson_date for rows stored before the column existed."""
+        cursor.execute('SELECT id, date FROM changes_history WHERE lesson_date IS NULL')
+        updates = [(to_iso_date(row['date']), row['id']) for row in cursor.fetchall()]
+        cursor.executemany('UPDATE changes_history SET lesson_date = ? WHERE id = ?', updates)
+    
+    @staticmethod
+    def _backfill_teacher_keys(cursor: sqlite3.Cursor):
+        """Fill teacher_key for preferences stored without one."""
+        cursor.execute('SELECT id, teacher_name FROM teacher_preferences WHERE teacher_key IS NULL')
+        updates = [(normalize_teacher(row['teacher_name']), row['id']) for row in cursor.fetchall()]
+        cursor.executemany('UPDATE teacher_preferences SET teacher_key = ? WHERE id = ?', updates)
+    
+    @staticmethod
+    def _backfill_change_teacher_keys(cursor: sqlite3.Cursor):
+        """Fill teacher_key for changes stored before the column existed."""
+        cursor.execute('SELECT id, teacher FROM changes_history')
+        updates = [(normalize_teacher(row['teacher']), row['id']) for row in cursor.fetchall()]
+        cursor.executemany('UPDATE changes_history SET teacher_key = ? WHERE id = ?', updates)
     
     # User operations
+    @_timed
     def register_user(self, device_token: str, class_id: str, class_name: str, 
                      language: str = 'he') -> int:
         """Register a new user or update existing one."""
@@ -119,6 +277,7 @@ class Database:
             cursor.execute('SELECT id FROM users WHERE device_token = ?', (device_token,))
             return cursor.fetchone()[0]
     
+    @_timed
     def get_user_by_token(self, device_token: str) -> Optional[Dict]:
         """Get user by device token."""
         with self.get_connection() as conn:
@@ -127,6 +286,7 @@ class Database:
             row = cursor.fetchone()
             return dict(row) if row else None
     
+    @_timed
     def get_users_by_class(self, class_id: str) -> List[Dict]:
         """Get all users in a specific class."""
         with self.get_connection() as conn:
@@ -134,6 +294,7 @@ class Database:
             cursor.execute('SELECT * FROM users WHERE class_id = ?', (class_id,))
             return [dict(row) for row in cursor.fetchall()]
     
+    @_timed
     def get_all_classes(self) -> List[str]:
         """Get list of all classes that have registered users."""
         with self.get_connection() as conn:
@@ -141,7 +302,16 @@ class Database:
             cursor.execute('SELECT DISTINCT class_id FROM users')
             return [row[0] for row in cursor.fetchall()]
     
+    @_timed
+    def get_class_subscriber_counts(self) -> Dict[str, int]:
+        """Get the number of registered users per class."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT class_id, COUNT(*) FROM users GROUP BY class_id')
+            return {row[0]: row[1] for row in cursor.fetchall()}
+    
     # Teacher preferences operations
+    @_timed
     def set_teacher_preferences(self, user_id: int, preferences: Dict[str, str]):
         """
         Set teacher preferences for a user.
@@ -157,10 +327,11 @@ class Database:
             for subject, teacher in preferences.items():
                 if teacher:  # Skip subjects with no teacher selected
                     cursor.execute('''
-                        INSERT INTO teacher_preferences (user_id, subject, teacher_name)
-                        VALUES (?, ?, ?)
-                    ''', (user_id, subject, teacher))
+                        INSERT INTO teacher_preferences (user_id, subject, teacher_name, teacher_key)
+                        VALUES (?, ?, ?, ?)
+                    ''', (user_id, subject, teacher, normalize_teacher(teacher)))
     
+    @_timed
     def get_teacher_preferences(self, user_id: int) -> Dict[str, str]:
         """Get teacher preferences for a user."""
         with self.get_connection() as conn:
@@ -172,43 +343,196 @@ class Database:
             ''', (user_id,))
             return {row['subject']: row['teacher_name'] for row in cursor.fetchall()}
     
+    def iter_user_records(self, class_id: Optional[str] = None) -> Iterator[Dict]:
+        """
+        Stream users with their teacher preferences, in ID order, for export.
+        Rows are fetched in batches, so memory use doesn't grow with the user count.
+        Yields: Dicts with device_token, class_id, class_name, language,
+                created_at, updated_at and preferences (subject -> teacher).
+        """
+        where = 'WHERE u.class_id = ?' if class_id else ''
+        with self.get_connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT u.id, u.device_token, u.class_id, u.class_name, u.language,
+                       u.created_at, u.updated_at, tp.subject, tp.teacher_name
+                FROM users u LEFT JOIN teacher_preferences tp ON tp.user_id = u.id
+                {where}
+                ORDER BY u.id
+            ''', (class_id,) if class_id else ())
+            
+            # Preference rows of a user are adjacent, so each user is complete
+            # once a row of the next one arrives
+            record, user_id = None, None
+            while True:
+                rows = cursor.fetchmany(self.TRANSFER_CHUNK_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    if row['id'] != user_id:
+                        if record is not None:
+                            yield record
+                        user_id = row['id']
+                        record = {key: row[key] for key in ('device_token', 'class_id', 'class_name',
+                                                            'language', 'created_at', 'updated_at')}
+                        record['preferences'] = {}
+                    if row['subject'] is not None:
+                        record['preferences'][row['subject']] = row['teacher_name']
+            if record is not None:
+                yield record
+    
+    def import_user_records(self, records: Iterable[Dict], merge: bool = False,
+                            chunk_size: Optional[int] = None) -> Dict[str, int]:
+        """
+        Insert or update users and their preferences from exported records.
+        
+        Users are matched by device token. Each chunk of records is written
+        with a few executemany calls in its own transaction, so memory stays
+        flat and an interrupted import can simply be run again.
+        
+        merge: Keep a user's existing preferences that the record doesn't
+               mention (by default the record's preferences replace them)
+        Returns: Dict with imported and skipped record counts.
+        """
+        chunk_size = chunk_size or self.TRANSFER_CHUNK_SIZE
+        result = {'imported': 0, 'skipped': 0}
+        
+        with self.get_connection() as conn:
+            chunk = []
+            for record in itertools.chain(records, [None]):
+                if record is not None:
+                    if not record.get('device_token') or not record.get('class_id'):
+                        result['skipped'] += 1
+                        continue
+                    chunk.append(record)
+                    if len(chunk) < chunk_size:
+                        continue
+                if chunk:
+                    self._import_user_chunk(conn, chunk, merge)
+                    conn.commit()
+                    result['imported'] += len(chunk)
+                    chunk = []
+        
+        return result
+    
+    @staticmethod
+    def _import_user_chunk(conn: sqlite3.Connection, chunk: List[Dict], merge: bool):
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO users (device_token, class_id, class_name, language, created_at, updated_at)
+            VALUES (?1, ?2, COALESCE(?3, ''), COALESCE(?4, 'he'),
+                    COALESCE(?5, CURRENT_TIMESTAMP), COALESCE(?6, CURRENT_TIMESTAMP))
+            ON CONFLICT(device_token) DO UPDATE SET
+                class_id = excluded.class_id,
+                class_name = COALESCE(?3, class_name),
+                language = COALESCE(?4, language),
+                updated_at = excluded.updated_at
+        ''', [(
+            record['device_token'],
+            record['class_id'],
+            # Fields missing from a record keep their current values
+            record.get('class_name'),
+            record.get('language'),
+            record.get('created_at'),
+            record.get('updated_at')
+        ) for record in chunk])
+        
+        # Records without a preferences key leave the user's preferences alone
+        with_preferences = [record for record in chunk if record.get('preferences') is not None]
+        if not with_preferences:
+            return
+        
+        tokens = [record['device_token'] for record in with_preferences]
+        user_ids = dict(cursor.execute(
+            f"SELECT device_token, id FROM users WHERE device_token IN ({','.join('?' * len(tokens))})",
+            tokens
+        ).fetchall())
+        
+        if not merge:
+            cursor.executemany('DELETE FROM teacher_preferences WHERE user_id = ?',
+                               [(user_ids[token],) for token in tokens])
+        cursor.executemany('''
+            INSERT INTO teacher_preferences (user_id, subject, teacher_name, teacher_key)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, subject) DO UPDATE SET
+                teacher_name = excluded.teacher_name,
+                teacher_key = excluded.teacher_key
+        ''', [
+            (user_ids[record['device_token']], subject, teacher, normalize_teacher(teacher))
+            for record in with_preferences
+            for subject, teacher in record['preferences'].items()
+            if teacher  # Skip subjects with no teacher selected, as set_teacher_preferences does
+        ])
+    
+    @_timed
     def get_users_for_teacher(self, class_id: str, teacher_name: str) -> List[Dict]:
-        """Get all users who have selected a specific teacher."""
+        """Get all users who have selected a specific teacher (compared in normalized form)."""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT DISTINCT u.* 
                 FROM users u
                 JOIN teacher_preferences tp ON u.id = tp.user_id
-                WHERE u.class_id = ? AND tp.teacher_name = ?
-            ''', (class_id, teacher_name))
+                WHERE u.class_id = ? AND tp.teacher_key = ?
+            ''', (class_id, normalize_teacher(teacher_name)))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    @_timed
+    def get_class_preferences(self, class_id: str, user_id: Optional[int] = None) -> List[Dict]:
+        """
+        Get every teacher preference of a class's users, with the user's token and language.
+        user_id: Only this user's preferences
+        """
+        query = '''
+            SELECT u.id AS user_id, u.device_token, u.language, tp.subject, tp.teacher_key
+            FROM users u
+            JOIN teacher_preferences tp ON u.id = tp.user_id
+            WHERE u.class_id = ?
+        '''
+        params: list = [class_id]
+        if user_id is not None:
+            query += ' AND u.id = ?'
+            params.append(user_id)
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
             return [dict(row) for row in cursor.fetchall()]
     
     # Schedule cache operations
-    def cache_schedule(self, class_id: str, lessons: List[Dict]):
-        """Cache the schedule for a class."""
+    @_timed
+    def apply_schedule_diff(self, class_id: str, upserts: List[Dict], deletes: List[Tuple]) -> int:
+        """
+        Update a class's cached schedule in place.
+        upserts: New or changed lessons (dicts or ScheduleLesson records)
+        deletes: (day, lesson_number, subject, teacher) keys of removed lessons
+        Returns: Number of rows written.
+        """
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            
-            # Clear old cache for this class
-            cursor.execute('DELETE FROM schedule_cache WHERE class_id = ?', (class_id,))
-            
-            # Insert new schedule
-            for lesson in lessons:
-                cursor.execute('''
-                    INSERT INTO schedule_cache 
-                    (class_id, day, lesson_number, subject, teacher, room, group_info)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    class_id,
-                    lesson.get('day', ''),
-                    lesson.get('lesson_number', 0),
-                    lesson.get('subject', ''),
-                    lesson.get('teacher', ''),
-                    lesson.get('room', ''),
-                    lesson.get('group', '')
-                ))
+            cursor.executemany('''
+                DELETE FROM schedule_cache
+                WHERE class_id = ? AND day = ? AND lesson_number = ? AND subject = ? AND teacher = ?
+            ''', [(class_id, *key) for key in deletes])
+            cursor.executemany('''
+                INSERT INTO schedule_cache
+                (class_id, day, lesson_number, subject, teacher, room, group_info)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(class_id, day, lesson_number, subject, teacher) DO UPDATE SET
+                    room = excluded.room,
+                    group_info = excluded.group_info,
+                    cached_at = CURRENT_TIMESTAMP
+            ''', [(
+                class_id,
+                lesson.get('day', ''),
+                lesson.get('lesson_number', 0),
+                lesson.get('subject', ''),
+                lesson.get('teacher', ''),
+                lesson.get('room', ''),
+                lesson.get('group', '')
+            ) for lesson in upserts])
+            return len(deletes) + len(upserts)
     
+    @_timed
     def get_cached_schedule(self, class_id: str) -> List[Dict]:
         """Get cached schedule for a class."""
         with self.get_connection() as conn:
@@ -220,33 +544,81 @@ class Database:
             ''', (class_id,))
             return [dict(row) for row in cursor.fetchall()]
     
+    @_timed
+    def get_schedule_version(self, class_id: str) -> Dict:
+        """
+        Get values that change whenever a class's cached schedule changes,
+        and the class's number of registered users (who keep the monitor
+        refreshing it). Used to build ETag/Last-Modified headers without
+        loading the rows.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COUNT(*) AS lessons,
+                       MAX(cached_at) AS last_cached,
+                       (SELECT COUNT(*) FROM users WHERE class_id = ?) AS subscribers
+                FROM schedule_cache
+                WHERE class_id = ?
+            ''', (class_id, class_id))
+            return dict(cursor.fetchone())
+    
     # Changes history operations
-    def add_change(self, class_id: str, change: Dict) -> bool:
+    @_timed
+    def add_change(self, class_id: str, change: Dict) -> Optional[int]:
         """
         Add a schedule change to history.
-        Returns True if this is a new change, False if it already exists.
+        change: Dict, or a ScheduleChange (which supports dict-style access)
+        Returns the new row ID if this is a new change, None if it already exists.
         """
         with self.get_connection() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute('''
                     INSERT INTO changes_history 
-                    (class_id, date, lesson_number, teacher, change_type, description, new_room)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    (class_id, date, lesson_date, lesson_number, teacher, teacher_key, subject,
+                     change_type, description, new_room)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
                     class_id,
                     change.get('date', ''),
+                    to_iso_date(change.get('date', '')),
                     change.get('lesson_number', 0),
                     change.get('teacher', ''),
+                    normalize_teacher(change.get('teacher', '')),
+                    change.get('subject', ''),
                     change.get('change_type', ''),
                     change.get('description', ''),
                     change.get('new_room')
                 ))
-                return True
+                return cursor.lastrowid
             except sqlite3.IntegrityError:
                 # Change already exists
-                return False
+                return None
+    
+    @_timed
+    def get_change(self, change_id: int) -> Optional[Dict]:
+        """Get a single change by ID."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM changes_history WHERE id = ?', (change_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    @_timed
+    def get_changes_since(self, class_id: str, after_id: int, limit: int = 100) -> List[Dict]:
+        """Get changes for a class with an ID greater than after_id, oldest first."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM changes_history
+                WHERE class_id = ? AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (class_id, after_id, limit))
+            return [dict(row) for row in cursor.fetchall()]
     
+    @_timed
     def get_unnotified_changes(self, class_id: str) -> List[Dict]:
         """Get changes that haven't been notified yet."""
         with self.get_connection() as conn:
@@ -258,6 +630,7 @@ class Database:
             ''', (class_id,))
             return [dict(row) for row in cursor.fetchall()]
     
+    @_timed
     def mark_change_notified(self, change_id: int):
         """Mark a change as notified."""
         with self.get_connection() as conn:
@@ -268,6 +641,7 @@ class Database:
                 WHERE id = ?
             ''', (change_id,))
     
+    @_timed
     def get_recent_changes(self, class_id: str, limit: int = 50) -> List[Dict]:
         """Get recent changes for a class."""
         with self.get_connection() as conn:
@@ -280,14 +654,333 @@ class Database:
             ''', (class_id, limit))
             return [dict(row) for row in cursor.fetchall()]
     
-    def cleanup_old_changes(self, days: int = 7):
-        """Remove changes older than specified days."""
+    @_timed
+    def get_changes_by_date(self, class_id: str, when: str, limit: int = 50) -> List[Dict]:
+        """
+        Get a class's changes by lesson date.
+        when: 'upcoming' (today and later, soonest first), 'today',
+              or 'past' (before today, most recent first)
+        """
+        conditions = {
+            'upcoming': ('lesson_date >= ?', 'lesson_date ASC, lesson_number ASC'),
+            'today': ('lesson_date = ?', 'lesson_number ASC'),
+            'past': ('lesson_date < ?', 'lesson_date DESC, lesson_number DESC'),
+        }
+        if when not in conditions:
+            raise ValueError(f"Invalid value for when: '{when}'")
+        condition, order = conditions[when]
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT * FROM changes_history
+                WHERE class_id = ? AND {condition}
+                ORDER BY {order}
+                LIMIT ?
+            ''', (class_id, school_today(), limit))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    @_timed
+    def get_user_feed(self, user_id: int, before: Optional[int] = None,
+                      since: Optional[int] = None, limit: int = 50,
+                      upcoming_only: bool = False,
+                      follows: Optional[Callable[[Dict], bool]] = None) -> List[Dict]:
+        """
+        Get changes in the user's class that concern the user.
+        
+        Uses keyset pagination on the change ID:
+        - before: changes older than this ID, newest first (paging back)
+        - since: changes newer than this ID, oldest first (delta sync)
+        Without either, returns the newest changes first.
+        upcoming_only skips changes to lessons that are already in the past.
+        follows: Decides if a change concerns the user, as push notifications
+                 do (see matching.ClassMatcher); changes are read in ID order
+                 until `limit` of them pass.
+        Only changes by a teacher the user follows (compared with
+        normalize.teachers_match, as the matcher does) are read, so follows
+        sees every change it could accept.
+        """
+        feed = []
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT teacher_key FROM teacher_preferences WHERE user_id = ?', (user_id,))
+            followed = [row['teacher_key'] for row in cursor.fetchall()]
+            cursor.execute('''
+                SELECT DISTINCT ch.teacher_key
+                FROM users u
+                JOIN changes_history ch ON ch.class_id = u.class_id
+                WHERE u.id = ?
+            ''', (user_id,))
+            teacher_keys = [row['teacher_key'] for row in cursor.fetchall()
+                            if any(teachers_match(row['teacher_key'], key) for key in followed)]
+            if not teacher_keys:
+                return feed
+            
+            query = f'''
+                SELECT ch.*
+                FROM users u
+                JOIN changes_history ch ON ch.class_id = u.class_id
+                WHERE u.id = ? AND ch.teacher_key IN ({', '.join('?' * len(teacher_keys))})
+            '''
+            params: list = [user_id, *teacher_keys]
+            
+            if upcoming_only:
+                query += ' AND ch.lesson_date >= ?'
+                params.append(school_today())
+            
+            if since is not None:
+                query += ' AND ch.id > ? ORDER BY ch.id ASC'
+                params.append(since)
+            else:
+                if before is not None:
+                    query += ' AND ch.id < ?'
+                    params.append(before)
+                query += ' ORDER BY ch.id DESC'
+            
+            cursor.execute(query, params)
+            while len(feed) < limit:
+                rows = cursor.fetchmany(limit)
+                if not rows:
+                    break
+                for row in rows:
+                    change = dict(row)
+                    if follows is None or follows(change):
+                        feed.append(change)
+                        if len(feed) == limit:
+                            break
+        return feed
+    
+    @_timed
+    def get_changes_version(self, class_id: str) -> Dict:
+        """
+        Get values that change whenever a class's changes history changes.
+        Used to build ETag/Last-Modified headers without loading the rows.
+        """
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                DELETE FROM changes_history 
-                WHERE detected_at < datetime('now', '-' || ? || ' days')
-            ''', (days,))
+                SELECT MAX(id) AS max_id,
+                       COUNT(*) AS count,
+                       COALESCE(SUM(notified), 0) AS notified,
+                       MAX(detected_at) AS last_detected
+                FROM changes_history
+                WHERE class_id = ?
+            ''', (class_id,))
+            return dict(cursor.fetchone())
+    
+    @_timed
+    def cleanup_old_changes(self, days: int = 7, archive_path: Optional[str] = None) -> int:
+        """
+        Remove changes to lessons more than `days` days in the past.
+        Rows without a lesson date fall back to when they were detected.
+        
+        Args:
+            days: Retention window in days
+            archive_path: Optional gzip file the removed rows are appended to
+                          as JSON lines before they are deleted
+        
+        Returns:
+            Number of removed rows
+        """
+        # Counted from the school's today, like lesson dates, not SQLite's UTC 'now'
+        cutoff = (date.fromisoformat(school_today()) - timedelta(days=days)).isoformat()
+        condition = 'COALESCE(lesson_date, date(detected_at)) < ?'
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            if archive_path:
+                cursor.execute(f'SELECT * FROM changes_history WHERE {condition} ORDER BY id', (cutoff,))
+                # Appending creates a new gzip member; readers see one continuous stream
+                with gzip.open(archive_path, 'at', encoding='utf-8') as archive:
+                    while True:
+                        rows = cursor.fetchmany(1000)
+                        if not rows:
+                            break
+                        for row in rows:
+                            archive.write(json.dumps(dict(row), ensure_ascii=False) + '\n')
+            
+            cursor.execute(f'DELETE FROM changes_history WHERE {condition}', (cutoff,))
+            return cursor.rowcount
+    
+    # Maintenance operations
+    @_timed
+    def optimize_storage(self) -> Dict:
+        """
+        Reclaim free pages and refresh query planner statistics.
+        
+        Databases created before incremental auto-vacuum was enabled are
+        converted once with a full VACUUM, so run this off-peak.
+        
+        Returns:
+            Dict with the number of pages freed
+        """
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+            else:
+                # executescript steps the pragma to completion (execute frees one page)
+                conn.executescript('PRAGMA incremental_vacuum;')
+            
+            conn.execute('PRAGMA optimize')
+            free_after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            return {'pages_freed': max(free_before - free_after, 0)}
+        finally:
+            conn.close()
+    
+    @_timed
+    def get_storage_stats(self) -> Dict:
+        """Get the database file size and row counts per table."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+            page_count = cursor.execute('PRAGMA page_count').fetchone()[0]
+            free_pages = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+            
+            tables = [row[0] for row in cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()]
+            rows = {
+                table: cursor.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                for table in tables
+            }
+            
+            return {
+                'size_bytes': page_size * page_count,
+                'free_bytes': page_size * free_pages,
+                'rows': rows
+            }
+    
+    # Cycle trace operations
+    @_timed
+    def save_cycle_trace(self, record: Dict, keep: int = 200):
+        """
+        Store a cycle trace, keeping only the most recent `keep` traces.
+        record: Dict produced by tracing.Trace.to_record()
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            attributes = record.get('attributes', {})
+            cursor.execute('''
+                INSERT INTO cycle_traces
+                (started_at, duration_ms, busy_ms, classes_checked, new_changes, trace)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (
+                record['started_at'],
+                record['duration_ms'],
+                record['busy_ms'],
+                attributes.get('classes_checked', 0),
+                attributes.get('new_changes', 0),
+                json.dumps(record, ensure_ascii=False)
+            ))
+            
+            # Drop traces that fell out of the ring buffer
+            cursor.execute('DELETE FROM cycle_traces WHERE id <= ?', (cursor.lastrowid - keep,))
+    
+    @_timed
+    def get_slowest_cycle_traces(self, limit: int = 10) -> List[Dict]:
+        """Get the slowest stored cycle traces, slowest first."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, trace FROM cycle_traces
+                ORDER BY duration_ms DESC
+                LIMIT ?
+            ''', (limit,))
+            traces = []
+            for row in cursor.fetchall():
+                trace = json.loads(row['trace'])
+                trace['id'] = row['id']
+                traces.append(trace)
+            return traces
+    
+    @_timed
+    def heartbeat_shard(self, shard_id: str, pid: int, hostname: str):
+        """Register a monitor shard or refresh its heartbeat."""
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT INTO monitor_shards (shard_id, pid, hostname, heartbeat_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(shard_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at
+            ''', (shard_id, pid, hostname, time.time()))
+    
+    @_timed
+    def get_live_shards(self, ttl_seconds: float) -> List[str]:
+        """
+        Get the IDs of the shards that sent a heartbeat within ttl_seconds.
+        Dead shards are removed on the way.
+        """
+        cutoff = time.time() - ttl_seconds
+        with self.get_connection() as conn:
+            conn.execute('DELETE FROM monitor_shards WHERE heartbeat_at < ?', (cutoff,))
+            return [row['shard_id'] for row in conn.execute(
+                'SELECT shard_id FROM monitor_shards ORDER BY shard_id')]
+    
+    def get_shards(self) -> List[Dict]:
+        """Get all registered shards with their last heartbeat age in seconds."""
+        now = time.time()
+        with self.get_connection() as conn:
+            rows = conn.execute('''
+                SELECT shard_id, pid, hostname, started_at, heartbeat_at FROM monitor_shards
+                ORDER BY shard_id
+            ''').fetchall()
+        return [{**dict(row), 'heartbeat_age': round(now - row['heartbeat_at'], 1)} for row in rows]
+    
+    def remove_shard(self, shard_id: str):
+        """Unregister a monitor shard."""
+        with self.get_connection() as conn:
+            conn.execute('DELETE FROM monitor_shards WHERE shard_id = ?', (shard_id,))
+    
+    # Live snapshot operations
+    @_timed
+    def save_live_snapshot(self, class_id: str, fetched_at: float, changes: List[Dict]):
+        """Store the latest parsed changes of a class, unless a newer snapshot is stored."""
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT INTO live_snapshots (class_id, fetched_at, changes)
+                VALUES (?, ?, ?)
+                ON CONFLICT(class_id) DO UPDATE SET
+                    fetched_at = excluded.fetched_at,
+                    changes = excluded.changes
+                WHERE excluded.fetched_at > live_snapshots.fetched_at
+            ''', (class_id, fetched_at, json.dumps(changes, ensure_ascii=False)))
+    
+    @_timed
+    def touch_live_snapshots(self, updates: List[Tuple[str, float, float]]) -> List[str]:
+        """
+        Move stored snapshots' fetch time forward without rewriting their changes.
+        updates: (class_id, stored fetched_at, new fetched_at) per snapshot
+        Returns: IDs of the classes whose snapshot was replaced in the meantime
+                 (e.g. by another process) and so was left alone.
+        """
+        replaced = []
+        with self.get_connection() as conn:
+            for class_id, stored_at, fetched_at in updates:
+                cursor = conn.execute(
+                    'UPDATE live_snapshots SET fetched_at = ? WHERE class_id = ? AND fetched_at = ?',
+                    (fetched_at, class_id, stored_at)
+                )
+                if cursor.rowcount == 0:
+                    replaced.append(class_id)
+        return replaced
+    
+    @_timed
+    def get_live_snapshot(self, class_id: str) -> Optional[Tuple[float, List[Dict]]]:
+        """
+        Get the latest stored changes of a class.
+        Returns: Tuple of (fetched_at timestamp, change dicts), or None.
+        """
+        with self.get_connection() as conn:
+            row = conn.execute(
+                'SELECT fetched_at, changes FROM live_snapshots WHERE class_id = ?', (class_id,)
+            ).fetchone()
+        if not row:
+            return None
+        return row['fetched_at'], json.loads(row['changes'])
 
 
 # Example usage
@@ -0,0 +1,72 @@
+"""
+In-process publish/subscribe of newly detected schedule changes.
+The monitor publishes each new changes_history row so the SSE streams of
+that class wake up right away. Streams read the changes themselves from the
+database, which also has the changes detected by other processes.
+"""
+
+import queue
+import threading
+from typing import Dict, Optional, Set
+
+
+class Subscription:
+    """A single client's queue of changes for one class."""
+
+    def __init__(self, class_id: str, max_pending: int):
+        self.class_id = class_id
+        self.queue: 'queue.Queue[Dict]' = queue.Queue(maxsize=max_pending)
+
+    def get(self, timeout: float) -> Optional[Dict]:
+        """Wait for the next change. Returns: The change, or None on timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def drain(self):
+        """Drop the pending changes (the stream reads them from the database)."""
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class ChangeBroker:
+    """Fans out new changes to subscribers of each class."""
+
+    def __init__(self, max_pending: int = 100):
+        self.max_pending = max_pending
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, class_id: str) -> Subscription:
+        subscription = Subscription(class_id, self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(class_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.class_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.class_id]
+
+    def publish(self, class_id: str, change: Dict):
+        """Send a change (a changes_history row) to every subscriber of the class."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(class_id, ()))
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(change)
+            except queue.Full:
+                # The client is already due to wake up and read the database
+                pass
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
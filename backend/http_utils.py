@@ -0,0 +1,97 @@
+"""
+HTTP helpers for the Flask API: conditional GET (ETag/Last-Modified) and
+response compression for clients that poll frequently.
+"""
+
+import gzip
+import hashlib
+from datetime import datetime, timezone
+from typing import Callable, Optional, Union
+
+from flask import Response, jsonify, request
+
+try:
+    import brotli
+except ImportError:  # Optional dependency, gzip is used when it is missing
+    brotli = None
+
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+def make_etag(*parts) -> str:
+    """Build a weak ETag from the values that identify a response version."""
+    digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:20]
+    # Weak, because the same version may be served with different encodings
+    return f'W/"{digest}"'
+
+
+def parse_db_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """Parse an SQLite CURRENT_TIMESTAMP value (UTC) into an aware datetime."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def _not_modified(etag: str, last_modified: Optional[datetime]) -> bool:
+    """Check the request's validators against the current version."""
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+        return request.if_none_match.contains_weak(etag.removeprefix('W/').strip('"'))
+
+    if last_modified and request.if_modified_since:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+
+    return False
+
+
+def conditional_json(payload: Union[dict, Callable[[], dict]], etag: str,
+                     last_modified: Optional[datetime] = None) -> Response:
+    """
+    Return payload as JSON, or an empty 304 if the client already has this version.
+    payload may be a callable, in which case it is only built when needed.
+    Clients are asked to revalidate on every use, so a poll costs a 304 when
+    nothing changed.
+    """
+    if _not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        response = jsonify(payload() if callable(payload) else payload)
+
+    response.headers['ETag'] = etag
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def compress_response(response: Response) -> Response:
+    """Compress a response with brotli or gzip if the client accepts it."""
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
@@ -0,0 +1,97 @@
+"""
+Matching of schedule changes to the subscribers they affect.
+A ClassMatcher is built once per class check from the class's timetable and
+its users' teacher preferences, after which each change is resolved with a
+hash lookup instead of a database query.
+"""
+
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from database import to_iso_date
+from normalize import normalize_subject, normalize_teacher, teachers_match
+
+
+# Day names used by the timetable, by date.weekday()
+DAY_NAMES = {6: 'ראשון', 0: 'שני', 1: 'שלישי', 2: 'רביעי', 3: 'חמישי', 4: 'שישי'}
+
+UNKNOWN_SUBJECT = 'Unknown'
+
+
+def day_name(change_date: str) -> Optional[str]:
+    """Get the timetable day name of a scraped date (e.g. '15.01.2026')."""
+    iso_date = to_iso_date(change_date)
+    if not iso_date:
+        return None
+    return DAY_NAMES.get(date.fromisoformat(iso_date).weekday())
+
+
+class ClassMatcher:
+    """Maps a class's (subject, teacher) pairs and lesson slots to subscribers."""
+
+    def __init__(self, lessons: Iterable, preferences: Iterable[Dict]):
+        """
+        Args:
+            lessons: The class's timetable (ScheduleLesson records or schedule_cache rows)
+            preferences: Rows from Database.get_class_preferences() (of the whole
+                         class, or of one user for their feed)
+        """
+        self.users: Dict[int, Dict] = {}
+        # (subject key, teacher key) -> user IDs
+        self._by_pair: Dict[Tuple[str, str], Set[int]] = {}
+        # teacher key -> user IDs, for changes that can't be placed in the timetable
+        self._by_teacher: Dict[str, Set[int]] = {}
+        for row in preferences:
+            self.users[row['user_id']] = {'id': row['user_id'],
+                                          'device_token': row['device_token'],
+                                          'language': row['language']}
+            pair = (normalize_subject(row['subject']), row['teacher_key'])
+            self._by_pair.setdefault(pair, set()).add(row['user_id'])
+            self._by_teacher.setdefault(row['teacher_key'], set()).add(row['user_id'])
+
+        # (day, lesson_number) -> (subject key, teacher key) of the lessons in that slot
+        self._slots: Dict[Tuple[str, int], List[Tuple[str, str]]] = {}
+        for lesson in lessons:
+            pair = (normalize_subject(lesson['subject']), normalize_teacher(lesson['teacher']))
+            self._slots.setdefault((lesson['day'], lesson['lesson_number']), []).append(pair)
+
+    def _users(self, user_ids: Iterable[int]) -> List[Dict]:
+        return [self.users[user_id] for user_id in user_ids]
+
+    def subscribers(self, subject: str, teacher: str) -> List[Dict]:
+        """Get the users following a (subject, teacher) pair."""
+        pair = (normalize_subject(subject), normalize_teacher(teacher))
+        return self._users(self._by_pair.get(pair, ()))
+
+    def match(self, change) -> List[Dict]:
+        """
+        Get the users affected by a change.
+        change: ScheduleChange, or a changes_history row
+        Returns: User dicts with id, device_token and language.
+        """
+        teacher_key = normalize_teacher(change['teacher'])
+        slot = self._slots.get((day_name(change['date']), change['lesson_number']), ())
+
+        # A subject the scraper resolved to a lesson in this very slot pins
+        # the change to one timetable pair
+        if change['subject'] and change['subject'] != UNKNOWN_SUBJECT:
+            pair = (normalize_subject(change['subject']), teacher_key)
+            if pair in slot:
+                return self._users(self._by_pair.get(pair, ()))
+
+        # Otherwise place it in its slot: the lessons at that day and lesson
+        # number taught by a matching teacher. Whether it is placed depends
+        # only on the timetable, so matching a single user's preferences
+        # (the feed) agrees with matching the whole class's.
+        user_ids: Set[int] = set()
+        placed = False
+        for subject_key, lesson_teacher in slot:
+            if teachers_match(teacher_key, lesson_teacher):
+                placed = True
+                user_ids |= self._by_pair.get((subject_key, lesson_teacher), set())
+        if placed:
+            return self._users(user_ids)
+
+        # Not in this class's timetable (e.g. a substitute's lesson): everyone
+        # who follows the teacher
+        return self._users(self._by_teacher.get(teacher_key, ()))
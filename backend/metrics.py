@@ -0,0 +1,267 @@
+"""
+Lightweight in-process metrics with Prometheus text exposition.
+Counters, gauges and histograms are kept in memory and rendered on demand
+by the /api/metrics endpoint. Recording a value is a lock plus a few
+additions, so the instrumentation is cheap enough to leave on in production.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+
+_REGISTRY: List['_Metric'] = []
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value the way Prometheus expects."""
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs: Sequence[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    """Base class for a named metric with an optional set of label names."""
+
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+        _REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _label_pairs(self, key: Tuple[str, ...]) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, key))
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}',
+        ]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing counter."""
+
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [
+            f'{self.name}{_format_labels(self._label_pairs(key))} {_format_value(value)}'
+            for key, value in items
+        ]
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [
+            f'{self.name}{_format_labels(self._label_pairs(key))} {_format_value(value)}'
+            for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    """Histogram of observed values (typically durations in seconds)."""
+
+    type_name = 'histogram'
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [per-bucket counts (last one is +Inf), sum, count]
+                state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager that observes the duration of its body."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2]))
+                     for key, state in self._values.items()]
+
+        lines = []
+        for key, (counts, total, count) in items:
+            pairs = self._label_pairs(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(pairs + [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(pairs)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(pairs)} {count}')
+        return lines
+
+
+def render() -> str:
+    """Render all registered metrics in the Prometheus text format."""
+    return '\n'.join(metric.render() for metric in _REGISTRY) + '\n'
+
+
+# Scraper
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    'schedule_notifier_upstream_request_seconds',
+    'Latency of requests to the school website by postback target.',
+    ['target']
+)
+UPSTREAM_RESPONSE_BYTES = Counter(
+    'schedule_notifier_upstream_response_bytes_total',
+    'Bytes downloaded from the school website by target and postback mode.',
+    ['target', 'mode']
+)
+HTML_PARSE_SECONDS = Histogram(
+    'schedule_notifier_html_parse_seconds',
+    'Time spent parsing pages, including the wait for a parse worker when offloaded.',
+    ['page']
+)
+CHANGE_PARSE_SECONDS = Histogram(
+    'schedule_notifier_change_parse_seconds',
+    'Time spent parsing one change cell (not recorded when parsing is offloaded).',
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+)
+PARSE_POOL_RESTARTS_TOTAL = Counter(
+    'schedule_notifier_parse_pool_restarts_total',
+    'Parse pools replaced because a worker process died.'
+)
+UPSTREAM_CIRCUIT_STATE = Gauge(
+    'schedule_notifier_upstream_circuit_state',
+    'State of the circuit breaker around the school website (0 closed, 1 half-open, 2 open).',
+    ['circuit']
+)
+UPSTREAM_REJECTED_TOTAL = Counter(
+    'schedule_notifier_upstream_rejected_total',
+    'Requests to the school website refused because the circuit was open.',
+    ['circuit']
+)
+
+# Database
+DB_OPERATION_SECONDS = Histogram(
+    'schedule_notifier_db_operation_seconds',
+    'Latency of Database operations by method.',
+    ['method']
+)
+
+# Notifications
+FCM_SEND_SECONDS = Histogram(
+    'schedule_notifier_fcm_send_seconds',
+    'Latency of Firebase Cloud Messaging sends by kind and outcome.',
+    ['kind', 'outcome']
+)
+NOTIFICATIONS_TOTAL = Counter(
+    'schedule_notifier_notifications_total',
+    'Push notifications by outcome.',
+    ['outcome']
+)
+
+# Monitor
+CYCLE_DURATION_SECONDS = Histogram(
+    'schedule_notifier_cycle_duration_seconds',
+    'Wall-clock duration of a full check_all_classes cycle, including staggering waits.',
+    buckets=(1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 900.0, 1200.0, 1800.0, 3600.0)
+)
+CLASS_CHECK_SECONDS = Histogram(
+    'schedule_notifier_class_check_seconds',
+    'Duration of checking a single class (scrape, store and notify).'
+)
+CLASSES_CHECKED_TOTAL = Counter(
+    'schedule_notifier_classes_checked_total',
+    'Number of class checks performed.'
+)
+NEW_CHANGES_TOTAL = Counter(
+    'schedule_notifier_new_changes_total',
+    'Number of newly detected schedule changes.'
+)
+SCHEDULE_ROWS_WRITTEN_TOTAL = Counter(
+    'schedule_notifier_schedule_rows_written_total',
+    'schedule_cache rows upserted or deleted by incremental timetable refreshes.'
+)
+TIMETABLE_CHANGES_TOTAL = Counter(
+    'schedule_notifier_timetable_changes_total',
+    'Permanent timetable changes detected, by kind (teacher, room, added, removed).',
+    ['kind']
+)
+SCHEDULER_LAG_SECONDS = Histogram(
+    'schedule_notifier_scheduler_lag_seconds',
+    'Delay between the scheduled and the actual start of scheduled work.',
+    ['job']
+)
+
+# Storage
+DB_SIZE_BYTES = Gauge(
+    'schedule_notifier_db_size_bytes',
+    'Size of the SQLite database file, measured by the maintenance job.'
+)
+DB_ROWS = Gauge(
+    'schedule_notifier_db_rows',
+    'Row count per table, measured by the maintenance job.',
+    ['table']
+)
+
+# Streaming
+STREAMS_REJECTED_TOTAL = Counter(
+    'schedule_notifier_streams_rejected_total',
+    'SSE connections refused because STREAM_MAX_CLIENTS streams were open.'
+)
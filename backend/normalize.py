@@ -0,0 +1,53 @@
+"""
+Normalization of subject and teacher names shared by the scraper, the
+database and change matching.
+The same few hundred names are seen thousands of times per cycle, so the
+results are cached and each distinct string is normalized only once.
+"""
+
+import re
+from functools import lru_cache
+
+
+# Precompiled patterns used while parsing pages
+LESSON_NUMBER_PATTERN = re.compile(r'שיעור\s+(\d+)')
+NEW_ROOM_PATTERN = re.compile(r'לחדר\s+(\S+)')
+ROOM_INFO_PATTERN = re.compile(r'\(([^)]+)\)')
+# "Subject X units ..." (e.g. "English 5 units COBE", "מתמטיקה 5 יח\"ל")
+SUBJECT_UNITS_PATTERN = re.compile(r'^(.+?)\s+(\d+)\s*(?:יח[:\-\'"”]?ל?|יחידות).*$')
+TRAILING_NUMBER_PATTERN = re.compile(r'\s*\d+\s*$')
+
+# Hebrew punctuation (geresh/gershayim) and typographic quotes the site uses
+# interchangeably with their ASCII forms
+_PUNCTUATION = str.maketrans({'׳': "'", '״': '"', '‘': "'", '’': "'", '“': '"', '”': '"'})
+
+
+@lru_cache(maxsize=4096)
+def normalize_subject(subject: str) -> str:
+    """
+    Get the base name used to group a subject's variants
+    (e.g. ספרות 30, ספרות 70 → ספרות; "English 5 units COBE" → "English 5 יח'").
+    """
+    match = SUBJECT_UNITS_PATTERN.search(subject)
+    if match:
+        return f"{match.group(1).strip()} {match.group(2)} יח'"
+    return TRAILING_NUMBER_PATTERN.sub('', subject).strip()
+
+
+@lru_cache(maxsize=8192)
+def normalize_teacher(name: str) -> str:
+    """Get the form teacher names are compared in: single spaces, unified quotes, casefolded."""
+    return ' '.join(name.translate(_PUNCTUATION).split()).casefold()
+
+
+def teachers_match(a: str, b: str) -> bool:
+    """Fuzzy comparison of two normalized teacher names (one contains the other, or equal ignoring spaces)."""
+    return a in b or b in a or a.replace(' ', '') == b.replace(' ', '')
+
+
+def cache_info() -> dict:
+    """Hit/miss statistics of the normalization caches."""
+    return {
+        'subject': normalize_subject.cache_info()._asdict(),
+        'teacher': normalize_teacher.cache_info()._asdict(),
+    }
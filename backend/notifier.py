@@ -6,19 +6,31 @@ import firebase_admin
 from firebase_admin import credentials, messaging
 from typing import List, Dict, Optional
 import os
+import time
+
+import metrics
+import tracing
 
 
 class NotificationService:
     """Service for sending push notifications via Firebase Cloud Messaging."""
     
-    def __init__(self, credentials_path: Optional[str] = None):
+    MAX_MULTICAST_TOKENS = 500
+    
+    def __init__(self, credentials_path: Optional[str] = None, dry_run: bool = False):
         """
         Initialize Firebase Admin SDK.
         
         Args:
             credentials_path: Path to Firebase service account JSON file.
                             If None, will look for GOOGLE_APPLICATION_CREDENTIALS env var.
+            dry_run: Format notifications but don't send them (for load testing).
+                     Firebase is not initialized and every send counts as delivered.
         """
+        self.dry_run = dry_run
+        if dry_run:
+            return
+        
         if not firebase_admin._apps:
             if credentials_path and os.path.exists(credentials_path):
                 cred = credentials.Certificate(credentials_path)
@@ -41,6 +53,11 @@ class NotificationService:
         Returns:
             True if successful, False otherwise
         """
+        if self.dry_run:
+            metrics.NOTIFICATIONS_TOTAL.inc(outcome='dry_run')
+            return True
+        
+        start = None
         try:
             message = messaging.Message(
                 notification=messaging.Notification(
@@ -64,11 +81,20 @@ class NotificationService:
                 ),
             )
             
-            response = messaging.send(message)
+            start = time.perf_counter()
+            with tracing.span('fcm.send'):
+                response = messaging.send(message)
+            metrics.FCM_SEND_SECONDS.observe(time.perf_counter() - start,
+                                             kind='single', outcome='success')
+            metrics.NOTIFICATIONS_TOTAL.inc(outcome='success')
             print(f"Successfully sent notification: {response}")
             return True
             
         except Exception as e:
+            if start is not None:
+                metrics.FCM_SEND_SECONDS.observe(time.perf_counter() - start,
+                                                 kind='single', outcome='failure')
+            metrics.NOTIFICATIONS_TOTAL.inc(outcome='failure')
             print(f"Error sending notification: {e}")
             return False
     
@@ -89,6 +115,21 @@ class NotificationService:
         if not device_tokens:
             return {'success': 0, 'failure': 0}
         
+        if self.dry_run:
+            metrics.NOTIFICATIONS_TOTAL.inc(len(device_tokens), outcome='dry_run')
+            return {'success': len(device_tokens), 'failure': 0}
+        
+        # FCM accepts at most MAX_MULTICAST_TOKENS tokens per multicast message
+        if len(device_tokens) > self.MAX_MULTICAST_TOKENS:
+            totals = {'success': 0, 'failure': 0}
+            for i in range(0, len(device_tokens), self.MAX_MULTICAST_TOKENS):
+                result = self.send_multicast(device_tokens[i:i + self.MAX_MULTICAST_TOKENS],
+                                             title, body, data)
+                totals['success'] += result['success']
+                totals['failure'] += result['failure']
+            return totals
+        
+        start = None
         try:
             message = messaging.MulticastMessage(
                 notification=messaging.Notification(
@@ -112,7 +153,15 @@ class NotificationService:
                 ),
             )
             
-            response = messaging.send_multicast(message)
+            start = time.perf_counter()
+            with tracing.span('fcm.send_multicast', tokens=len(device_tokens)):
+                # send_each_for_multicast replaces send_multicast, whose batch
+                # endpoint has been shut down by Firebase
+                response = messaging.send_each_for_multicast(message)
+            metrics.FCM_SEND_SECONDS.observe(time.perf_counter() - start,
+                                             kind='multicast', outcome='success')
+            metrics.NOTIFICATIONS_TOTAL.inc(response.success_count, outcome='success')
+            metrics.NOTIFICATIONS_TOTAL.inc(response.failure_count, outcome='failure')
             print(f"Successfully sent {response.success_count} notifications")
             print(f"Failed to send {response.failure_count} notifications")
             
@@ -122,6 +171,10 @@ class NotificationService:
             }
             
         except Exception as e:
+            if start is not None:
+                metrics.FCM_SEND_SECONDS.observe(time.perf_counter() - start,
+                                                 kind='multicast', outcome='failure')
+            metrics.NOTIFICATIONS_TOTAL.inc(len(device_tokens), outcome='failure')
             print(f"Error sending multicast notification: {e}")
             return {'success': 0, 'failure': len(device_tokens)}
     
@@ -159,6 +212,43 @@ class NotificationService:
         
         return title, body
     
+    def format_timetable_change_notification(self, change: Dict, language: str = 'he') -> tuple:
+        """
+        Format a notification for a permanent change to the weekly timetable.
+        
+        Args:
+            change: Timetable change dict (see timetable_diff.diff_schedules)
+            language: 'he' or 'en'
+        
+        Returns:
+            Tuple of (title, body)
+        """
+        kind = change['kind']
+        if language == 'he':
+            title = "שינוי קבוע במערכת"
+            lesson = f"{change['subject']} ביום {change['day']} שיעור {change['lesson_number']}"
+            if kind == 'teacher':
+                body = f"{lesson}: {change['teacher']} במקום {change['old_teacher']}"
+            elif kind == 'room':
+                body = f"{lesson} עבר לחדר {change['room']}"
+            elif kind == 'added':
+                body = f"נוסף שיעור: {lesson} - {change['teacher']}"
+            else:
+                body = f"הוסר שיעור: {lesson} - {change['teacher']}"
+        else:  # English
+            title = "Timetable Change"
+            lesson = f"{change['subject']} on {change['day']}, lesson {change['lesson_number']}"
+            if kind == 'teacher':
+                body = f"{lesson}: {change['teacher']} instead of {change['old_teacher']}"
+            elif kind == 'room':
+                body = f"{lesson} moved to room {change['room']}"
+            elif kind == 'added':
+                body = f"New lesson: {lesson} - {change['teacher']}"
+            else:
+                body = f"Lesson removed: {lesson} - {change['teacher']}"
+        
+        return title, body
+    
     def send_change_notification(self, device_token: str, change: Dict, 
                                 language: str = 'he') -> bool:
         """
@@ -172,10 +262,38 @@ class NotificationService:
         Returns:
             True if successful, False otherwise
         """
+        title, body, data = self.format_change_notification(change, language)
+        return self.send_notification(device_token, title, body, data)
+    
+    def send_change_multicast(self, device_tokens: List[str], change: Dict,
+                              language: str = 'he') -> Dict[str, int]:
+        """
+        Send one notification for a schedule change to many devices at once.
+        
+        Args:
+            device_tokens: FCM device tokens (all users share the same language)
+            change: Change dict with date, lesson_number, teacher, change_type, etc.
+            language: 'he' or 'en'
+        
+        Returns:
+            Dict with 'success' and 'failure' counts
+        """
+        title, body, data = self.format_change_notification(change, language)
+        return self.send_multicast(device_tokens, title, body, data)
+    
+    def format_change_notification(self, change: Dict, language: str = 'he') -> tuple:
+        """
+        Format a notification for any kind of schedule change.
+        
+        Returns:
+            Tuple of (title, body, data)
+        """
         if change['change_type'] == 'cancellation':
             title, body = self.format_cancellation_notification(change, language)
         elif change['change_type'] == 'room_change':
             title, body = self.format_room_change_notification(change, language)
+        elif change['change_type'] == 'timetable_change':
+            title, body = self.format_timetable_change_notification(change, language)
         else:
             # Generic change notification
             if language == 'he':
@@ -192,8 +310,7 @@ class NotificationService:
             'date': change['date'],
         }
         
-        return self.send_notification(device_token, title, body, data)
-
+        return title, body, data
 
 # Example usage
 if __name__ == "__main__":
@@ -0,0 +1,336 @@
+"""
+Synthetic population generator for database scaling tests.
+Fills users, teacher_preferences and changes_history with district-sized,
+realistically skewed data using bulk inserts, then reports the query plans
+and latencies of the queries the monitor and API run most.
+
+Usage:
+    python population.py --db population.db --users 200000 --classes 800 --months 6
+    python population.py --db population.db --report-only
+"""
+
+import argparse
+import math
+import os
+import random
+import sqlite3
+import statistics
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterator, List, Tuple
+
+from database import Database, school_today
+from normalize import normalize_teacher
+from standin_server import FIRST_NAMES, GRADES, LAST_NAMES, SUBJECTS
+
+
+# Rows per executemany() batch
+BATCH_SIZE = 50_000
+
+SCHOOL_DAYS = (6, 0, 1, 2, 3, 4)  # Sunday to Friday (date.weekday())
+
+
+@dataclass
+class PopulationConfig:
+    users: int = 100_000
+    classes: int = 400
+    months: float = 6
+    # Zipf exponent of subscribers per class: a few popular classes, a long tail
+    class_skew: float = 1.1
+    # Share of the district's teachers absent on a given school day
+    absence_rate: float = 0.03
+    room_change_rate: float = 0.02
+    english_share: float = 0.15
+    seed: int = 1
+
+
+@dataclass
+class Population:
+    """The generated school structure (rows are streamed straight into SQLite)."""
+    class_ids: List[str] = field(default_factory=list)
+    class_names: Dict[str, str] = field(default_factory=dict)
+    # class_id -> subject -> teacher
+    teachers: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    counts: Dict[str, int] = field(default_factory=dict)
+
+
+def _build_structure(config: PopulationConfig, rng: random.Random) -> Population:
+    population = Population()
+
+    # District teacher pool; each teacher teaches one subject in several classes
+    pool_size = max(len(SUBJECTS), config.classes * 2)
+    names = [f"{last} {first}" for last in LAST_NAMES for first in FIRST_NAMES]
+    pool = [(names[i % len(names)] + (f" {i // len(names) + 1}" if i >= len(names) else ''),
+             SUBJECTS[i % len(SUBJECTS)]) for i in range(pool_size)]
+    by_subject: Dict[str, List[str]] = {}
+    for teacher, subject in pool:
+        by_subject.setdefault(subject, []).append(teacher)
+
+    for index in range(config.classes):
+        class_id = str(1000 + index)
+        population.class_ids.append(class_id)
+        population.class_names[class_id] = f"{GRADES[index % len(GRADES)]} {index // len(GRADES) + 1}"
+        subjects = rng.sample(SUBJECTS, rng.randint(12, len(SUBJECTS)))
+        population.teachers[class_id] = {subject: rng.choice(by_subject[subject]) for subject in subjects}
+
+    return population
+
+
+def _batched(rows: Iterator[tuple]) -> Iterator[List[tuple]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@contextmanager
+def _bulk_connection(db_path: str):
+    """A connection tuned for bulk loading: no journal, no fsync, one transaction."""
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -200000')
+    conn.execute('BEGIN')
+    try:
+        yield conn
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def _insert(conn: sqlite3.Connection, sql: str, rows: Iterator[tuple]) -> int:
+    count = 0
+    for batch in _batched(rows):
+        conn.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+
+def _user_rows(config: PopulationConfig, population: Population,
+               rng: random.Random) -> Iterator[tuple]:
+    weights = [1 / (rank ** config.class_skew) for rank in range(1, config.classes + 1)]
+    ranked = population.class_ids[:]
+    rng.shuffle(ranked)
+    assigned = rng.choices(ranked, weights=weights, k=config.users)
+    for n, class_id in enumerate(assigned):
+        language = 'en' if rng.random() < config.english_share else 'he'
+        yield (f'synthetic-{config.seed}-{n}', class_id, population.class_names[class_id], language)
+
+
+def _preference_rows(conn: sqlite3.Connection, population: Population,
+                     rng: random.Random, prefix: str, after_id: int) -> Iterator[tuple]:
+    # Only users inserted by this run: earlier runs' users may be in classes
+    # this population doesn't have
+    cursor = conn.execute('SELECT id, class_id FROM users WHERE id > ? AND device_token LIKE ?',
+                          (after_id, prefix + '%'))
+    for user_id, class_id in cursor:
+        teachers = population.teachers[class_id]
+        for subject in rng.sample(list(teachers), rng.randint(4, min(10, len(teachers)))):
+            yield (user_id, subject, teachers[subject], normalize_teacher(teachers[subject]))
+
+
+def _change_rows(config: PopulationConfig, population: Population,
+                 rng: random.Random) -> Iterator[tuple]:
+    # Which classes each teacher teaches, so an absence hits all of them
+    classes_by_teacher: Dict[str, List[Tuple[str, str]]] = {}
+    for class_id, teachers in population.teachers.items():
+        for subject, teacher in teachers.items():
+            classes_by_teacher.setdefault(teacher, []).append((class_id, subject))
+    all_teachers = list(classes_by_teacher)
+
+    today = date.fromisoformat(school_today())
+    start = today - timedelta(days=int(config.months * 30))
+    day = start
+    while day <= today + timedelta(days=7):
+        if day.weekday() in SCHOOL_DAYS:
+            date_text = day.strftime('%d.%m.%Y')
+            # Detected the afternoon before the lesson
+            detected_at = (datetime.combine(day, datetime.min.time()) - timedelta(hours=rng.randint(4, 30)))
+            detected_text = detected_at.strftime('%Y-%m-%d %H:%M:%S')
+            notified = 1 if day < today else int(rng.random() < 0.5)
+
+            absent = rng.sample(all_teachers, max(1, int(len(all_teachers) * config.absence_rate)))
+            for teacher in absent:
+                for class_id, subject in classes_by_teacher[teacher]:
+                    lesson_number = rng.randint(1, 10)
+                    yield (class_id, date_text, lesson_number, teacher, normalize_teacher(teacher),
+                           subject, day.isoformat(), 'cancellation', 'ביטול שיעור', None, detected_text, notified)
+
+            for class_id in population.class_ids:
+                if rng.random() < config.room_change_rate * len(population.teachers[class_id]) / 5:
+                    subject, teacher = rng.choice(list(population.teachers[class_id].items()))
+                    room = str(rng.randint(100, 450))
+                    yield (class_id, date_text, rng.randint(1, 10), teacher, normalize_teacher(teacher),
+                           subject, day.isoformat(), 'room_change', f'לחדר {room}', room, detected_text, notified)
+        day += timedelta(days=1)
+
+
+def generate(db_path: str, config: PopulationConfig) -> Dict[str, int]:
+    """
+    Fill the database at db_path with a synthetic population.
+    Returns: Number of rows inserted per table.
+    """
+    Database(db_path)  # Create the schema and indexes
+    rng = random.Random(config.seed)
+    population = _build_structure(config, rng)
+    counts = {}
+
+    with _bulk_connection(db_path) as conn:
+        last_user_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM users').fetchone()[0]
+        counts['users'] = _insert(conn, '''
+            INSERT OR IGNORE INTO users (device_token, class_id, class_name, language)
+            VALUES (?, ?, ?, ?)
+        ''', _user_rows(config, population, rng))
+
+        # Materialized first: the SELECT cursor must not be read while inserting
+        preferences = list(_preference_rows(conn, population, rng, f'synthetic-{config.seed}-', last_user_id))
+        counts['teacher_preferences'] = _insert(conn, '''
+            INSERT OR IGNORE INTO teacher_preferences (user_id, subject, teacher_name, teacher_key)
+            VALUES (?, ?, ?, ?)
+        ''', iter(preferences))
+        del preferences
+
+        counts['changes_history'] = _insert(conn, '''
+            INSERT OR IGNORE INTO changes_history
+            (class_id, date, lesson_number, teacher, teacher_key, subject, lesson_date,
+             change_type, description, new_room, detected_at, notified)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', _change_rows(config, population, rng))
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('ANALYZE')
+    return counts
+
+
+class _RecordingDatabase(Database):
+    """Database that records the SQL (with bound values) its methods execute."""
+
+    def __init__(self, db_path: str):
+        self.statements: List[str] = []
+        super().__init__(db_path)
+
+    @contextmanager
+    def get_connection(self):
+        with super().get_connection() as conn:
+            conn.set_trace_callback(self.statements.append)
+            yield conn
+
+
+def _query_cases(db: Database, rng: random.Random) -> Dict[str, callable]:
+    """Representative calls per query, with parameters drawn from the data."""
+    with db.get_connection() as conn:
+        pairs = conn.execute('''
+            SELECT u.class_id, tp.teacher_name FROM teacher_preferences tp
+            JOIN users u ON u.id = tp.user_id
+            WHERE tp.id IN (SELECT abs(random()) % (SELECT max(id) FROM teacher_preferences) + 1
+                            FROM teacher_preferences LIMIT 200)
+        ''').fetchall()
+        class_ids = [row[0] for row in conn.execute('SELECT DISTINCT class_id FROM users')]
+    pairs = [tuple(row) for row in pairs] or [('0', '')]
+
+    return {
+        'get_users_for_teacher': lambda: db.get_users_for_teacher(*rng.choice(pairs)),
+        'get_recent_changes': lambda: db.get_recent_changes(rng.choice(class_ids)),
+        'get_unnotified_changes': lambda: db.get_unnotified_changes(rng.choice(class_ids)),
+        'get_all_classes': db.get_all_classes,
+    }
+
+
+def report(db_path: str, samples: int = 50, seed: int = 1) -> List[Dict]:
+    """
+    Measure the hot queries and collect their query plans.
+    Returns: One dict per query with latency percentiles, plan lines and warnings.
+    """
+    rng = random.Random(seed)
+    db = _RecordingDatabase(db_path)
+    results = []
+
+    for name, call in _query_cases(db, rng).items():
+        durations = []
+        rows = 0
+        for _ in range(samples):
+            db.statements.clear()
+            start = time.perf_counter()
+            result = call()
+            durations.append((time.perf_counter() - start) * 1000)
+            rows += len(result)
+
+        statement = next((s for s in db.statements if s.lstrip().upper().startswith('SELECT')), '')
+        with sqlite3.connect(db_path) as conn:
+            plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + statement)] if statement else []
+
+        warnings = []
+        for line in plan:
+            # A SCAN of a table (not a covering index) reads every row
+            if line.startswith('SCAN') and 'COVERING INDEX' not in line:
+                warnings.append(f'full scan: {line}')
+            if 'TEMP B-TREE' in line:
+                warnings.append(f'sort without index: {line}')
+
+        durations.sort()
+        results.append({
+            'query': name,
+            'median_ms': round(statistics.median(durations), 3),
+            'p95_ms': round(durations[min(len(durations) - 1, math.ceil(len(durations) * 0.95) - 1)], 3),
+            'avg_rows': round(rows / samples, 1),
+            'plan': plan,
+            'warnings': warnings,
+        })
+    return results
+
+
+def table_counts(db_path: str) -> Dict[str, int]:
+    with sqlite3.connect(db_path) as conn:
+        return {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                for table in ('users', 'teacher_preferences', 'changes_history')}
+
+
+def print_report(results: List[Dict]):
+    for item in results:
+        print(f"\n{item['query']}: median {item['median_ms']} ms, p95 {item['p95_ms']} ms, "
+              f"{item['avg_rows']} rows")
+        for line in item['plan']:
+            print(f"    {line}")
+        for warning in item['warnings']:
+            print(f"    ! {warning}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic population and report query costs')
+    parser.add_argument('--db', default='population.db', help='SQLite file to fill (created if missing)')
+    parser.add_argument('--users', type=int, default=PopulationConfig.users)
+    parser.add_argument('--classes', type=int, default=PopulationConfig.classes)
+    parser.add_argument('--months', type=float, default=PopulationConfig.months,
+                        help='Months of change history to generate')
+    parser.add_argument('--class-skew', type=float, default=PopulationConfig.class_skew)
+    parser.add_argument('--seed', type=int, default=PopulationConfig.seed)
+    parser.add_argument('--samples', type=int, default=50, help='Calls measured per query')
+    parser.add_argument('--report-only', action='store_true', help='Skip generation')
+    args = parser.parse_args()
+
+    if not args.report_only:
+        if os.path.exists(args.db):
+            print(f"Adding to existing database {args.db}")
+        config = PopulationConfig(users=args.users, classes=args.classes, months=args.months,
+                                  class_skew=args.class_skew, seed=args.seed)
+        start = time.perf_counter()
+        counts = generate(args.db, config)
+        elapsed = time.perf_counter() - start
+        print(f"Inserted {sum(counts.values()):,} rows in {elapsed:.1f}s: "
+              + ', '.join(f'{table}={count:,}' for table, count in counts.items()))
+
+    print(f"Table sizes: {table_counts(args.db)}")
+    print_report(report(args.db, args.samples, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+On-demand profiling for the schedule monitor and the API.
+Selected check_all_classes cycles or API requests are run under cProfile
+(and optionally tracemalloc) and the results are written to PROFILE_DIR as
+.pstats and .memdiff.txt files. Profiling is off unless PROFILE_MODE is set.
+"""
+
+import cProfile
+import os
+import random
+import re
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+MODES = ('off', 'cycles', 'requests', 'all')
+KINDS = ('cycle', 'request')
+
+
+class ProfileSession:
+    """A single running profile (cProfile plus an optional tracemalloc snapshot)."""
+
+    def __init__(self, profiler: 'Profiler', kind: str, label: str):
+        self.profiler = profiler
+        self.kind = kind
+        self.label = label
+        self.started_at = datetime.utcnow()
+        self._profile = cProfile.Profile()
+        self._snapshot = None
+        self._started_tracemalloc = False
+
+    def start(self):
+        if self.profiler.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self._started_tracemalloc = True
+            self._snapshot = tracemalloc.take_snapshot()
+        self._profile.enable()
+
+    def stop(self) -> List[str]:
+        """Stop profiling and write the results. Returns: Paths of written files."""
+        self._profile.disable()
+
+        memory_diff = None
+        if self._snapshot is not None:
+            memory_diff = tracemalloc.take_snapshot().compare_to(self._snapshot, 'lineno')
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+
+        return self.profiler._write(self, memory_diff)
+
+
+class Profiler:
+    """Decides which cycles/requests get profiled and stores the results."""
+
+    def __init__(self, mode: str = 'off', sample_rate: float = 0.05,
+                 output_dir: str = 'profiles', max_bytes: int = 100 * 1024 * 1024,
+                 trace_memory: bool = False):
+        """
+        Args:
+            mode: 'off', 'cycles', 'requests' or 'all'
+            sample_rate: Fraction of eligible cycles/requests profiled automatically
+            output_dir: Directory for .pstats and .memdiff.txt files
+            max_bytes: Total size cap for output_dir; oldest files are removed first
+            trace_memory: Also record tracemalloc snapshot diffs
+        """
+        if mode not in MODES:
+            raise ValueError(f"Invalid profile mode '{mode}', expected one of {MODES}")
+
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.max_bytes = max_bytes
+        self.trace_memory = trace_memory
+        self._forced = {kind: 0 for kind in KINDS}
+        self._lock = threading.Lock()
+        # Only one profile at a time: tracemalloc is process-wide and
+        # overlapping profiles would distort each other
+        self._running = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'Profiler':
+        """Create a profiler configured from PROFILE_* environment variables."""
+        return cls(
+            mode=os.getenv('PROFILE_MODE', 'off').lower(),
+            sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', '0.05')),
+            output_dir=os.getenv('PROFILE_DIR', 'profiles'),
+            max_bytes=int(float(os.getenv('PROFILE_MAX_MB', '100')) * 1024 * 1024),
+            trace_memory=os.getenv('PROFILE_TRACEMALLOC', 'False').lower() in ('true', '1', 't')
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off'
+
+    def _kind_enabled(self, kind: str) -> bool:
+        return self.mode == 'all' or self.mode == kind + 's'
+
+    def request_profiles(self, kind: str, count: int = 1):
+        """Force profiling of the next `count` cycles or requests."""
+        if kind not in KINDS:
+            raise ValueError(f"Invalid profile kind '{kind}', expected one of {KINDS}")
+        with self._lock:
+            self._forced[kind] += count
+
+    def pending(self) -> Dict[str, int]:
+        """Get the number of forced profiles still waiting per kind."""
+        with self._lock:
+            return dict(self._forced)
+
+    def start(self, kind: str, label: str) -> Optional[ProfileSession]:
+        """
+        Start profiling if this cycle/request is selected.
+        Returns: The running session, or None if it is not being profiled.
+        """
+        if not self.enabled:
+            return None
+        sampled = self._kind_enabled(kind) and random.random() < self.sample_rate
+        if not sampled and not self.pending()[kind]:
+            return None
+        if not self._running.acquire(blocking=False):
+            return None
+
+        # A forced profile is only used up once it can actually run
+        with self._lock:
+            forced = self._forced[kind] > 0
+            if forced:
+                self._forced[kind] -= 1
+        if not (forced or sampled):
+            self._running.release()
+            return None
+
+        session = ProfileSession(self, kind, label)
+        try:
+            session.start()
+        except Exception:
+            self._running.release()
+            raise
+        return session
+
+    def stop(self, session: Optional[ProfileSession]) -> List[str]:
+        """Stop a session returned by start(). Returns: Paths of written files."""
+        if session is None:
+            return []
+        try:
+            return session.stop()
+        finally:
+            self._running.release()
+
+    @contextmanager
+    def profile(self, kind: str, label: str):
+        """Profile the body of the block if it is selected for profiling."""
+        session = self.start(kind, label)
+        try:
+            yield session
+        finally:
+            self.stop(session)
+
+    def _write(self, session: ProfileSession, memory_diff) -> List[str]:
+        os.makedirs(self.output_dir, exist_ok=True)
+        safe_label = re.sub(r'[^A-Za-z0-9_.-]+', '_', session.label).strip('_')[:80]
+        stamp = session.started_at.strftime('%Y%m%dT%H%M%S%f')
+        base = os.path.join(self.output_dir, f'{session.kind}-{safe_label}-{stamp}')
+
+        paths = [base + '.pstats']
+        session._profile.dump_stats(paths[0])
+
+        if memory_diff is not None:
+            paths.append(base + '.memdiff.txt')
+            with open(paths[1], 'w', encoding='utf-8') as f:
+                f.write(f'# Top memory differences for {session.kind} {session.label}\n')
+                for stat in memory_diff[:50]:
+                    f.write(f'{stat}\n')
+
+        self._enforce_size_cap()
+        return paths
+
+    def _enforce_size_cap(self):
+        """Remove the oldest profile files until the directory fits in max_bytes."""
+        files = self.list_profiles()
+        total = sum(item['size'] for item in files)
+        for item in sorted(files, key=lambda item: item['modified_at']):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.output_dir, item['name']))
+                total -= item['size']
+            except OSError:
+                pass
+
+    def list_profiles(self) -> List[Dict]:
+        """List the stored profile files, newest first."""
+        if not os.path.isdir(self.output_dir):
+            return []
+
+        files = []
+        for name in os.listdir(self.output_dir):
+            if not name.endswith(('.pstats', '.memdiff.txt')):
+                continue
+            stat = os.stat(os.path.join(self.output_dir, name))
+            files.append({
+                'name': name,
+                'size': stat.st_size,
+                'modified_at': datetime.utcfromtimestamp(stat.st_mtime).isoformat(timespec='seconds')
+            })
+        return sorted(files, key=lambda item: item['modified_at'], reverse=True)
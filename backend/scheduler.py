@@ -4,12 +4,34 @@ Background scheduler for checking schedule changes periodically.
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from datetime import datetime
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import heapq
 import logging
-from typing import Dict, List
+import multiprocessing
+import random
+import requests
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple, Union
 
-from scraper import BeginHSScraper
-from database import Database
+import metrics
+import tracing
+from profiling import Profiler
+from events import ChangeBroker
+from snapshots import SnapshotStore
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from sharding import MAINTENANCE_KEY, ShardMembership
+from scraper import BeginHSScraper, PendingClass, ScheduleChange, ScheduleLesson
+from matching import ClassMatcher
+from timetable_diff import diff_schedules
+from database import Database, SCHOOL_TIMEZONE, school_today, to_iso_date
 from notifier import NotificationService
 
 
@@ -20,83 +42,528 @@ logger = logging.getLogger(__name__)
 class ScheduleMonitor:
     """Monitors schedule changes and sends notifications."""
     
-    def __init__(self, db: Database, notifier: NotificationService):
+    # Above this share of changed lessons a timetable update is stored silently
+    MAX_TIMETABLE_CHANGE_FRACTION = 0.25
+    
+    def __init__(self, db: Database, notifier: NotificationService,
+                 spread_fraction: float = 0.9, jitter_fraction: float = 0.5,
+                 trace_buffer_size: int = 200, profiler: Optional[Profiler] = None,
+                 retention_days: int = 60, archive_path: Optional[str] = None,
+                 maintenance_hour: int = 3, pre_school_boost: float = 3.0,
+                 pre_school_boost_hours: float = 14.0, staleness_weight: float = 5.0,
+                 base_url: Optional[str] = None, snapshots: Optional[SnapshotStore] = None,
+                 shard: Optional[ShardMembership] = None, parse_workers: int = 0,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        Args:
+            db: Database instance
+            notifier: Notification service used for push messages
+            spread_fraction: Portion of the check interval over which class checks
+                             are spread (0 checks all classes back to back)
+            jitter_fraction: Random jitter applied inside each class's slot, as a
+                             fraction of the slot length
+            trace_buffer_size: Number of recent cycle traces kept in the database
+            profiler: Optional profiler used to profile selected check cycles
+            retention_days: Changes to lessons older than this are removed
+            archive_path: Optional gzip file removed changes are archived to
+            maintenance_hour: Hour of the night (school time) maintenance runs at
+            pre_school_boost: Subscriber-count multiplier before the school day starts
+            pre_school_boost_hours: How many hours before the school day the boost applies
+            staleness_weight: Priority added per check interval since a class was last checked
+            base_url: School page to scrape instead of the real site
+            snapshots: Optional store for scraped pages (pruned with retention_days)
+            shard: Membership of this monitor in a sharded deployment; only the
+                   classes the shard owns are checked
+            parse_workers: Number of processes pages are parsed in (0 parses
+                           in this process). With workers, a cycle downloads
+                           the next classes while earlier ones are parsed.
+            breaker: Optional circuit breaker for requests to the school website
+        """
         self.db = db
         self.notifier = notifier
-        self.scraper = BeginHSScraper()
+        self.snapshots = snapshots
+        self.shard = shard
+        self.parse_workers = parse_workers
+        self.parse_pool = self._start_parse_pool(parse_workers) if parse_workers > 0 else None
+        self._parse_pool_lock = threading.Lock()
+        self.scraper = BeginHSScraper(base_url=base_url, snapshots=snapshots, parse_pool=self.parse_pool,
+                                      breaker=breaker)
         self.scheduler = BackgroundScheduler()
+        self.interval_seconds = 20 * 60
+        self.spread_fraction = spread_fraction
+        self.jitter_fraction = jitter_fraction
+        self.trace_buffer_size = trace_buffer_size
+        self.profiler = profiler or Profiler()
+        self.events = ChangeBroker()
+        self.retention_days = retention_days
+        self.archive_path = archive_path
+        self.maintenance_hour = maintenance_hour
+        self.pre_school_boost = pre_school_boost
+        self.pre_school_boost_hours = pre_school_boost_hours
+        self.staleness_weight = staleness_weight
+        self._last_checked: Dict[str, float] = {}
+        # Latest scraped timetable per class
+        self._schedules: Dict[str, List[ScheduleLesson]] = {}
+        
+        # Latest parsed changes per class: class_id -> (fetched_at, changes),
+        # also stored in live_snapshots for the other processes
+        self._snapshots: Dict[str, Tuple[float, List[ScheduleChange]]] = {}
+        # fetched_at of the live_snapshots row known to hold the same changes
+        self._stored_snapshots: Dict[str, float] = {}
+        # Fetch times of unchanged snapshots not yet written: class_id -> fetched_at
+        self._snapshot_touches: Dict[str, float] = {}
+        self._touches_since: Optional[float] = None
+        # Scrapes in progress for get_live_snapshot, shared by concurrent callers
+        self._refreshing: Dict[str, Future] = {}
+        self._snapshot_lock = threading.Lock()
+        # Separate session for on-demand refreshes, so they never wait behind a cycle
+        self.live_scraper = BeginHSScraper(base_url=base_url, snapshots=snapshots, parse_pool=self.parse_pool,
+                                           breaker=breaker)
+        self._stop_event = threading.Event()
+    
+    @staticmethod
+    def _start_parse_pool(workers: int) -> ProcessPoolExecutor:
+        """
+        Start the page parsing processes.
+        They are forked right away, while this is still the only thread, since
+        `python api.py` can't be re-imported by spawned workers.
+        """
+        context = multiprocessing.get_context('fork') \
+            if 'fork' in multiprocessing.get_all_start_methods() else None
+        pool = ProcessPoolExecutor(workers, mp_context=context)
+        pool.submit(int).result()
+        return pool
+    
+    def _restore_parse_pool(self):
+        """
+        Replace the parse pool if it is broken. When a worker dies (e.g. it is
+        killed for memory), the pool fails every pending and later parse.
+        The replacement is forked from the running process; the workers only
+        run the page parsers, which take no locks.
+        """
+        with self._parse_pool_lock:
+            try:
+                self.parse_pool.submit(int).result()
+                return
+            except BrokenProcessPool:
+                pass
+            
+            logger.error("A parse worker died, restarting the parse pool")
+            metrics.PARSE_POOL_RESTARTS_TOTAL.inc()
+            self.parse_pool.shutdown(wait=False)
+            self.parse_pool = self._start_parse_pool(self.parse_workers)
+            self.scraper.parse_pool = self.parse_pool
+            self.live_scraper.parse_pool = self.parse_pool
+    
+    def check_changes_for_class(self, class_id: str, pages: Optional[PendingClass] = None) -> int:
+        """
+        Check for changes in a specific class and notify affected users.
+        pages: The class's pages if already fetched with scraper.fetch_class()
+        Returns: Number of new changes detected.
+        """
+        metrics.CLASSES_CHECKED_TOTAL.inc()
+        with metrics.CLASS_CHECK_SECONDS.time(), tracing.span('check_class', class_id=class_id):
+            return self._check_changes_for_class(class_id, pages)
     
-    def check_changes_for_class(self, class_id: str):
-        """Check for changes in a specific class and notify affected users."""
+    def _check_changes_for_class(self, class_id: str, pages: Optional[PendingClass] = None,
+                                 retry: bool = True) -> int:
+        new_changes = 0
         try:
             logger.info(f"Checking changes for class {class_id}")
             
-            # Scrape current changes
-            changes = self.scraper.get_changes(class_id)
+            if pages is not None:
+                with tracing.span('wait_parse'):
+                    schedule, changes = pages.result()
+                self._store_schedule(class_id, schedule)
+            else:
+                # Scrape the timetable, then the changes (resolved against it)
+                with tracing.span('scrape_schedule'):
+                    schedule = self.scraper.get_schedule(class_id)
+                self._store_schedule(class_id, schedule)
+                with tracing.span('scrape_changes'):
+                    changes = self.scraper.get_changes(class_id, schedule=schedule)
+            self._save_snapshot(class_id, changes)
             
             if not changes:
                 logger.info(f"No changes found for class {class_id}")
-                return
+                self._last_checked[class_id] = time.time()
+                return 0
+            
+            # Built on the first new change, most checks don't need it
+            matcher = None
             
             # Process each change
             for change in changes:
-                # Convert dataclass to dict
-                change_dict = {
-                    'date': change.date,
-                    'lesson_number': change.lesson_number,
-                    'teacher': change.teacher,
-                    'change_type': change.change_type,
-                    'description': change.description,
-                    'new_room': change.new_room
-                }
+                # Add to database (returns the new row ID if new)
+                change_id = self.db.add_change(class_id, change)
                 
-                # Add to database (returns True if new)
-                is_new_change = self.db.add_change(class_id, change_dict)
-                
-                if is_new_change:
+                if change_id:
+                    new_changes += 1
+                    metrics.NEW_CHANGES_TOTAL.inc()
                     logger.info(f"New change detected: {change.teacher} - {change.change_type}")
                     
-                    # Get users who have this teacher
-                    affected_users = self.db.get_users_for_teacher(class_id, change.teacher)
+                    # Push to clients streaming this class
+                    if self.events.subscriber_count():
+                        row = self.db.get_change(change_id)
+                        if row:
+                            self.events.publish(class_id, row)
+                    
+                    # Don't push changes to lessons that already took place
+                    lesson_date = to_iso_date(change.date)
+                    if lesson_date and lesson_date < school_today():
+                        logger.info(f"Skipping notification for past lesson on {change.date}")
+                        # Handled: it must not come back as unnotified
+                        self.db.mark_change_notified(change_id)
+                        continue
+                    
+                    # Get users who follow this lesson
+                    if matcher is None:
+                        matcher = ClassMatcher(schedule, self.db.get_class_preferences(class_id))
+                    affected_users = matcher.match(change)
                     
                     # Send notifications
-                    for user in affected_users:
-                        success = self.notifier.send_change_notification(
-                            device_token=user['device_token'],
-                            change=change_dict,
-                            language=user.get('language', 'he')
-                        )
-                        
-                        if success:
-                            logger.info(f"Notification sent to user {user['id']}")
-                        else:
-                            logger.error(f"Failed to send notification to user {user['id']}")
+                    self._notify_users(change, affected_users)
                     
                     # Mark as notified
-                    # Get the change ID
-                    recent_changes = self.db.get_recent_changes(class_id, limit=1)
-                    if recent_changes:
-                        self.db.mark_change_notified(recent_changes[0]['id'])
+                    self.db.mark_change_notified(change_id)
+            
+            # Failed and skipped checks don't count, so the class stays stale
+            # and keeps its priority in the next cycle
+            self._last_checked[class_id] = time.time()
         
+        except CircuitOpenError as e:
+            logger.warning(f"Skipping class {class_id}: {e}")
+        except BrokenProcessPool as e:
+            # Raised while parsing, before any change was processed
+            logger.warning(f"Parse pool broke while checking class {class_id}: {e}")
+            self._restore_parse_pool()
+            if retry:
+                return self._check_changes_for_class(class_id, retry=False)
         except Exception as e:
             logger.error(f"Error checking changes for class {class_id}: {e}", exc_info=True)
+        
+        return new_changes
+    
+    def _store_schedule(self, class_id: str, schedule: List[ScheduleLesson]):
+        """
+        Keep the latest timetable of a class. Only lessons that changed are
+        written to schedule_cache, and permanent changes (teacher swaps, room
+        moves, added or removed lessons) are sent to the lessons' subscribers.
+        """
+        if not schedule:
+            return
+        previous = self._schedules.get(class_id)
+        if previous is None:
+            previous = self.db.get_cached_schedule(class_id)
+        self._schedules[class_id] = schedule
+        
+        with tracing.span('diff_schedule'):
+            diff = diff_schedules(previous, schedule)
+        if not diff:
+            return
+        metrics.SCHEDULE_ROWS_WRITTEN_TOTAL.inc(
+            self.db.apply_schedule_diff(class_id, diff.upserts, diff.deletes)
+        )
+        
+        # Nothing to compare against on the first load
+        if not previous or not diff.changes:
+            return
+        
+        # A new term (or a half-parsed page) rewrites most of the timetable;
+        # that is stored but not worth a burst of notifications
+        if len(diff.changes) > self.MAX_TIMETABLE_CHANGE_FRACTION * len(previous):
+            logger.warning(f"Timetable of class {class_id} changed in {len(diff.changes)} places, "
+                           f"not notifying")
+            return
+        
+        # Subscribers of the lessons as they were (the old teacher for swaps)
+        matcher = ClassMatcher(previous, self.db.get_class_preferences(class_id))
+        for change in diff.changes:
+            metrics.TIMETABLE_CHANGES_TOTAL.inc(kind=change['kind'])
+            logger.info(f"Timetable change in class {class_id}: {change['kind']} - "
+                        f"{change['day']} {change['lesson_number']} {change['subject']}")
+            users = matcher.subscribers(change['subject'], change.get('old_teacher', change['teacher']))
+            if users:
+                self._notify_users(change, users)
+    
+    def _notify_users(self, change: Union[ScheduleChange, Dict], users: List[Dict]):
+        """Send a change to its affected users, batched per language."""
+        tokens_by_language: Dict[str, List[str]] = {}
+        for user in users:
+            tokens_by_language.setdefault(user.get('language') or 'he', []).append(user['device_token'])
+        
+        for language, tokens in tokens_by_language.items():
+            with tracing.span('notify', language=language, users=len(tokens)):
+                result = self.notifier.send_change_multicast(tokens, change, language)
+            
+            logger.info(f"Notified {result['success']} users ({language})")
+            if result['failure']:
+                logger.error(f"Failed to notify {result['failure']} users ({language})")
+    
+    def get_live_snapshot(self, class_id: str,
+                          max_age: float) -> Tuple[float, List[ScheduleChange]]:
+        """
+        Get the latest parsed changes for a class.
+        
+        Returns the latest snapshot (this process's or the one another worker
+        or shard stored) if it is at most max_age seconds old. Otherwise the
+        class is scraped once, with concurrent callers for the same class
+        waiting for that single scrape instead of starting their own.
+        
+        Returns: Tuple of (fetched_at timestamp, changes)
+        """
+        snapshot = self.get_last_snapshot(class_id)
+        if snapshot and time.time() - snapshot[0] <= max_age:
+            return snapshot
+        
+        with self._snapshot_lock:
+            refresh = self._refreshing.get(class_id)
+            is_leader = refresh is None
+            if is_leader:
+                refresh = Future()
+                self._refreshing[class_id] = refresh
+        
+        if is_leader:
+            try:
+                try:
+                    changes = self.live_scraper.get_changes(class_id)
+                except BrokenProcessPool:
+                    self._restore_parse_pool()
+                    changes = self.live_scraper.get_changes(class_id)
+                refresh.set_result(self._save_snapshot(class_id, changes))
+            except Exception as e:
+                # Waiting callers get the same error (e.g. CircuitOpenError)
+                refresh.set_exception(e)
+            finally:
+                with self._snapshot_lock:
+                    del self._refreshing[class_id]
+        
+        # Only the new scrape is returned, never an older snapshot past max_age
+        try:
+            return refresh.result(timeout=120)
+        except FuturesTimeoutError:
+            raise requests.Timeout(f"Timed out waiting for the changes of class {class_id}") from None
+    
+    def get_last_snapshot(self, class_id: str) -> Optional[Tuple[float, List[ScheduleChange]]]:
+        """Get the latest parsed changes for a class, however old, without scraping."""
+        snapshot = self._snapshots.get(class_id)
+        try:
+            stored = self.db.get_live_snapshot(class_id)
+        except Exception as e:
+            logger.warning(f"Could not load the stored snapshot of class {class_id}: {e}")
+            return snapshot
+        
+        # Another process (the shard owning the class) may have a newer one
+        if stored and (snapshot is None or stored[0] > snapshot[0]):
+            fetched_at, changes = stored
+            snapshot = (fetched_at, [ScheduleChange(**change) for change in changes])
+            self._snapshots[class_id] = snapshot
+            self._stored_snapshots[class_id] = fetched_at
+        return snapshot
+    
+    # How long fetch times of unchanged snapshots may wait to be stored
+    SNAPSHOT_FLUSH_SECONDS = 60
+    
+    def _save_snapshot(self, class_id: str,
+                       changes: List[ScheduleChange]) -> Tuple[float, List[ScheduleChange]]:
+        """
+        Keep a class's freshly parsed changes, here and for the other processes.
+        Changes identical to the stored ones aren't written again; only their
+        fetch time is, batched with other classes' (see _flush_snapshot_times).
+        Returns: The snapshot, as (fetched_at timestamp, changes).
+        """
+        previous = self._snapshots.get(class_id)
+        snapshot = (time.time(), changes)
+        self._snapshots[class_id] = snapshot
+        
+        if previous is not None and previous[1] == changes and class_id in self._stored_snapshots:
+            self._snapshot_touches[class_id] = snapshot[0]
+            if self._touches_since is None:
+                self._touches_since = snapshot[0]
+            elif snapshot[0] - self._touches_since >= self.SNAPSHOT_FLUSH_SECONDS:
+                self._flush_snapshot_times()
+            return snapshot
+        
+        self._snapshot_touches.pop(class_id, None)
+        try:
+            self.db.save_live_snapshot(class_id, snapshot[0], [change.to_dict() for change in changes])
+            self._stored_snapshots[class_id] = snapshot[0]
+        except Exception as e:
+            self._stored_snapshots.pop(class_id, None)
+            logger.warning(f"Could not store the snapshot of class {class_id}: {e}")
+        return snapshot
+    
+    def _flush_snapshot_times(self):
+        """Store the fetch times of unchanged snapshots in one transaction."""
+        touches, self._snapshot_touches = self._snapshot_touches, {}
+        self._touches_since = None
+        updates = [(class_id, self._stored_snapshots[class_id], fetched_at)
+                   for class_id, fetched_at in touches.items() if class_id in self._stored_snapshots]
+        if not updates:
+            return
+        try:
+            replaced = set(self.db.touch_live_snapshots(updates))
+        except Exception as e:
+            logger.warning(f"Could not store the fetch times of {len(updates)} snapshots: {e}")
+            return
+        for class_id, _, fetched_at in updates:
+            if class_id in replaced:
+                # Another process stored different changes: write ours in full next time
+                self._stored_snapshots.pop(class_id, None)
+            else:
+                self._stored_snapshots[class_id] = fetched_at
+    
+    @staticmethod
+    def _class_phase(class_id: str) -> int:
+        """Stable per-class hash (the builtin hash() is randomized per process)."""
+        return zlib.crc32(class_id.encode('utf-8'))
+    
+    # School runs Sunday to Friday (Python weekdays: Monday=0 ... Sunday=6)
+    SCHOOL_DAYS = (6, 0, 1, 2, 3, 4)
+    SCHOOL_START_HOUR = 8
+    
+    def _in_pre_school_window(self, now: Optional[datetime] = None) -> bool:
+        """Check if we are within pre_school_boost_hours of the next school day's start."""
+        now = now or datetime.now(ZoneInfo(SCHOOL_TIMEZONE))
+        start = now.replace(hour=self.SCHOOL_START_HOUR, minute=0, second=0, microsecond=0)
+        if start <= now:
+            start += timedelta(days=1)
+        while start.weekday() not in self.SCHOOL_DAYS:
+            start += timedelta(days=1)
+        return start - now <= timedelta(hours=self.pre_school_boost_hours)
+    
+    def _prioritize_classes(self, subscriber_counts: Dict[str, int]) -> List[str]:
+        """
+        Order classes so those serving the most users are checked first.
+        
+        Priority is the subscriber count (multiplied by pre_school_boost in the
+        hours before the next school day, when changes matter most) plus a
+        staleness term that grows with the time since the class was last checked,
+        so small classes are not starved when cycles run long.
+        
+        Returns: Class IDs, highest priority first.
+        """
+        now = time.time()
+        boost = self.pre_school_boost if self._in_pre_school_window() else 1.0
+        
+        heap = []
+        for class_id, subscribers in subscriber_counts.items():
+            last_checked = self._last_checked.get(class_id)
+            # Never-checked classes count as two intervals stale
+            staleness = 2.0 if last_checked is None else (now - last_checked) / self.interval_seconds
+            priority = subscribers * boost + staleness * self.staleness_weight
+            # Stable hash as tie-breaker keeps equal classes in a consistent order
+            heapq.heappush(heap, (-priority, self._class_phase(class_id), class_id))
+        
+        return [heapq.heappop(heap)[2] for _ in range(len(heap))]
+    
+    def _class_offsets(self, classes: List[str]) -> List[tuple]:
+        """
+        Assign each class an offset (in seconds) from the start of the cycle.
+        
+        Classes keep the given (priority) order and are spread evenly across the
+        spread window, with a little jitter inside each slot.
+        
+        Returns: List of (offset_seconds, class_id) tuples sorted by offset.
+        """
+        if not classes:
+            return []
+        
+        window = self.interval_seconds * self.spread_fraction
+        slot = window / len(classes)
+        
+        return [
+            (slot * (index + random.uniform(0, self.jitter_fraction)), class_id)
+            for index, class_id in enumerate(classes)
+        ]
     
     def check_all_classes(self):
-        """Check changes for all registered classes."""
+        """
+        Check changes for all registered classes.
+        
+        Checks are staggered across the interval instead of being sent as one
+        burst, giving the school's server a steady, low request rate. Each run
+        is traced and stored in the cycle_traces ring buffer.
+        """
         logger.info("Starting scheduled check for all classes")
+        cycle_start = time.monotonic()
+        
+        with self.profiler.profile('cycle', 'check_all_classes'), \
+                tracing.start_trace('check_all_classes') as trace:
+            trace.attributes.update({'classes_checked': 0, 'new_changes': 0})
+            self._run_cycle(cycle_start, trace)
+        self._flush_snapshot_times()
+        
+        metrics.CYCLE_DURATION_SECONDS.observe(time.monotonic() - cycle_start)
         
         try:
-            # Get all classes that have registered users
-            classes = self.db.get_all_classes()
+            self.db.save_cycle_trace(trace.to_record(), keep=self.trace_buffer_size)
+        except Exception as e:
+            logger.error(f"Failed to store cycle trace: {e}", exc_info=True)
+    
+    def _run_cycle(self, cycle_start: float, trace: tracing.Trace):
+        # Classes whose pages are downloaded and being parsed in the parse
+        # pool, oldest first; at most parse_workers are kept in flight
+        in_flight = deque()
+        try:
+            # Get all classes that have registered users, most important first
+            subscriber_counts = self.db.get_class_subscriber_counts()
+            if self.shard is not None:
+                subscriber_counts = {class_id: count for class_id, count in subscriber_counts.items()
+                                     if self.shard.owns(class_id)}
+            classes = self._prioritize_classes(subscriber_counts)
             
             logger.info(f"Checking {len(classes)} classes")
             
-            for class_id in classes:
-                self.check_changes_for_class(class_id)
+            for offset, class_id in self._class_offsets(classes):
+                # Wait for this class's slot (returns early if we are stopping)
+                delay = cycle_start + offset - time.monotonic()
+                if delay > 0:
+                    if self._stop_event.wait(delay):
+                        logger.info("Stop requested, aborting check cycle")
+                        trace.attributes['aborted'] = True
+                        return
+                else:
+                    metrics.SCHEDULER_LAG_SECONDS.observe(-delay, job='class_slot')
+                
+                # Another shard may have taken the class over since the cycle started
+                if self.shard is not None and not self.shard.owns(class_id):
+                    continue
+                
+                if self.parse_pool is None:
+                    self._finish_class(class_id, None, trace)
+                    continue
+                
+                try:
+                    with tracing.span('fetch_class', class_id=class_id):
+                        in_flight.append(self.scraper.fetch_class(class_id))
+                except CircuitOpenError as e:
+                    logger.warning(f"Skipping class {class_id}: {e}")
+                    continue
+                except BrokenProcessPool as e:
+                    # Check this class without pipelining, on a fresh pool
+                    logger.warning(f"Parse pool broke while fetching class {class_id}: {e}")
+                    self._restore_parse_pool()
+                    self._finish_class(class_id, None, trace)
+                    continue
+                except Exception as e:
+                    logger.error(f"Error checking changes for class {class_id}: {e}", exc_info=True)
+                    continue
+                while in_flight and (len(in_flight) > self.parse_workers or in_flight[0].done()):
+                    pages = in_flight.popleft()
+                    self._finish_class(pages.class_id, pages, trace)
+            
+            while in_flight:
+                pages = in_flight.popleft()
+                self._finish_class(pages.class_id, pages, trace)
         
         except Exception as e:
             logger.error(f"Error in scheduled check: {e}", exc_info=True)
     
+    def _finish_class(self, class_id: str, pages: Optional[PendingClass], trace: tracing.Trace):
+        trace.attributes['new_changes'] += self.check_changes_for_class(class_id, pages)
+        trace.attributes['classes_checked'] += 1
+    
     def start(self, interval_minutes: int = 20):
         """
         Start the background scheduler.
@@ -104,29 +571,122 @@ class ScheduleMonitor:
         Args:
             interval_minutes: How often to check for changes (default: 20 minutes)
         """
-        # Add job to check every interval_minutes
+        self.interval_seconds = interval_minutes * 60
+        self._stop_event.clear()
+        
+        # Run once immediately on startup. Shards started together first wait
+        # for a heartbeat round so they all see each other before splitting classes
+        first_run = datetime.now()
+        if self.shard is not None:
+            first_run += timedelta(seconds=self.shard.heartbeat_seconds * 1.5)
+        
+        # Add job to check every interval_minutes. All cycles (the first one
+        # and run_now() too) are runs of this one job, so they never overlap
         self.scheduler.add_job(
             func=self.check_all_classes,
             trigger=IntervalTrigger(minutes=interval_minutes),
             id='check_schedule_changes',
             name='Check schedule changes',
+            next_run_time=first_run,
+            max_instances=1,
             replace_existing=True
         )
         
-        # Run once immediately on startup
+        # Retention and vacuuming run once a night, outside school hours
         self.scheduler.add_job(
-            func=self.check_all_classes,
-            trigger='date',
-            id='initial_check',
-            name='Initial check on startup'
+            func=self._scheduled_maintenance,
+            trigger=CronTrigger(hour=self.maintenance_hour, timezone=SCHOOL_TIMEZONE),
+            id='database_maintenance',
+            name='Database maintenance',
+            replace_existing=True
         )
         
+        if self.shard is not None:
+            self._shard_heartbeat()
+            self.scheduler.add_job(
+                func=self._shard_heartbeat,
+                trigger=IntervalTrigger(seconds=self.shard.heartbeat_seconds),
+                id='shard_heartbeat',
+                name='Shard heartbeat',
+                replace_existing=True
+            )
+        
+        self.scheduler.add_listener(self._on_job_submitted, EVENT_JOB_SUBMITTED)
         self.scheduler.start()
         logger.info(f"Scheduler started - checking every {interval_minutes} minutes")
     
+    def _shard_heartbeat(self):
+        """Keep this shard alive and follow joins and departures of other shards."""
+        try:
+            changed = self.shard.heartbeat()
+        except Exception as e:
+            logger.error(f"Shard heartbeat failed: {e}", exc_info=True)
+            return
+        
+        if changed:
+            # A class handed to another shard is updated there; if it comes
+            # back, diff against schedule_cache rather than our stale copy
+            for class_id in list(self._schedules):
+                if not self.shard.owns(class_id):
+                    del self._schedules[class_id]
+    
+    def _scheduled_maintenance(self):
+        """Nightly maintenance, run by a single shard when sharded."""
+        if self.shard is not None and not self.shard.owns(MAINTENANCE_KEY):
+            return
+        self.run_maintenance()
+    
+    def run_maintenance(self) -> Dict:
+        """
+        Apply the retention window, reclaim free space and report storage stats.
+        Returns: Dict with removed rows, freed pages and storage stats.
+        """
+        logger.info("Starting database maintenance")
+        result = {}
+        
+        try:
+            result['removed_changes'] = self.db.cleanup_old_changes(
+                days=self.retention_days,
+                archive_path=self.archive_path
+            )
+            result.update(self.db.optimize_storage())
+            if self.snapshots is not None:
+                result['snapshots'] = self.snapshots.prune(self.retention_days)
+        except Exception as e:
+            logger.error(f"Error in database maintenance: {e}", exc_info=True)
+            result['error'] = str(e)
+        
+        stats = self.db.get_storage_stats()
+        metrics.DB_SIZE_BYTES.set(stats['size_bytes'])
+        for table, count in stats['rows'].items():
+            metrics.DB_ROWS.set(count, table=table)
+        result['stats'] = stats
+        
+        logger.info(f"Database maintenance done: {result}")
+        return result
+    
+    def run_now(self):
+        """
+        Schedule an immediate check cycle in the background.
+        It is skipped if a cycle is already running.
+        """
+        self.scheduler.modify_job('check_schedule_changes', next_run_time=datetime.now())
+    
+    def _on_job_submitted(self, event):
+        """Record how late APScheduler submitted a job relative to its run time."""
+        if event.scheduled_run_times:
+            scheduled = event.scheduled_run_times[-1]
+            lag = (datetime.now(scheduled.tzinfo) - scheduled).total_seconds()
+            metrics.SCHEDULER_LAG_SECONDS.observe(max(lag, 0.0), job=event.job_id)
+    
     def stop(self):
         """Stop the background scheduler."""
+        self._stop_event.set()
         self.scheduler.shutdown()
+        if self.shard is not None:
+            self.shard.leave()
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown(cancel_futures=True)
         logger.info("Scheduler stopped")
 
 
@@ -5,14 +5,70 @@ Handles ASP.NET postback mechanism to extract schedule and changes data.
 
 import requests
 from bs4 import BeautifulSoup
+import functools
+import logging
 import re
-from typing import Dict, List, Optional, Tuple
+import sys
+import threading
+import time
+from concurrent.futures import Executor, Future
+from html import unescape
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 from dataclasses import dataclass
-from datetime import datetime
 
+import metrics
+import tracing
+from snapshots import SnapshotStore
+from circuit_breaker import CircuitBreaker
+from matching import day_name
+from normalize import (LESSON_NUMBER_PATTERN, NEW_ROOM_PATTERN, ROOM_INFO_PATTERN,
+                       normalize_subject, normalize_teacher, teachers_match)
 
-@dataclass
-class ScheduleLesson:
+
+logger = logging.getLogger(__name__)
+
+
+def _synchronized(func):
+    """
+    Serialize calls on a scraper instance.
+    Each request depends on the viewstate returned by the previous one, so
+    concurrent scrapes on the same session would corrupt each other.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+# Records are slotted and their repeated strings (days, teachers, subjects,
+# rooms) are interned, so thousands of cached records share one copy of each.
+_intern = sys.intern
+
+
+class _RecordAccess:
+    """
+    Read-only dict-style access for the slotted records (record['teacher'],
+    record.get('room')), so they can be passed to the database and notifier
+    without conversion.
+    """
+    __slots__ = ()
+    
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+    
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+    
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+@dataclass(slots=True)
+class ScheduleLesson(_RecordAccess):
     """Represents a single lesson in the schedule."""
     day: str
     lesson_number: int
@@ -22,8 +78,8 @@ class ScheduleLesson:
     group: str = ""
 
 
-@dataclass
-class ScheduleChange:
+@dataclass(slots=True)
+class ScheduleChange(_RecordAccess):
     """Represents a schedule change (cancellation or room change)."""
     date: str
     lesson_number: int
@@ -34,12 +90,351 @@ class ScheduleChange:
     new_room: Optional[str] = None
 
 
+class AsyncPostbackError(Exception):
+    """Raised when an async (UpdatePanel) postback response cannot be used."""
+
+
+def parse_delta_response(text: str) -> List[Tuple[str, str, str]]:
+    """
+    Parse an MS AJAX async postback response.
+    The body is a sequence of 'length|type|id|content|' records, where length
+    is the number of characters in content.
+    Returns: List of (type, id, content) tuples.
+    """
+    records = []
+    pos = 0
+    try:
+        while pos < len(text):
+            length_end = text.index('|', pos)
+            length = int(text[pos:length_end])
+            type_end = text.index('|', length_end + 1)
+            id_end = text.index('|', type_end + 1)
+            content_end = id_end + 1 + length
+            if text[content_end:content_end + 1] != '|':
+                raise AsyncPostbackError("Delta record length mismatch")
+            records.append((text[length_end + 1:type_end],
+                            text[type_end + 1:id_end],
+                            text[id_end + 1:content_end]))
+            pos = content_end + 1
+    except ValueError as e:
+        raise AsyncPostbackError(f"Malformed delta response: {e}") from e
+    return records
+
+
+# Timetable columns, Sunday to Friday
+DAYS = ('ראשון', 'שני', 'שלישי', 'רביעי', 'חמישי', 'שישי')
+
+# ASP.NET state fields, read from raw pages without building a document tree
+_HIDDEN_FIELD_PATTERN = re.compile(
+    rb'<input\b[^>]*?\bname="(__VIEWSTATE|__VIEWSTATEGENERATOR|__EVENTVALIDATION)"[^>]*>')
+_VALUE_PATTERN = re.compile(rb'\bvalue="([^"]*)"')
+
+
+def extract_hidden_fields(content: bytes) -> Dict[str, str]:
+    """Get the ASP.NET state fields (__VIEWSTATE, ...) present in a page."""
+    fields = {}
+    for match in _HIDDEN_FIELD_PATTERN.finditer(content):
+        value = _VALUE_PATTERN.search(match.group(0))
+        if value:
+            fields[match.group(1).decode('ascii')] = unescape(value.group(1).decode('utf-8'))
+    return fields
+
+
+# Page parsers. With a parse pool these run in worker processes, so they take
+# raw page bytes and return plain tuples of ScheduleLesson / ScheduleChange
+# fields, which are cheap to send back. They must not touch metrics or
+# logging (the workers are forked and don't share their locks).
+
+def parse_timetable(content: bytes, snapshot: bool = False) -> Tuple[List[tuple], Optional[str]]:
+    """
+    Parse the TTTable of a timetable page (or UpdatePanel).
+    snapshot: Also return the table's HTML, for the snapshot store
+    Returns: Tuple of (lesson field tuples, table HTML or None).
+    """
+    soup = BeautifulSoup(content, 'html.parser')
+
+    # Find the schedule table (TTTable class)
+    table = soup.find('table', class_='TTTable')
+    if not table:
+        return [], None
+
+    lessons = []
+
+    # Iterate through rows (lessons)
+    rows = table.find_all('tr')[1:]  # Skip header row
+
+    for lesson_num, row in enumerate(rows, start=1):
+        cells = row.find_all('td', class_='TTCell')
+
+        for day_idx, cell in enumerate(cells):
+            if day_idx >= len(DAYS):
+                break
+
+            # Find all lessons in this cell (can have multiple)
+            lesson_divs = cell.find_all('div', class_='TTLesson')
+
+            for lesson_div in lesson_divs:
+                # Extract subject (in <b> tag)
+                subject_tag = lesson_div.find('b')
+                if not subject_tag:
+                    continue
+
+                subject_text = subject_tag.text.strip()
+
+                # Extract room/group info (in parentheses)
+                room = ""
+                group = ""
+                room_match = ROOM_INFO_PATTERN.search(subject_text)
+                if room_match:
+                    room_info = room_match.group(1)
+                    if 'קבוצה' in room_info:
+                        group = room_info
+                    else:
+                        room = room_info
+                    subject_text = subject_text[:room_match.start()].strip()
+
+                # Extract teacher (after <br>)
+                teacher = ""
+                br_tag = lesson_div.find('br')
+                if br_tag and br_tag.next_sibling:
+                    teacher = br_tag.next_sibling.strip()
+
+                if subject_text and teacher:
+                    lessons.append((DAYS[day_idx], lesson_num, subject_text, teacher, room, group))
+
+    return lessons, str(table) if snapshot else None
+
+
+def parse_changes(content: bytes, lesson_map: Dict[Tuple[str, int, str], str], snapshot: bool = False,
+                  observe: Optional[Callable[[float], None]] = None) -> Tuple[List[tuple], Optional[str]]:
+    """
+    Parse the MsgCell rows of a changes page (or UpdatePanel).
+    lesson_map: (day, lesson_number, teacher) -> subject, used to resolve each change's subject
+    snapshot: Also return the rows' HTML, for the snapshot store
+    observe: Optional callback given the time spent on each change text
+    Returns: Tuple of (change field tuples, rows HTML or None).
+    """
+    soup = BeautifulSoup(content, 'html.parser')
+
+    # Find all change cells (MsgCell class)
+    change_cells = soup.find_all('td', class_='MsgCell')
+
+    changes = []
+    for cell in change_cells:
+        text = cell.get_text(strip=True)
+        if not text:
+            continue
+
+        # Format: "DD.MM.YYYY, שיעור N, Teacher Name, Description"
+        start = time.perf_counter()
+        change = parse_change_text(text, lesson_map)
+        if observe is not None:
+            observe(time.perf_counter() - start)
+        if change:
+            changes.append(change)
+
+    html = None
+    if snapshot:
+        html = '<table>' + ''.join(f'<tr>{cell}</tr>' for cell in change_cells) + '</table>'
+    return changes, html
+
+
+def lesson_map_for(lessons: Iterable) -> Dict[Tuple[str, int, str], str]:
+    """Map a timetable's (day, lesson_number, teacher) slots to their subjects."""
+    return {(lesson[0], lesson[1], lesson[3]): lesson[2] for lesson in lessons}
+
+
+def parse_change_text(text: str, lesson_map: Dict[Tuple[str, int, str], str]) -> Optional[tuple]:
+    """Parse a change text string into a tuple of ScheduleChange fields."""
+    # Split by comma
+    parts = [p.strip() for p in text.split(',')]
+
+    if len(parts) < 4:
+        return None
+
+    # Extract date
+    date = parts[0]
+
+    # Extract lesson number
+    lesson_match = LESSON_NUMBER_PATTERN.search(parts[1])
+    if not lesson_match:
+        return None
+    lesson_number = int(lesson_match.group(1))
+
+    # Teacher name
+    teacher = parts[2]
+
+    # Description and change type
+    description = ', '.join(parts[3:])
+
+    change_type = 'cancellation'
+    new_room = None
+
+    if 'החלפת חדר' in text:
+        change_type = 'room_change'
+
+        # If "החלפת חדר" is in the teacher part, clean it
+        if 'החלפת חדר' in teacher:
+            teacher = teacher.replace('החלפת חדר לקבוצה', '').strip()
+            # Also remove leading " - " if present
+            if teacher.startswith('-'):
+                teacher = teacher[1:].strip()
+
+        # Extract new room number from description or full text
+        room_match = NEW_ROOM_PATTERN.search(text)
+        if room_match:
+            new_room = room_match.group(1)
+
+        # Clean description
+        description = description.replace('החלפת חדר', '').replace('לקבוצה', '').strip()
+        if description.startswith(teacher):
+             description = description[len(teacher):].strip()
+
+    elif 'ביטול' in description or 'ביטול' in text:
+        change_type = 'cancellation'
+
+    # Lookup subject from lesson map - try exact match first
+    day = day_name(date)
+    subject = lesson_map.get((day, lesson_number, teacher))
+
+    if not subject:
+        teacher_key = normalize_teacher(teacher)
+
+        # If no exact match, try fuzzy matching on teacher name in the same slot
+        for (l_day, l_num, l_teacher), l_subject in lesson_map.items():
+            if (l_day == day and l_num == lesson_number
+                    and teachers_match(teacher_key, normalize_teacher(l_teacher))):
+                subject = l_subject
+                break
+
+        # If still no match (substitute lessons or changes to lessons not in the
+        # regular schedule), use the teacher's subject - but only if they teach
+        # just one, otherwise any pick could be the wrong lesson
+        if not subject:
+            subjects = {l_subject for (_, _, l_teacher), l_subject in lesson_map.items()
+                        if teachers_match(teacher_key, normalize_teacher(l_teacher))}
+            if len(subjects) == 1:
+                subject = subjects.pop()
+
+    # Default to 'Unknown' if still not found
+    if not subject:
+        subject = 'Unknown'
+
+    return (date, lesson_number, teacher, subject, change_type, description, new_room)
+
+
+def parse_class_pages(timetable: bytes, changes: bytes,
+                      snapshot: bool = False) -> Tuple[List[tuple], Optional[str], List[tuple], Optional[str]]:
+    """
+    Parse a class's timetable and changes pages in one go, resolving the
+    changes against the timetable.
+    Returns: Tuple of (lessons, timetable HTML, changes, changes HTML), as
+             returned by parse_timetable() and parse_changes().
+    """
+    lessons, timetable_html = parse_timetable(timetable, snapshot)
+    lesson_map = lesson_map_for(lessons)
+    change_records, changes_html = parse_changes(changes, lesson_map, snapshot)
+    return lessons, timetable_html, change_records, changes_html
+
+
+def unique_subjects(lessons: Iterable) -> Dict[str, List[str]]:
+    """
+    Group a timetable's teachers by base subject name (e.g., ספרות 30, ספרות 70 → ספרות).
+    lessons: ScheduleLesson records or schedule_cache rows
+    Returns: Dict mapping subject names to list of teacher names.
+    """
+    # First, collect all subject-teacher pairs
+    subject_teacher_pairs = {}
+    for lesson in lessons:
+        # Normalize subject name for grouping (cached per distinct name)
+        base_subject = normalize_subject(lesson['subject'])
+
+        if base_subject not in subject_teacher_pairs:
+            subject_teacher_pairs[base_subject] = set()
+
+        if lesson['teacher']:
+            subject_teacher_pairs[base_subject].add(lesson['teacher'])
+
+    # Convert sets to lists
+    return {subject: list(teachers) for subject, teachers in subject_teacher_pairs.items()}
+
+
+def _lesson_record(fields: tuple) -> ScheduleLesson:
+    day, lesson_number, subject, teacher, room, group = fields
+    return ScheduleLesson(_intern(day), lesson_number, _intern(subject), _intern(teacher),
+                          _intern(room), _intern(group))
+
+
+def _change_record(fields: tuple) -> ScheduleChange:
+    date, lesson_number, teacher, subject, change_type, description, new_room = fields
+    return ScheduleChange(_intern(date), lesson_number, _intern(teacher), _intern(subject),
+                          _intern(change_type), description,
+                          _intern(new_room) if new_room else new_room)
+
+
+class PendingClass:
+    """A class's downloaded pages while they are parsed (see BeginHSScraper.fetch_class)."""
+
+    def __init__(self, scraper: 'BeginHSScraper', class_id: str, future: Future):
+        self.class_id = class_id
+        self._scraper = scraper
+        self._future = future
+        self._result = None
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def result(self) -> Tuple[List[ScheduleLesson], List[ScheduleChange]]:
+        """
+        Wait for the parse to finish.
+        Returns: Tuple of (schedule, changes), as get_schedule() and get_changes() return them.
+        """
+        if self._result is None:
+            lessons, timetable_html, changes, changes_html = self._future.result()
+            if timetable_html is not None:
+                self._scraper._save_snapshot(self.class_id, 'timetable', timetable_html)
+            if changes_html is not None:
+                self._scraper._save_snapshot(self.class_id, 'changes', changes_html)
+            self._result = ([_lesson_record(fields) for fields in lessons],
+                            [_change_record(fields) for fields in changes])
+        return self._result
+
+
 class BeginHSScraper:
     """Scraper for Begin High School schedule website."""
     
     BASE_URL = "https://beginhs.iscool.co.il/Default.aspx?TabId=4645&language=he-IL"
     
-    def __init__(self):
+    # Patterns for the PageRequestManager setup script on pages with UpdatePanels.
+    # ASP.NET 4 passes the panels to _initialize as [flag+uniqueID, clientID, ...];
+    # older versions pass [flag+uniqueID, ...] to a separate _updateControls call.
+    _SCRIPT_MANAGER_PATTERN = re.compile(
+        r"PageRequestManager\._initialize\('([^']+)',\s*'[^']*'(?:,\s*\[([^\]]*)\])?")
+    _UPDATE_CONTROLS_PATTERN = re.compile(r"_updateControls\(\[([^\]]*)\]")
+    
+    def __init__(self, async_postback: bool = True, base_url: Optional[str] = None,
+                 snapshots: Optional[SnapshotStore] = None, parse_pool: Optional[Executor] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        Args:
+            async_postback: Use MS AJAX partial postbacks when the page supports
+                            them, so only the TimeTableView panel is downloaded.
+                            Falls back to full postbacks automatically.
+            base_url: Page to scrape instead of BASE_URL (e.g. a local stand-in
+                      server for load testing)
+            snapshots: Optional store that keeps every distinct timetable and
+                       changes table scraped, for debugging and replay
+            parse_pool: Optional executor (e.g. a ProcessPoolExecutor) the
+                        timetable and changes pages are parsed in. Requests and
+                        viewstate handling stay in the calling process.
+            breaker: Optional circuit breaker all requests go through (may be
+                     shared between scrapers); while it is open requests
+                     raise CircuitOpenError without being sent
+        """
+        self.base_url = base_url or self.BASE_URL
+        self.snapshots = snapshots
+        self.parse_pool = parse_pool
+        self.breaker = breaker
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -57,23 +452,115 @@ class BeginHSScraper:
         self.viewstate = None
         self.viewstate_generator = None
         self.event_validation = None
+        self._lock = threading.RLock()
+        
+        # Async postback setup, discovered from the initial page
+        self.async_postback = async_postback
+        self._script_manager = None
+        self._update_panel = None
+    
+    def _request(self, method: str, target: str, **kwargs) -> requests.Response:
+        """Send a request to the school website, through the circuit breaker if there is one."""
+        if self.breaker is None:
+            return self._send(method, target, **kwargs)
+        return self.breaker.call(lambda: self._send(method, target, **kwargs),
+                                 is_failure=lambda response: response.status_code >= 500)
     
-    def _get_initial_page(self) -> BeautifulSoup:
+    def _send(self, method: str, target: str, **kwargs) -> requests.Response:
+        """Send a request to the school website, timing it by postback target."""
+        with tracing.span('upstream', target=target), \
+                metrics.UPSTREAM_REQUEST_SECONDS.time(target=target):
+            return self.session.request(method, self.base_url, timeout=30, **kwargs)
+    
+    def _parse_html(self, content: bytes, page: str) -> BeautifulSoup:
+        """Parse an HTML response into a BeautifulSoup tree."""
+        with tracing.span('parse_html', page=page), \
+                metrics.HTML_PARSE_SECONDS.time(page=page):
+            return BeautifulSoup(content, 'html.parser')
+    
+    def _submit_parse(self, page: str, parser: Callable, *args) -> Future:
+        """
+        Run a page parser, in the parse pool if there is one.
+        Returns: Future of the parser's result (already done without a pool).
+        """
+        if self.parse_pool is None:
+            future = Future()
+            with tracing.span('parse_html', page=page), \
+                    metrics.HTML_PARSE_SECONDS.time(page=page):
+                future.set_result(parser(*args))
+            return future
+        
+        # Timed from submission, so the wait for a free worker is included
+        start = time.perf_counter()
+        future = self.parse_pool.submit(parser, *args)
+        future.add_done_callback(lambda _: metrics.HTML_PARSE_SECONDS.observe(
+            time.perf_counter() - start, page=page))
+        return future
+    
+    def _update_state(self, content: bytes):
+        """Update ASP.NET state variables from a raw page."""
+        fields = extract_hidden_fields(content)
+        if '__VIEWSTATE' in fields:
+            self.viewstate = fields['__VIEWSTATE']
+        if '__VIEWSTATEGENERATOR' in fields:
+            self.viewstate_generator = fields['__VIEWSTATEGENERATOR']
+        if '__EVENTVALIDATION' in fields:
+            self.event_validation = fields['__EVENTVALIDATION']
+    
+    def _discover_async_panel(self, html: str):
+        """Find the ScriptManager and the TimeTableView UpdatePanel, if the page has them."""
+        manager_match = self._SCRIPT_MANAGER_PATTERN.search(html)
+        if not manager_match:
+            logger.info("No ScriptManager found, using full postbacks")
+            self.async_postback = False
+            return
+        
+        entries = []
+        step = 1
+        if manager_match.group(2):
+            entries = manager_match.group(2).split(',')
+            step = 2  # Skip the client IDs
+        else:
+            controls_match = self._UPDATE_CONTROLS_PATTERN.search(html)
+            if controls_match:
+                entries = controls_match.group(1).split(',')
+        
+        # Entries look like 'tdnn$ctr16506$TimeTableView$UpdatePanel1' (the
+        # first character is the ChildrenAsTriggers flag)
+        entries = [entry.strip().strip('\'"') for entry in entries]
+        panels = [entry[1:] for entry in entries[::step] if entry]
+        panel = next((p for p in panels if 'TimeTableView' in p), None)
+        if not panel:
+            logger.info("No TimeTableView UpdatePanel found, using full postbacks")
+            self.async_postback = False
+            return
+        
+        self._script_manager = manager_match.group(1)
+        self._update_panel = panel
+    
+    def _get_initial_page(self) -> bytes:
         """Load the initial page and extract ASP.NET state variables."""
-        response = self.session.get(self.BASE_URL, timeout=30)
-        soup = BeautifulSoup(response.content, 'html.parser')
+        response = self._request('GET', 'initial')
+        metrics.UPSTREAM_RESPONSE_BYTES.inc(len(response.content), target='initial', mode='full')
+        
+        if self.async_postback and self._update_panel is None:
+            self._discover_async_panel(response.text)
         
         # Extract ASP.NET state variables
-        self.viewstate = soup.find('input', {'name': '__VIEWSTATE'})['value']
-        self.viewstate_generator = soup.find('input', {'name': '__VIEWSTATEGENERATOR'})['value']
-        event_val = soup.find('input', {'name': '__EVENTVALIDATION'})
-        if event_val:
-            self.event_validation = event_val['value']
+        fields = extract_hidden_fields(response.content)
+        self.viewstate = fields['__VIEWSTATE']
+        self.viewstate_generator = fields['__VIEWSTATEGENERATOR']
+        if '__EVENTVALIDATION' in fields:
+            self.event_validation = fields['__EVENTVALIDATION']
         
-        return soup
+        return response.content
     
-    def _do_postback(self, event_target: str, event_argument: str = '') -> BeautifulSoup:
-        """Perform an ASP.NET postback."""
+    def _do_postback(self, event_target: str, event_argument: str = '',
+                     extra_fields: Optional[Dict[str, str]] = None) -> bytes:
+        """
+        Perform an ASP.NET postback.
+        Returns: The raw page, or the UpdatePanel's HTML for async postbacks.
+        """
         data = {
             '__EVENTTARGET': event_target,
             '__EVENTARGUMENT': event_argument,
@@ -84,30 +571,86 @@ class BeginHSScraper:
         if self.event_validation:
             data['__EVENTVALIDATION'] = self.event_validation
         
-        response = self.session.post(self.BASE_URL, data=data, timeout=30)
-        soup = BeautifulSoup(response.content, 'html.parser')
+        if extra_fields:
+            data.update(extra_fields)
+        
+        # Label timings by the control name, e.g. 'btnChanges'
+        target = event_target.rsplit('$', 1)[-1]
+        
+        if self.async_postback and self._update_panel:
+            try:
+                return self._do_async_postback(target, data)
+            except AsyncPostbackError as e:
+                logger.warning(f"Async postback failed, falling back to full postbacks: {e}")
+                self.async_postback = False
+            except requests.HTTPError as e:
+                # A client error means the site rejects async postbacks
+                if e.response is not None and 400 <= e.response.status_code < 500:
+                    logger.warning(f"Async postback rejected, falling back to full postbacks: {e}")
+                    self.async_postback = False
+                else:
+                    logger.warning(f"Async postback failed, retrying as a full postback: {e}")
+            except requests.RequestException as e:
+                # Timeouts and dropped connections say nothing about async
+                # support; only this request is retried as a full postback
+                logger.warning(f"Async postback failed, retrying as a full postback: {e}")
+        
+        response = self._request('POST', target, data=data)
+        metrics.UPSTREAM_RESPONSE_BYTES.inc(len(response.content), target=target, mode='full')
         
         # Update state variables
-        viewstate_input = soup.find('input', {'name': '__VIEWSTATE'})
-        if viewstate_input:
-            self.viewstate = viewstate_input['value']
-        
-        viewstate_gen = soup.find('input', {'name': '__VIEWSTATEGENERATOR'})
-        if viewstate_gen:
-            self.viewstate_generator = viewstate_gen['value']
+        self._update_state(response.content)
         
-        event_val = soup.find('input', {'name': '__EVENTVALIDATION'})
-        if event_val:
-            self.event_validation = event_val['value']
+        return response.content
+    
+    def _do_async_postback(self, target: str, data: Dict[str, str]) -> bytes:
+        """
+        Perform a partial (UpdatePanel) postback.
+        Only the panel's HTML and the updated hidden fields are downloaded.
+        Returns: The panel content.
+        """
+        async_data = dict(data)
+        async_data[self._script_manager] = f"{self._update_panel}|{data['__EVENTTARGET']}"
+        async_data['__ASYNCPOST'] = 'true'
         
-        return soup
+        response = self._request('POST', target, data=async_data, headers={
+            'X-MicrosoftAjax': 'Delta=true',
+            'X-Requested-With': 'XMLHttpRequest',
+        })
+        metrics.UPSTREAM_RESPONSE_BYTES.inc(len(response.content), target=target, mode='async')
+        response.raise_for_status()
+        
+        records = parse_delta_response(response.text)
+        
+        panels = []
+        hidden_fields = {}
+        for record_type, record_id, content in records:
+            if record_type == 'updatePanel':
+                panels.append(content)
+            elif record_type == 'hiddenField':
+                hidden_fields[record_id] = content
+            elif record_type in ('error', 'pageRedirect'):
+                raise AsyncPostbackError(f"Server returned {record_type}: {content[:200]}")
+        
+        if not panels:
+            raise AsyncPostbackError("Delta response contained no UpdatePanel content")
+        
+        if '__VIEWSTATE' in hidden_fields:
+            self.viewstate = hidden_fields['__VIEWSTATE']
+        if '__VIEWSTATEGENERATOR' in hidden_fields:
+            self.viewstate_generator = hidden_fields['__VIEWSTATEGENERATOR']
+        if '__EVENTVALIDATION' in hidden_fields:
+            self.event_validation = hidden_fields['__EVENTVALIDATION']
+        
+        return ''.join(panels).encode('utf-8')
     
+    @_synchronized
     def get_class_list(self) -> Dict[str, str]:
         """
         Get list of all available classes.
         Returns: Dict mapping class names to their internal IDs.
         """
-        soup = self._get_initial_page()
+        soup = self._parse_html(self._get_initial_page(), 'initial')
         
         # Find the class dropdown
         class_select = soup.find('select', {'name': re.compile(r'.*ClassesList.*')})
@@ -122,275 +665,103 @@ class BeginHSScraper:
         
         return classes
     
-    def _select_class(self, class_id: str) -> BeautifulSoup:
+    def _select_class(self, class_id: str):
         """Select a specific class."""
         # First load the page
-        soup = self._get_initial_page()
+        self._get_initial_page()
         
         # Do a postback with the selected class value
-        data = {
-            '__EVENTTARGET': 'dnn$ctr16506$TimeTableView$ClassesList',
-            '__EVENTARGUMENT': '',
-            '__VIEWSTATE': self.viewstate,
-            '__VIEWSTATEGENERATOR': self.viewstate_generator,
-            'dnn$ctr16506$TimeTableView$ClassesList': class_id,
-        }
-        
-        if self.event_validation:
-            data['__EVENTVALIDATION'] = self.event_validation
-        
-        response = self.session.post(self.BASE_URL, data=data, timeout=30)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Update state variables after class selection
-        viewstate_input = soup.find('input', {'name': '__VIEWSTATE'})
-        if viewstate_input:
-            self.viewstate = viewstate_input['value']
-        
-        viewstate_gen = soup.find('input', {'name': '__VIEWSTATEGENERATOR'})
-        if viewstate_gen:
-            self.viewstate_generator = viewstate_gen['value']
-        
-        event_val = soup.find('input', {'name': '__EVENTVALIDATION'})
-        if event_val:
-            self.event_validation = event_val['value']
-        
-        return soup
+        self._do_postback(
+            'dnn$ctr16506$TimeTableView$ClassesList',
+            extra_fields={'dnn$ctr16506$TimeTableView$ClassesList': class_id}
+        )
+    
+    def _get_tab(self, class_id: str, button: str) -> bytes:
+        """Select a class and open one of its tabs (btnTimeTable or btnChanges)."""
+        self._select_class(class_id)
+        return self._do_postback(f'dnn$ctr16506$TimeTableView${button}', '')
     
+    @_synchronized
     def get_schedule(self, class_id: str) -> List[ScheduleLesson]:
         """
         Get the weekly schedule for a specific class.
         Returns: List of ScheduleLesson objects.
         """
-        # Select the class first
-        self._select_class(class_id)
+        # Select the class, then click on the schedule tab (מערכת שעות)
+        content = self._get_tab(class_id, 'btnTimeTable')
+        
+        lessons, html = self._submit_parse('timetable', parse_timetable, content,
+                                           self.snapshots is not None).result()
+        if html is not None:
+            self._save_snapshot(class_id, 'timetable', html)
         
-        # Now click on the schedule tab (מערכת שעות)
-        soup = self._do_postback('dnn$ctr16506$TimeTableView$btnTimeTable', '')
-        
-        # Parse the schedule table
-        lessons = []
-        
-        # Find the schedule table (TTTable class)
-        table = soup.find('table', class_='TTTable')
-        if not table:
-            return lessons
-        
-        # Days of the week (columns)
-        days = ['ראשון', 'שני', 'שלישי', 'רביעי', 'חמישי', 'שישי']
-        
-        # Iterate through rows (lessons)
-        rows = table.find_all('tr')[1:]  # Skip header row
-        
-        for lesson_num, row in enumerate(rows, start=1):
-            cells = row.find_all('td', class_='TTCell')
-            
-            for day_idx, cell in enumerate(cells):
-                if day_idx >= len(days):
-                    break
-                
-                # Find all lessons in this cell (can have multiple)
-                lesson_divs = cell.find_all('div', class_='TTLesson')
-                
-                for lesson_div in lesson_divs:
-                    # Extract subject (in <b> tag)
-                    subject_tag = lesson_div.find('b')
-                    if not subject_tag:
-                        continue
-                    
-                    subject_text = subject_tag.text.strip()
-                    
-                    # Extract room/group info (in parentheses)
-                    room = ""
-                    group = ""
-                    room_match = re.search(r'\(([^)]+)\)', subject_text)
-                    if room_match:
-                        room_info = room_match.group(1)
-                        if 'קבוצה' in room_info:
-                            group = room_info
-                        else:
-                            room = room_info
-                        subject_text = subject_text[:room_match.start()].strip()
-                    
-                    # Extract teacher (after <br>)
-                    teacher = ""
-                    br_tag = lesson_div.find('br')
-                    if br_tag and br_tag.next_sibling:
-                        teacher = br_tag.next_sibling.strip()
-                    
-                    if subject_text and teacher:
-                        lessons.append(ScheduleLesson(
-                            day=days[day_idx],
-                            lesson_number=lesson_num,
-                            subject=subject_text,
-                            teacher=teacher,
-                            room=room,
-                            group=group
-                        ))
-        
-        return lessons
+        return [_lesson_record(fields) for fields in lessons]
     
-    def get_changes(self, class_id: str) -> List[ScheduleChange]:
+    @_synchronized
+    def get_changes(self, class_id: str,
+                    schedule: Optional[List[ScheduleLesson]] = None) -> List[ScheduleChange]:
         """
         Get current schedule changes for a specific class.
+        schedule: The class's schedule if the caller already has it; fetched otherwise
         Returns: List of ScheduleChange objects.
         """
         # First get the schedule to map lesson numbers to subjects
-        schedule = self.get_schedule(class_id)
+        if schedule is None:
+            schedule = self.get_schedule(class_id)
         
         # Create a mapping of (day, lesson_number, teacher) -> subject
-        lesson_map = {}
-        for lesson in schedule:
-            key = (lesson.lesson_number, lesson.teacher)
-            lesson_map[key] = lesson.subject
-        
-        # Select the class
-        self._select_class(class_id)
+        lesson_map = lesson_map_for(
+            (lesson.day, lesson.lesson_number, lesson.subject, lesson.teacher) for lesson in schedule)
         
-        # Click on the changes tab
-        soup = self._do_postback('dnn$ctr16506$TimeTableView$btnChanges', '')
+        # Select the class, then click on the changes tab
+        content = self._get_tab(class_id, 'btnChanges')
         
-        # Parse the changes
-        changes = []
+        # Per-change timings can only be taken in this process
+        observe = metrics.CHANGE_PARSE_SECONDS.observe if self.parse_pool is None else None
+        changes, html = self._submit_parse('changes', parse_changes, content, lesson_map,
+                                           self.snapshots is not None, observe).result()
+        if html is not None:
+            self._save_snapshot(class_id, 'changes', html)
         
-        # Find all change cells (MsgCell class)
-        change_cells = soup.find_all('td', class_='MsgCell')
-        
-        for cell in change_cells:
-            text = cell.get_text(strip=True)
-            if not text:
-                continue
-            
-            # Parse the change text
-            # Format: "DD.MM.YYYY, שיעור N, Teacher Name, Description"
-            change = self._parse_change_text(text, lesson_map)
-            if change:
-                changes.append(change)
-        
-        return changes
+        return [_change_record(fields) for fields in changes]
+    
+    @_synchronized
+    def fetch_class(self, class_id: str) -> PendingClass:
+        """
+        Download a class's timetable and changes pages and start parsing them.
+        With a parse pool this returns as soon as the pages are downloaded, so
+        the next class can be fetched while this one is parsed.
+        Returns: PendingClass whose result() is (get_schedule(), get_changes()).
+        """
+        timetable = self._get_tab(class_id, 'btnTimeTable')
+        changes = self._get_tab(class_id, 'btnChanges')
+        future = self._submit_parse('class', parse_class_pages, timetable, changes,
+                                    self.snapshots is not None)
+        return PendingClass(self, class_id, future)
+    
+    def _save_snapshot(self, class_id: str, tab: str, html: str):
+        """Store a scraped table in the snapshot store, if one is configured."""
+        if self.snapshots is None:
+            return
+        try:
+            self.snapshots.save(class_id, tab, html)
+        except Exception as e:
+            # Snapshots are a debugging aid and must never fail a scrape
+            logger.warning(f"Could not save {tab} snapshot for class {class_id}: {e}")
     
     def _parse_change_text(self, text: str, lesson_map: Dict) -> Optional[ScheduleChange]:
         """Parse a change text string into a ScheduleChange object."""
-        # Split by comma
-        parts = [p.strip() for p in text.split(',')]
-        
-        if len(parts) < 4:
-            return None
-        
-        # Extract date
-        date = parts[0]
-        
-        # Extract lesson number
-        lesson_match = re.search(r'שיעור\s+(\d+)', parts[1])
-        if not lesson_match:
-            return None
-        lesson_number = int(lesson_match.group(1))
-        
-        # Teacher name
-        teacher = parts[2]
-        
-        # Description and change type
-        description = ', '.join(parts[3:])
-        
-        change_type = 'cancellation'
-        new_room = None
-        
-        if 'החלפת חדר' in text:
-            change_type = 'room_change'
-            
-            # If "החלפת חדר" is in the teacher part, clean it
-            if 'החלפת חדר' in teacher:
-                teacher = teacher.replace('החלפת חדר לקבוצה', '').strip()
-                # Also remove leading " - " if present
-                if teacher.startswith('-'):
-                    teacher = teacher[1:].strip()
-
-            # Extract new room number from description or full text
-            room_match = re.search(r'לחדר\s+(\S+)', text)
-            if room_match:
-                new_room = room_match.group(1)
-            
-            # Clean description
-            description = description.replace('החלפת חדר', '').replace('לקבוצה', '').strip()
-            if description.startswith(teacher):
-                 description = description[len(teacher):].strip()
-            
-        elif 'ביטול' in description or 'ביטול' in text:
-            change_type = 'cancellation'
-        
-        # Lookup subject from lesson map - try exact match first
-        subject = lesson_map.get((lesson_number, teacher))
-        
-        # If no exact match, try fuzzy matching on teacher name for same lesson number
-        if not subject:
-            for (l_num, l_teacher), l_subject in lesson_map.items():
-                if l_num == lesson_number:
-                    teacher_lower = teacher.lower().strip()
-                    l_teacher_lower = l_teacher.lower().strip()
-                    
-                    if (teacher_lower in l_teacher_lower or 
-                        l_teacher_lower in teacher_lower or
-                        teacher_lower.replace(' ', '') == l_teacher_lower.replace(' ', '')):
-                        subject = l_subject
-                        break
-        
-        # If still no match, try to find ANY lesson taught by this teacher
-        # (useful for substitute lessons or changes to lessons not in regular schedule)
-        if not subject:
-            for (l_num, l_teacher), l_subject in lesson_map.items():
-                teacher_lower = teacher.lower().strip()
-                l_teacher_lower = l_teacher.lower().strip()
-                
-                if (teacher_lower in l_teacher_lower or 
-                    l_teacher_lower in teacher_lower or
-                    teacher_lower.replace(' ', '') == l_teacher_lower.replace(' ', '')):
-                    subject = l_subject
-                    break
-        
-        # Default to 'Unknown' if still not found
-        if not subject:
-            subject = 'Unknown'
-        
-        return ScheduleChange(
-            date=date,
-            lesson_number=lesson_number,
-            teacher=teacher,
-            subject=subject,
-            change_type=change_type,
-            description=description,
-            new_room=new_room
-        )
+        fields = parse_change_text(text, lesson_map)
+        return _change_record(fields) if fields else None
     
+    @_synchronized
     def get_unique_subjects(self, class_id: str) -> Dict[str, List[str]]:
         """
         Get unique subjects and their teachers for a class.
         Groups subjects with same base name and teacher (e.g., ספרות 30, ספרות 70 → ספרות)
         Returns: Dict mapping subject names to list of teacher names.
         """
-        lessons = self.get_schedule(class_id)
-        
-        # First, collect all subject-teacher pairs
-        subject_teacher_pairs = {}
-        for lesson in lessons:
-            # Normalize subject name for grouping
-            # 1. Match "Subject X Units" pattern (e.g., "English 5 units COBE" -> "English 5 units")
-            match = re.search(r'^(.+?)\s+(\d+)\s*(?:יח[:\-\'"”]?ל?|יחידות).*$', lesson.subject)
-            if match:
-                base_subject = f"{match.group(1).strip()} {match.group(2)} יח'"
-            else:
-                # 2. Fallback: Remove trailing numbers (e.g., "Sifrut 30" -> "Sifrut")
-                base_subject = re.sub(r'\s*\d+\s*$', '', lesson.subject).strip()
-            
-            if base_subject not in subject_teacher_pairs:
-                subject_teacher_pairs[base_subject] = set()
-            
-            if lesson.teacher:
-                subject_teacher_pairs[base_subject].add(lesson.teacher)
-        
-        # Convert sets to lists
-        subjects = {subject: list(teachers) for subject, teachers in subject_teacher_pairs.items()}
-        
-        return subjects
+        return unique_subjects(self.get_schedule(class_id))
 
 
 # Example usage
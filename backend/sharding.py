@@ -0,0 +1,140 @@
+"""
+Sharded monitoring: several monitor processes split the classes between them.
+Each process registers as a shard in the monitor_shards table and keeps its
+heartbeat fresh; every shard builds the same consistent-hash ring from the
+live shards and only checks the classes it owns. When a shard joins or stops
+heartbeating, the ring changes and only about 1/K of the classes move.
+
+Usage:
+    python sharding.py status --db schedule_notifier.db
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from database import Database
+
+
+logger = logging.getLogger(__name__)
+
+# Key whose owner runs the once-a-night database maintenance
+MAINTENANCE_KEY = '__maintenance__'
+
+
+def _ring_hash(key: str) -> int:
+    # Stable across processes, unlike the builtin hash()
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent-hash ring mapping keys (class IDs) to shard IDs."""
+
+    def __init__(self, members: Iterable[str], replicas: int = 160):
+        """
+        Args:
+            members: Shard IDs
+            replicas: Virtual nodes per shard; more gives a more even split
+        """
+        self.members = sorted(set(members))
+        points = sorted((_ring_hash(f'{member}#{n}'), member)
+                        for member in self.members for n in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._owners = [point[1] for point in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        """Get the shard owning a key, or None if the ring is empty."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _ring_hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+    def assign(self, keys: Iterable[str]) -> Dict[str, List[str]]:
+        """Group keys by their owning shard."""
+        assignment = {member: [] for member in self.members}
+        for key in keys:
+            owner = self.owner(key)
+            if owner is not None:
+                assignment[owner].append(key)
+        return assignment
+
+
+class ShardMembership:
+    """This process's membership in the set of monitor shards."""
+
+    def __init__(self, db: Database, shard_id: Optional[str] = None,
+                 heartbeat_seconds: float = 30.0, ttl_seconds: Optional[float] = None):
+        """
+        Args:
+            db: Database shared by all shards
+            shard_id: Unique name of this shard (default: hostname:pid)
+            heartbeat_seconds: How often heartbeat() should be called
+            ttl_seconds: Shards without a heartbeat for this long are dropped
+                         from the ring (default: three heartbeats)
+        """
+        self.db = db
+        self.shard_id = shard_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.heartbeat_seconds = heartbeat_seconds
+        self.ttl_seconds = ttl_seconds or heartbeat_seconds * 3
+        self._ring = HashRing([self.shard_id])
+        self._lock = threading.Lock()
+
+    def heartbeat(self) -> bool:
+        """
+        Refresh this shard's heartbeat and rebuild the ring from the live shards.
+        Returns: True if the membership changed since the last heartbeat.
+        """
+        self.db.heartbeat_shard(self.shard_id, os.getpid(), socket.gethostname())
+        members = self.db.get_live_shards(self.ttl_seconds)
+        # Our own row may be missing if the heartbeat raced a prune by another shard
+        if self.shard_id not in members:
+            members.append(self.shard_id)
+
+        with self._lock:
+            if sorted(members) == self._ring.members:
+                return False
+            previous = self._ring.members
+            self._ring = HashRing(members)
+        logger.info(f"Shard membership changed: {previous} -> {self._ring.members}")
+        return True
+
+    def owns(self, class_id: str) -> bool:
+        """Check if this shard is responsible for a class."""
+        return self._ring.owner(class_id) == self.shard_id
+
+    def leave(self):
+        """Remove this shard, so the others take over its classes at their next heartbeat."""
+        self.db.remove_shard(self.shard_id)
+
+    def get_status(self, classes: Iterable[str]) -> Dict:
+        """Get the live shards and how many of the given classes each owns."""
+        return {
+            'shard_id': self.shard_id,
+            'shards': {member: len(owned) for member, owned in self._ring.assign(classes).items()},
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show monitor shards and their class assignment')
+    parser.add_argument('command', choices=('status',))
+    parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'schedule_notifier.db'))
+    parser.add_argument('--ttl', type=float, default=90.0, help='Seconds without a heartbeat before a shard is dead')
+    args = parser.parse_args()
+
+    db = Database(args.db)
+    ring = HashRing(db.get_live_shards(args.ttl))
+    assignment = ring.assign(db.get_all_classes())
+    print(json.dumps({
+        'shards': db.get_shards(),
+        'classes_per_shard': {member: len(owned) for member, owned in assignment.items()},
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
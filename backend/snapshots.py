@@ -0,0 +1,254 @@
+"""
+Content-addressed store of scraped timetable and changes pages, for debugging
+and replay. Each distinct page is stored once, compressed, under its SHA-256;
+a small index maps (class_id, tab, fetched_at) to the hash. The store lives in
+its own SQLite file so it never slows down the main database.
+
+Usage:
+    python snapshots.py stats --db snapshots.db
+    python snapshots.py export --db snapshots.db --out snapshots.ndjson.gz [--class-id 3895]
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, IO, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:  # Optional dependency, zlib is used when it is missing
+    zstandard = None
+
+
+TABS = ('timetable', 'changes')
+
+# Rows fetched per round trip while streaming
+_FETCH_SIZE = 200
+
+
+def _compress(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Snapshot is zstd-compressed but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class SnapshotStore:
+    """Deduplicated, compressed storage of scraped page fragments."""
+
+    def __init__(self, db_path: str = 'snapshots.db', codec: Optional[str] = None):
+        """
+        Args:
+            db_path: SQLite file for the store (separate from the main database)
+            codec: 'zstd' or 'zlib'; defaults to zstd when zstandard is installed.
+                   Existing blobs keep the codec they were written with.
+        """
+        if codec not in (None, 'zlib', 'zstd'):
+            raise ValueError(f"Invalid snapshot codec '{codec}', expected 'zlib' or 'zstd'")
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError("Snapshot codec 'zstd' requires the zstandard package")
+
+        self.db_path = db_path
+        self.codec = codec or ('zstd' if zstandard is not None else 'zlib')
+        self._init_db()
+
+    @contextmanager
+    def get_connection(self):
+        """Context manager for store connections."""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self.get_connection() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    codec TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored_size INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    class_id TEXT NOT NULL,
+                    tab TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL,
+                    hash TEXT NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_snapshots_class ON snapshots(class_id, tab, fetched_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_snapshots_hash ON snapshots(hash)')
+
+    def save(self, class_id: str, tab: str, html: str, fetched_at: Optional[str] = None) -> str:
+        """
+        Record a fetched page. The page body is only compressed and stored if
+        its content hash hasn't been seen before.
+        Returns: The content hash.
+        """
+        data = html.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        fetched_at = fetched_at or datetime.utcnow().isoformat(timespec='seconds')
+
+        with self.get_connection() as conn:
+            known = conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (digest,)).fetchone()
+            if not known:
+                stored = _compress(data, self.codec)
+                conn.execute('''
+                    INSERT OR IGNORE INTO blobs (hash, codec, size, stored_size, data)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (digest, self.codec, len(data), len(stored), stored))
+            conn.execute('''
+                INSERT INTO snapshots (class_id, tab, fetched_at, hash) VALUES (?, ?, ?, ?)
+            ''', (class_id, tab, fetched_at, digest))
+        return digest
+
+    def get(self, digest: str) -> Optional[str]:
+        """Get a stored page by its content hash."""
+        with self.get_connection() as conn:
+            row = conn.execute('SELECT codec, data FROM blobs WHERE hash = ?', (digest,)).fetchone()
+        if not row:
+            return None
+        return _decompress(row['data'], row['codec']).decode('utf-8')
+
+    def iter_snapshots(self, class_id: Optional[str] = None, tab: Optional[str] = None,
+                       since: Optional[str] = None, distinct: bool = False) -> Iterator[Dict]:
+        """
+        Stream snapshots oldest first, decompressing one page at a time.
+        distinct: Yield each page only once (its first fetch), e.g. for parser
+                  regression corpora
+        """
+        conditions, params = [], []
+        if class_id:
+            conditions.append('s.class_id = ?')
+            params.append(class_id)
+        if tab:
+            conditions.append('s.tab = ?')
+            params.append(tab)
+        if since:
+            conditions.append('s.fetched_at >= ?')
+            params.append(since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        if distinct:
+            where += (' AND ' if where else 'WHERE ') + \
+                's.id = (SELECT MIN(id) FROM snapshots WHERE hash = s.hash)'
+
+        with self.get_connection() as conn:
+            cursor = conn.execute(f'''
+                SELECT s.class_id, s.tab, s.fetched_at, s.hash, b.codec, b.data
+                FROM snapshots s JOIN blobs b ON b.hash = s.hash
+                {where}
+                ORDER BY s.id
+            ''', params)
+            while True:
+                rows = cursor.fetchmany(_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield {
+                        'class_id': row['class_id'],
+                        'tab': row['tab'],
+                        'fetched_at': row['fetched_at'],
+                        'hash': row['hash'],
+                        'html': _decompress(row['data'], row['codec']).decode('utf-8'),
+                    }
+
+    def export(self, out: IO[str], **filters) -> int:
+        """
+        Write snapshots to a text stream as NDJSON (one snapshot per line).
+        Accepts the same filters as iter_snapshots().
+        Returns: Number of snapshots written.
+        """
+        count = 0
+        for snapshot in self.iter_snapshots(**filters):
+            out.write(json.dumps(snapshot, ensure_ascii=False))
+            out.write('\n')
+            count += 1
+        return count
+
+    def prune(self, days: int) -> Dict[str, int]:
+        """
+        Remove index entries older than `days` and the pages no longer referenced.
+        Returns: Dict with removed snapshot and blob counts.
+        """
+        cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat(timespec='seconds')
+        with self.get_connection() as conn:
+            snapshots = conn.execute('DELETE FROM snapshots WHERE fetched_at < ?', (cutoff,)).rowcount
+            blobs = conn.execute('''
+                DELETE FROM blobs WHERE NOT EXISTS (SELECT 1 FROM snapshots s WHERE s.hash = blobs.hash)
+            ''').rowcount
+        return {'removed_snapshots': snapshots, 'removed_blobs': blobs}
+
+    def get_stats(self) -> Dict:
+        """Get snapshot counts and the raw vs stored size of the distinct pages."""
+        with self.get_connection() as conn:
+            snapshots = conn.execute('SELECT COUNT(*) FROM snapshots').fetchone()[0]
+            blobs = conn.execute('''
+                SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM blobs
+            ''').fetchone()
+            by_codec = {row['codec']: row['count'] for row in conn.execute(
+                'SELECT codec, COUNT(*) AS count FROM blobs GROUP BY codec')}
+        return {
+            'snapshots': snapshots,
+            'distinct_pages': blobs[0],
+            'raw_bytes': blobs[1],
+            'stored_bytes': blobs[2],
+            'file_bytes': os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0,
+            'codecs': by_codec,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and export scraped page snapshots')
+    parser.add_argument('command', choices=('stats', 'export'))
+    parser.add_argument('--db', default=os.getenv('SNAPSHOT_DB_PATH', 'snapshots.db'))
+    parser.add_argument('--out', help="Output file for export ('.gz' is gzipped); stdout if omitted")
+    parser.add_argument('--class-id')
+    parser.add_argument('--tab', choices=TABS)
+    parser.add_argument('--since', help='Only snapshots fetched at or after this ISO time')
+    parser.add_argument('--distinct', action='store_true', help='Export each distinct page once')
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.db)
+    if args.command == 'stats':
+        print(json.dumps(store.get_stats(), indent=2))
+        return
+
+    filters = dict(class_id=args.class_id, tab=args.tab, since=args.since, distinct=args.distinct)
+    if not args.out:
+        count = store.export(sys.stdout, **filters)
+    elif args.out.endswith('.gz'):
+        with gzip.open(args.out, 'wt', encoding='utf-8') as out:
+            count = store.export(out, **filters)
+    else:
+        with open(args.out, 'w', encoding='utf-8') as out:
+            count = store.export(out, **filters)
+    print(f"Exported {count} snapshots", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,435 @@
+"""
+Local stand-in for the school website, for end-to-end load testing.
+Imitates Default.aspx closely enough for BeginHSScraper: it issues and
+validates __VIEWSTATE/__EVENTVALIDATION, handles the ClassesList, btnTimeTable
+and btnChanges postbacks (full and async UpdatePanel) and serves synthetic
+TTTable/MsgCell content for any number of classes.
+
+Usage:
+    python standin_server.py --classes 500 --latency-ms 300 --port 8765
+    python standin_server.py --classes 500 --run-cycle
+
+With --run-cycle a full ScheduleMonitor cycle is run against the server using
+a temporary database and a dry-run notifier, and its timings are printed.
+Otherwise point the app at it with SCHOOL_SITE_URL=http://127.0.0.1:8765/Default.aspx.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import secrets
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+from zoneinfo import ZoneInfo
+
+
+CONTROL_PREFIX = 'dnn$ctr16506$TimeTableView$'
+CLASSES_LIST = CONTROL_PREFIX + 'ClassesList'
+BTN_TIMETABLE = CONTROL_PREFIX + 'btnTimeTable'
+BTN_CHANGES = CONTROL_PREFIX + 'btnChanges'
+SCRIPT_MANAGER = 'dnn$ScriptManager'
+UPDATE_PANEL = CONTROL_PREFIX + 'UpdatePanel1'
+UPDATE_PANEL_CLIENT_ID = UPDATE_PANEL.replace('$', '_')
+VIEWSTATE_GENERATOR = 'CA0B0334'
+
+DAYS = 6
+LESSONS_PER_DAY = 10
+GRADES = ["ט'", "י'", "י\"א", "י\"ב"]
+
+SUBJECTS = [
+    'מתמטיקה 5 יח"ל', 'מתמטיקה 4 יח"ל', 'אנגלית 5 יח"ל', 'ספרות 30', 'ספרות 70',
+    'תנ"ך', 'היסטוריה', 'אזרחות', 'לשון', 'פיזיקה', 'כימיה', 'ביולוגיה',
+    'מדעי המחשב', 'חינוך גופני', 'חינוך', 'ערבית', 'צרפתית', 'אמנות',
+]
+FIRST_NAMES = ['דנה', 'יוסי', 'מיכל', 'אבי', 'רונית', 'משה', 'נטע', 'אורי', 'שירה',
+               'דוד', 'טל', 'עינת', 'גיל', 'הילה', 'עמית', 'נועה', 'איתי', 'ליאת']
+LAST_NAMES = ['כהן', 'לוי', 'מזרחי', 'פרץ', 'ביטון', 'אברהם', 'פרידמן', 'ששון',
+              'אזולאי', 'דהן', 'שפירא', 'גולן', 'רוזן', 'חדד', 'קליין', 'ברק']
+
+
+def _teacher_name(rng: random.Random) -> str:
+    return f"{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)}"
+
+
+class SyntheticSchool:
+    """Deterministic synthetic classes, timetables and changes."""
+
+    def __init__(self, class_count: int, changes_per_class: int = 3,
+                 churn_seconds: float = 600, seed: int = 1):
+        """
+        Args:
+            class_count: Number of classes in the ClassesList dropdown
+            changes_per_class: Average number of changes shown per class
+            churn_seconds: How often each class's changes are replaced by new ones
+            seed: Seed for the generated data
+        """
+        self.changes_per_class = changes_per_class
+        self.churn_seconds = churn_seconds
+        self.seed = seed
+
+        # Class IDs are numeric like on the real site
+        self.classes: List[Tuple[str, str]] = []
+        for index in range(class_count):
+            grade = GRADES[index % len(GRADES)]
+            section = index // len(GRADES) + 1
+            self.classes.append((str(1000 + index), f"{grade} {section}"))
+        self.class_ids = {class_id for class_id, _ in self.classes}
+        self._timetables: Dict[str, List[List[List[Tuple[str, str, str]]]]] = {}
+        self._lock = threading.Lock()
+
+    def timetable(self, class_id: str) -> List[List[List[Tuple[str, str, str]]]]:
+        """Get the lessons of a class as rows[lesson][day] -> [(subject, room, teacher)]."""
+        with self._lock:
+            if class_id in self._timetables:
+                return self._timetables[class_id]
+
+        rng = random.Random(f'{self.seed}-timetable-{class_id}')
+        # Each class has a fixed teacher per subject
+        teachers = {subject: _teacher_name(rng) for subject in SUBJECTS}
+        rows = []
+        for _ in range(LESSONS_PER_DAY):
+            row = []
+            for _ in range(DAYS):
+                cell = []
+                if rng.random() < 0.85:
+                    # Some slots are split into groups with two parallel lessons
+                    for subject in rng.sample(SUBJECTS, 2 if rng.random() < 0.2 else 1):
+                        cell.append((subject, str(rng.randint(100, 450)), teachers[subject]))
+                row.append(cell)
+            rows.append(row)
+
+        with self._lock:
+            self._timetables[class_id] = rows
+        return rows
+
+    def changes(self, class_id: str, now: Optional[float] = None) -> List[str]:
+        """Get the change messages currently shown for a class."""
+        now = time.time() if now is None else now
+        epoch = int(now // self.churn_seconds) if self.churn_seconds > 0 else 0
+        rng = random.Random(f'{self.seed}-changes-{class_id}-{epoch}')
+        rows = self.timetable(class_id)
+        today = datetime.now(ZoneInfo('Asia/Jerusalem')).date()
+
+        messages = []
+        for _ in range(rng.randint(0, 2 * self.changes_per_class)):
+            lesson_index = rng.randrange(LESSONS_PER_DAY)
+            cell = rows[lesson_index][rng.randrange(DAYS)]
+            if not cell:
+                continue
+            _, _, teacher = rng.choice(cell)
+            date = (today + timedelta(days=rng.randint(0, 3))).strftime('%d.%m.%Y')
+            lesson = f"שיעור {lesson_index + 1}"
+            if rng.random() < 0.5:
+                messages.append(f"{date}, {lesson}, {teacher}, ביטול שיעור")
+            else:
+                messages.append(f"{date}, {lesson}, {teacher}, החלפת חדר לחדר {rng.randint(100, 450)}")
+        return messages
+
+
+class PageState:
+    """Signs and verifies the __VIEWSTATE/__EVENTVALIDATION pair."""
+
+    def __init__(self, secret: bytes, padding_bytes: int = 0):
+        """
+        Args:
+            secret: Key used to sign the state
+            padding_bytes: Extra bytes added to every viewstate, to mimic the
+                           size of the real site's viewstate
+        """
+        self.secret = secret
+        self.padding = 'A' * padding_bytes
+
+    def _sign(self, value: str) -> str:
+        return hmac.new(self.secret, value.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+    def encode(self, class_id: Optional[str]) -> Tuple[str, str]:
+        """Returns: (viewstate, event_validation) for a page showing class_id."""
+        payload = json.dumps({'class_id': class_id, 'nonce': secrets.token_hex(4)})
+        body = base64.b64encode(payload.encode('utf-8')).decode('ascii')
+        viewstate = f"{body}.{self._sign(body)}{self.padding}"
+        return viewstate, self._sign('ev:' + viewstate)
+
+    def decode(self, viewstate: str, event_validation: str) -> Optional[Dict]:
+        """Verify a posted state. Returns: The state, or None if it is invalid."""
+        if not hmac.compare_digest(self._sign('ev:' + viewstate), event_validation):
+            return None
+        body, _, signature = viewstate.removesuffix(self.padding).partition('.')
+        if not hmac.compare_digest(self._sign(body), signature):
+            return None
+        try:
+            return json.loads(base64.b64decode(body))
+        except ValueError:
+            return None
+
+
+def render_panel(school: SyntheticSchool, class_id: Optional[str], content: str) -> str:
+    """Render the TimeTableView UpdatePanel: the class list, the tab buttons and the content."""
+    options = ''.join(
+        f'<option{" selected" if value == class_id else ""} value="{value}">{escape(name)}</option>'
+        for value, name in school.classes
+    )
+    return (f'<select name="{CLASSES_LIST}" id="{CLASSES_LIST.replace("$", "_")}">'
+            f'<option value="">בחר כיתה</option>{options}</select>'
+            f'<input type="submit" name="{BTN_TIMETABLE}" value="מערכת שעות" />'
+            f'<input type="submit" name="{BTN_CHANGES}" value="שינויים" />'
+            f'{content}')
+
+
+def render_page(school: SyntheticSchool, state: PageState, class_id: Optional[str],
+                content: str) -> str:
+    """Render a full Default.aspx page."""
+    viewstate, event_validation = state.encode(class_id)
+    return f"""<!DOCTYPE html>
+<html dir="rtl"><head><meta charset="utf-8"><title>מערכת שעות</title></head>
+<body>
+<form method="post" action="./Default.aspx?TabId=4645&amp;language=he-IL" id="Form">
+<input type="hidden" name="__EVENTTARGET" id="__EVENTTARGET" value="" />
+<input type="hidden" name="__EVENTARGUMENT" id="__EVENTARGUMENT" value="" />
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{viewstate}" />
+<input type="hidden" name="__VIEWSTATEGENERATOR" id="__VIEWSTATEGENERATOR" value="{VIEWSTATE_GENERATOR}" />
+<input type="hidden" name="__EVENTVALIDATION" id="__EVENTVALIDATION" value="{event_validation}" />
+<script type="text/javascript">
+Sys.WebForms.PageRequestManager._initialize('{SCRIPT_MANAGER}', 'Form', ['t{UPDATE_PANEL}','{UPDATE_PANEL_CLIENT_ID}'], [], [], 90, '');
+</script>
+<div id="{UPDATE_PANEL_CLIENT_ID}">
+{render_panel(school, class_id, content)}
+</div>
+</form>
+</body></html>"""
+
+
+def render_delta(school: SyntheticSchool, state: PageState, class_id: Optional[str],
+                 content: str) -> str:
+    """Render an MS AJAX delta response with the panel and the new hidden fields."""
+    viewstate, event_validation = state.encode(class_id)
+    records = [
+        ('updatePanel', UPDATE_PANEL_CLIENT_ID, render_panel(school, class_id, content)),
+        ('hiddenField', '__EVENTTARGET', ''),
+        ('hiddenField', '__EVENTARGUMENT', ''),
+        ('hiddenField', '__VIEWSTATE', viewstate),
+        ('hiddenField', '__VIEWSTATEGENERATOR', VIEWSTATE_GENERATOR),
+        ('hiddenField', '__EVENTVALIDATION', event_validation),
+    ]
+    return ''.join(f"{len(text)}|{kind}|{record_id}|{text}|" for kind, record_id, text in records)
+
+
+def render_timetable(school: SyntheticSchool, class_id: str) -> str:
+    """Render a class's TTTable."""
+    day_names = ['ראשון', 'שני', 'שלישי', 'רביעי', 'חמישי', 'שישי']
+    parts = ['<table class="TTTable"><tr>']
+    parts.extend(f'<th class="CTitle">{name}</th>' for name in day_names)
+    parts.append('</tr>')
+    for row in school.timetable(class_id):
+        parts.append('<tr>')
+        for cell in row:
+            parts.append('<td class="TTCell">')
+            for subject, room, teacher in cell:
+                parts.append(f'<div class="TTLesson"><b>{escape(subject)} ({room})</b>'
+                             f'<br>{escape(teacher)}</div>')
+            parts.append('</td>')
+        parts.append('</tr>')
+    parts.append('</table>')
+    return ''.join(parts)
+
+
+def render_changes(school: SyntheticSchool, class_id: str, now: Optional[float] = None) -> str:
+    """Render a class's change messages as MsgCell rows."""
+    rows = ''.join(f'<tr><td class="MsgCell">{escape(message)}</td></tr>'
+                   for message in school.changes(class_id, now))
+    return f'<table class="TableMsg">{rows}</table>'
+
+
+class StandInServer(ThreadingHTTPServer):
+    """HTTP server holding the synthetic school and its settings."""
+
+    daemon_threads = True
+
+    def __init__(self, address, school: SyntheticSchool, state: PageState,
+                 latency_ms: float = 0, jitter_ms: float = 0):
+        super().__init__(address, StandInHandler)
+        self.school = school
+        self.state = state
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.request_counts: Dict[str, int] = {}
+        self._counts_lock = threading.Lock()
+
+    def count(self, kind: str):
+        with self._counts_lock:
+            self.request_counts[kind] = self.request_counts.get(kind, 0) + 1
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/Default.aspx?TabId=4645&language=he-IL"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves Default.aspx GETs and postbacks."""
+
+    server: StandInServer
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        delay = self.server.latency_ms + random.uniform(0, self.server.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def _send(self, status: int, body: str, content_type: str = 'text/html; charset=utf-8'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._delay()
+        self.server.count('GET')
+        self._send(200, render_page(self.server.school, self.server.state, None, ''))
+
+    def do_POST(self):
+        self._delay()
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in
+                parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True).items()}
+
+        state = self.server.state.decode(form.get('__VIEWSTATE', ''),
+                                         form.get('__EVENTVALIDATION', ''))
+        if state is None:
+            self.server.count('invalid_viewstate')
+            self._send(500, '<html><body><h1>Validation of viewstate MAC failed.</h1></body></html>')
+            return
+
+        class_id = state.get('class_id')
+        target = form.get('__EVENTTARGET', '')
+        if target == CLASSES_LIST:
+            class_id = form.get(CLASSES_LIST, '')
+            if class_id not in self.server.school.class_ids:
+                # Like ASP.NET event validation, reject values that weren't offered
+                self.server.count('invalid_event')
+                self._send(500, '<html><body><h1>Invalid postback or callback argument.</h1></body></html>')
+                return
+            panel = ''
+        elif target == BTN_TIMETABLE and class_id:
+            panel = render_timetable(self.server.school, class_id)
+        elif target == BTN_CHANGES and class_id:
+            panel = render_changes(self.server.school, class_id)
+        else:
+            panel = ''
+
+        is_async = form.get('__ASYNCPOST') == 'true'
+        self.server.count(f"{target.rsplit('$', 1)[-1] or 'none'}:{'async' if is_async else 'full'}")
+        if is_async:
+            self._send(200, render_delta(self.server.school, self.server.state, class_id, panel),
+                       'text/plain; charset=utf-8')
+        else:
+            self._send(200, render_page(self.server.school, self.server.state, class_id, panel))
+
+
+def start_server(class_count: int = 100, host: str = '127.0.0.1', port: int = 0,
+                 latency_ms: float = 0, jitter_ms: float = 0, changes_per_class: int = 3,
+                 churn_seconds: float = 600, viewstate_kb: float = 0,
+                 seed: int = 1) -> StandInServer:
+    """Start a stand-in server on a background thread. Returns: The running server."""
+    school = SyntheticSchool(class_count, changes_per_class, churn_seconds, seed)
+    state = PageState(secrets.token_bytes(16), int(viewstate_kb * 1024))
+    server = StandInServer((host, port), school, state, latency_ms, jitter_ms)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_cycle(server: StandInServer, users_per_class: int = 5) -> Dict:
+    """
+    Run one full ScheduleMonitor cycle against the stand-in server, with a
+    temporary database and a dry-run notifier.
+    Returns: Timing summary of the cycle.
+    """
+    # Imported here so the server itself has no app dependencies
+    import metrics
+    from database import Database
+    from notifier import NotificationService
+    from scheduler import ScheduleMonitor
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'loadtest.db'))
+        rng = random.Random(0)
+        for class_id, class_name in server.school.classes:
+            teachers = {subject: teacher for row in server.school.timetable(class_id)
+                        for cell in row for subject, _, teacher in cell}
+            subjects = sorted(teachers)
+            for n in range(users_per_class):
+                user_id = db.register_user(f'loadtest-{class_id}-{n}', class_id, class_name)
+                chosen = rng.sample(subjects, min(5, len(subjects)))
+                db.set_teacher_preferences(user_id, {subject: teachers[subject] for subject in chosen})
+
+        monitor = ScheduleMonitor(db, NotificationService(dry_run=True),
+                                  spread_fraction=0, base_url=server.url)
+        start = time.perf_counter()
+        monitor.check_all_classes()
+        elapsed = time.perf_counter() - start
+
+        slowest = db.get_slowest_cycle_traces(limit=1)
+        return {
+            'classes': len(server.school.classes),
+            'cycle_seconds': round(elapsed, 3),
+            'classes_per_second': round(len(server.school.classes) / elapsed, 2) if elapsed else None,
+            'requests': dict(server.request_counts),
+            'trace_busy_ms': slowest[0]['busy_ms'] if slowest else None,
+            'metrics': [line for line in metrics.render().splitlines()
+                        if line.startswith(('schedule_notifier_new_changes_total',
+                                            'schedule_notifier_notifications_total',
+                                            'schedule_notifier_upstream_response_bytes_total'))],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the school website')
+    parser.add_argument('--classes', type=int, default=100, help='Number of classes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Fixed delay per request')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Random extra delay per request')
+    parser.add_argument('--changes-per-class', type=int, default=3)
+    parser.add_argument('--churn-seconds', type=float, default=600,
+                        help='How often the changes shown for a class are regenerated')
+    parser.add_argument('--viewstate-kb', type=float, default=0,
+                        help='Pad the viewstate to mimic the real page size')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--run-cycle', action='store_true',
+                        help='Run one monitor cycle against the server and exit')
+    parser.add_argument('--users-per-class', type=int, default=5,
+                        help='Users registered per class for --run-cycle')
+    args = parser.parse_args()
+
+    server = start_server(args.classes, args.host, 0 if args.run_cycle else args.port,
+                          args.latency_ms, args.jitter_ms, args.changes_per_class,
+                          args.churn_seconds, args.viewstate_kb, args.seed)
+
+    if args.run_cycle:
+        print(json.dumps(run_cycle(server, args.users_per_class), ensure_ascii=False, indent=2))
+        server.shutdown()
+        return
+
+    print(f"Serving {args.classes} classes at {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
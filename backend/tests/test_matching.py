@@ -0,0 +1,126 @@
+"""
+Regression tests for resolving schedule changes to subjects and subscribers.
+Run from backend/: python -m unittest discover tests
+"""
+
+import os
+import tempfile
+import unittest
+
+from database import Database
+from matching import ClassMatcher
+from normalize import normalize_teacher
+from scraper import ScheduleChange, ScheduleLesson, _change_record, lesson_map_for, parse_change_text
+
+
+TEACHER = 'כהן דוד'
+
+# The teacher has חינוך on Sunday and היסטוריה on Monday, both in lesson 1
+LESSONS = [
+    ScheduleLesson('ראשון', 1, 'חינוך', TEACHER),
+    ScheduleLesson('שני', 1, 'היסטוריה', TEACHER),
+    ScheduleLesson('ראשון', 2, 'מתמטיקה', 'לוי רונית'),
+]
+
+# 18.10.2026 is a Sunday, 21.10.2026 a Wednesday
+SUNDAY_CANCELLATION = f'18.10.2026, שיעור 1, {TEACHER}, ביטול שיעור'
+WEDNESDAY_CANCELLATION = f'21.10.2026, שיעור 3, {TEACHER}, ביטול שיעור'
+
+
+def _preference(user_id: int, subject: str, teacher: str) -> dict:
+    return {'user_id': user_id, 'device_token': f'token-{user_id}', 'language': 'he',
+            'subject': subject, 'teacher_key': normalize_teacher(teacher)}
+
+
+def _parse(text: str) -> ScheduleChange:
+    lesson_map = lesson_map_for(
+        (lesson.day, lesson.lesson_number, lesson.subject, lesson.teacher) for lesson in LESSONS)
+    return _change_record(parse_change_text(text, lesson_map))
+
+
+class TeacherWithTwoSubjectsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = ClassMatcher(LESSONS, [
+            _preference(1, 'חינוך', TEACHER),
+            _preference(2, 'היסטוריה', TEACHER),
+            _preference(3, 'מתמטיקה', 'לוי רונית'),
+        ])
+
+    def _notified(self, change) -> set:
+        return {user['id'] for user in self.matcher.match(change)}
+
+    def test_subject_is_resolved_from_the_changes_day(self):
+        self.assertEqual(_parse(SUNDAY_CANCELLATION).subject, 'חינוך')
+
+    def test_change_notifies_the_lessons_followers(self):
+        self.assertEqual(self._notified(_parse(SUNDAY_CANCELLATION)), {1})
+
+    def test_wrongly_resolved_subject_falls_back_to_the_slot(self):
+        # Changes stored before subjects were resolved per day
+        change = ScheduleChange('18.10.2026', 1, TEACHER, 'היסטוריה', 'cancellation', 'ביטול שיעור')
+        self.assertEqual(self._notified(change), {1})
+
+    def test_change_outside_the_timetable_notifies_all_followers(self):
+        change = _parse(WEDNESDAY_CANCELLATION)
+        # Either subject would be a guess
+        self.assertEqual(change.subject, 'Unknown')
+        self.assertEqual(self._notified(change), {1, 2})
+
+
+class FeedAgreesWithPushTest(unittest.TestCase):
+    """The feed matches one user's preferences; pushes match the whole class's."""
+
+    def test_single_user_matching_agrees_with_class_matching(self):
+        preferences = [
+            _preference(1, 'חינוך', TEACHER),
+            _preference(2, 'היסטוריה', TEACHER),
+            _preference(3, 'מתמטיקה', 'לוי רונית'),
+            # Follows the teacher for a subject they don't teach this class
+            _preference(4, 'מתמטיקה', TEACHER),
+        ]
+        changes = [
+            _parse(SUNDAY_CANCELLATION),
+            _parse(WEDNESDAY_CANCELLATION),
+            _parse('18.10.2026, שיעור 2, לוי רונית, ביטול שיעור'),
+            ScheduleChange('18.10.2026', 1, TEACHER, 'היסטוריה', 'cancellation', 'ביטול שיעור'),
+        ]
+        class_matcher = ClassMatcher(LESSONS, preferences)
+        for change in changes:
+            pushed = {user['id'] for user in class_matcher.match(change)}
+            in_feed = {row['user_id'] for row in preferences
+                       if ClassMatcher(LESSONS, [row]).match(change)}
+            self.assertEqual(in_feed, pushed, change)
+
+
+class FeedQueryTest(unittest.TestCase):
+    """The feed's SQL prefilter must keep every change the matcher accepts."""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.db = Database(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_feed_reads_only_the_followed_teachers_changes(self):
+        user_id = self.db.register_user('token', '1', 'class')
+        self.db.set_teacher_preferences(user_id, {'חינוך': TEACHER})
+        self.db.add_change('1', _parse(SUNDAY_CANCELLATION))
+        # Not in the timetable and named differently: matched like teachers_match does
+        self.db.add_change('1', _parse(WEDNESDAY_CANCELLATION.replace(TEACHER, 'כהן  ד')))
+        self.db.add_change('1', _parse('18.10.2026, שיעור 2, לוי רונית, ביטול שיעור'))
+
+        read = []
+        def follows(change):
+            read.append(change['teacher'])
+            return True
+
+        feed = self.db.get_user_feed(user_id, follows=follows)
+        self.assertEqual([change['teacher'] for change in feed], ['כהן  ד', TEACHER])
+        self.assertNotIn('לוי רונית', read)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""
+Regression tests for importing users from NDJSON exports.
+Run from backend/: python -m unittest discover tests
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from database import Database
+from user_transfer import read_records
+
+
+def _line(**fields) -> str:
+    record = {'device_token': 'token', 'class_id': '1', 'preferences': {'חינוך': 'כהן דוד'}}
+    record.update(fields)
+    return json.dumps(record, ensure_ascii=False)
+
+
+class MalformedRecordTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.db = Database(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_malformed_records_are_rejected_with_their_line(self):
+        for fields in ({'preferences': [1]}, {'preferences': {'חינוך': 5}},
+                       {'device_token': 7}, {'language': 'fr'}):
+            with self.subTest(fields=fields):
+                lines = [_line(device_token='first'), '', _line(**fields)]
+                with self.assertRaisesRegex(ValueError, 'Line 3'):
+                    self.db.import_user_records(read_records(lines))
+
+    def test_chunk_with_a_malformed_record_is_not_imported(self):
+        lines = [_line(device_token='first'), _line(preferences=[1])]
+        with self.assertRaises(ValueError):
+            self.db.import_user_records(read_records(lines), chunk_size=10)
+        self.assertIsNone(self.db.get_user_by_token('first'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+Incremental diffing of a class's weekly timetable.
+Lessons are keyed like schedule_cache rows (day, lesson_number, subject,
+teacher), so a refresh becomes a handful of upserts and deletes. The diff
+also classifies permanent changes (teacher swaps, room moves, added and
+removed lessons) so affected subscribers can be told about them.
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple
+
+from normalize import normalize_subject
+
+
+LessonKey = Tuple[str, int, str, str]
+
+
+def lesson_key(lesson) -> LessonKey:
+    """Key of a lesson (ScheduleLesson or schedule_cache row), as in schedule_cache's UNIQUE constraint."""
+    return (lesson['day'], lesson['lesson_number'], lesson['subject'], lesson['teacher'])
+
+
+def _lesson_value(lesson) -> Tuple[str, str]:
+    group = lesson.get('group')
+    if group is None:
+        group = lesson.get('group_info', '')
+    return (lesson.get('room', '') or '', group or '')
+
+
+@dataclass
+class ScheduleDiff:
+    # New or changed lessons, as given in the new timetable
+    upserts: List = field(default_factory=list)
+    # Keys of lessons no longer in the timetable
+    deletes: List[LessonKey] = field(default_factory=list)
+    # Permanent changes, as change dicts for the notifier
+    changes: List[Dict] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.upserts or self.deletes)
+
+
+def _timetable_change(kind: str, lesson, **extra) -> Dict:
+    change = {
+        'change_type': 'timetable_change',
+        'kind': kind,
+        'day': lesson['day'],
+        # The notifier expects a date; a weekly change has a day
+        'date': lesson['day'],
+        'lesson_number': lesson['lesson_number'],
+        'subject': lesson['subject'],
+        'teacher': lesson['teacher'],
+        'room': _lesson_value(lesson)[0],
+    }
+    change.update(extra)
+    return change
+
+
+def diff_schedules(old: Iterable, new: Iterable) -> ScheduleDiff:
+    """Compare two timetables of a class in O(n)."""
+    old_lessons = {lesson_key(lesson): lesson for lesson in old}
+    new_lessons = {lesson_key(lesson): lesson for lesson in new}
+    diff = ScheduleDiff()
+
+    added = []
+    for key, lesson in new_lessons.items():
+        previous = old_lessons.get(key)
+        if previous is None:
+            added.append(lesson)
+            diff.upserts.append(lesson)
+        elif _lesson_value(previous) != _lesson_value(lesson):
+            diff.upserts.append(lesson)
+            if _lesson_value(previous)[0] != _lesson_value(lesson)[0]:
+                diff.changes.append(_timetable_change('room', lesson, old_room=_lesson_value(previous)[0]))
+
+    removed: Dict[Tuple[str, int, str], List] = {}
+    for key, lesson in old_lessons.items():
+        if key not in new_lessons:
+            diff.deletes.append(key)
+            removed.setdefault((lesson['day'], lesson['lesson_number'],
+                                normalize_subject(lesson['subject'])), []).append(lesson)
+
+    # A lesson replaced by the same subject in the same slot is a teacher swap
+    for lesson in added:
+        slot = (lesson['day'], lesson['lesson_number'], normalize_subject(lesson['subject']))
+        replaced = removed.get(slot)
+        if replaced:
+            previous = replaced.pop()
+            diff.changes.append(_timetable_change('teacher', lesson, old_teacher=previous['teacher']))
+        else:
+            diff.changes.append(_timetable_change('added', lesson))
+
+    for lessons in removed.values():
+        for lesson in lessons:
+            diff.changes.append(_timetable_change('removed', lesson))
+
+    return diff
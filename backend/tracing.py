@@ -0,0 +1,139 @@
+"""
+Lightweight per-cycle tracing for the schedule monitor.
+A trace records nested spans (upstream calls, parsing, DB writes, notification
+sends) for one check_all_classes run. Spans are only recorded while a trace is
+active on the current thread, so instrumented code called from API requests
+costs next to nothing.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+_local = threading.local()
+
+
+class Trace:
+    """A tree of timed spans recorded for one unit of work."""
+
+    MAX_SPANS = 5000
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = datetime.utcnow().isoformat(timespec='seconds')
+        self.attributes: Dict = {}
+        self.spans: List[Dict] = []
+        self.dropped_spans = 0
+        self.duration_ms = 0.0
+        self._start = time.perf_counter()
+        self._stack: List[int] = []
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+
+    def to_record(self) -> Dict:
+        """Convert the finished trace into a dict suitable for storage."""
+        # Busy time is the sum of top-level spans; the rest is staggering waits
+        busy_ms = sum(span['duration_ms'] for span in self.spans if span['parent'] is None)
+        return {
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': round(self.duration_ms, 3),
+            'busy_ms': round(busy_ms, 3),
+            'attributes': self.attributes,
+            'dropped_spans': self.dropped_spans,
+            'spans': self.spans,
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    """Get the trace active on this thread, if any."""
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def start_trace(name: str):
+    """Start a trace on the current thread for the duration of the block."""
+    trace = Trace(name)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        trace.duration_ms = trace.elapsed_ms()
+        _local.trace = None
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Record a span in the active trace.
+    Does nothing when no trace is active on the current thread.
+    """
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+
+    if len(trace.spans) >= Trace.MAX_SPANS:
+        trace.dropped_spans += 1
+        yield
+        return
+
+    parent = trace._stack[-1] if trace._stack else None
+    if parent is not None and 'class_id' not in attributes:
+        # Inherit the class so every span can be attributed to a class
+        class_id = trace.spans[parent]['attributes'].get('class_id')
+        if class_id is not None:
+            attributes['class_id'] = class_id
+
+    record = {
+        'name': name,
+        'parent': parent,
+        'start_ms': round(trace.elapsed_ms(), 3),
+        'duration_ms': 0.0,
+        'attributes': attributes,
+    }
+    trace.spans.append(record)
+    trace._stack.append(len(trace.spans) - 1)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        trace._stack.pop()
+
+
+def summarize(spans: List[Dict], top: int = 10) -> Dict:
+    """
+    Summarize a trace's spans.
+    Returns: Dict with total time per span name, total time per class and the
+    slowest individual spans.
+    """
+    by_name: Dict[str, float] = {}
+    by_class: Dict[str, float] = {}
+
+    for item in spans:
+        by_name[item['name']] = by_name.get(item['name'], 0.0) + item['duration_ms']
+        if item['parent'] is None and 'class_id' in item['attributes']:
+            class_id = item['attributes']['class_id']
+            by_class[class_id] = by_class.get(class_id, 0.0) + item['duration_ms']
+
+    slowest = sorted(
+        (item for item in spans if item['parent'] is not None),
+        key=lambda item: item['duration_ms'],
+        reverse=True
+    )[:top]
+
+    return {
+        'by_name_ms': {name: round(ms, 3) for name, ms in
+                       sorted(by_name.items(), key=lambda kv: kv[1], reverse=True)},
+        'by_class_ms': {class_id: round(ms, 3) for class_id, ms in
+                        sorted(by_class.items(), key=lambda kv: kv[1], reverse=True)},
+        'slowest_spans': slowest,
+    }
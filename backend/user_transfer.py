@@ -0,0 +1,115 @@
+"""
+Bulk export and import of users and their teacher preferences as NDJSON
+(one user per line), for moving between hosts or merging deployments.
+Both directions stream, so memory use doesn't depend on the number of users.
+
+Usage:
+    python user_transfer.py export --db schedule_notifier.db --out users.ndjson.gz [--class-id 3895]
+    python user_transfer.py import --db schedule_notifier.db --in users.ndjson.gz [--merge]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from typing import Dict, IO, Iterable, Iterator
+
+from database import Database
+
+
+# Languages notifications are written in (see notifier)
+LANGUAGES = ('he', 'en')
+
+_TEXT_FIELDS = ('device_token', 'class_id', 'class_name', 'created_at', 'updated_at')
+
+
+def _validate(record: Dict, number: int):
+    """Check the types of a record's fields; missing fields are left to the import."""
+    for key in _TEXT_FIELDS:
+        if record.get(key) is not None and not isinstance(record[key], str):
+            raise ValueError(f"Line {number}: {key} must be a string")
+    if record.get('language') is not None and record['language'] not in LANGUAGES:
+        raise ValueError(f"Line {number}: language must be one of {', '.join(LANGUAGES)}")
+    preferences = record.get('preferences')
+    if preferences is not None and (not isinstance(preferences, dict) or
+                                    not all(isinstance(teacher, str) for teacher in preferences.values())):
+        raise ValueError(f"Line {number}: preferences must map subjects to teacher names")
+
+
+def read_records(lines: Iterable[str]) -> Iterator[Dict]:
+    """
+    Parse NDJSON lines lazily, skipping blank lines.
+    Raises ValueError (with the line number) on invalid JSON or field types.
+    """
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON on line {number}: {e}") from e
+        if not isinstance(record, dict):
+            raise ValueError(f"Line {number} is not a JSON object")
+        _validate(record, number)
+        yield record
+
+
+def write_records(records: Iterable[Dict], out: IO[str]) -> int:
+    """
+    Write records to a text stream as NDJSON.
+    Returns: Number of records written.
+    """
+    count = 0
+    for record in records:
+        out.write(json.dumps(record, ensure_ascii=False))
+        out.write('\n')
+        count += 1
+    return count
+
+
+def _open(path: str, mode: str) -> IO[str]:
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import users and teacher preferences as NDJSON')
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'schedule_notifier.db'))
+    parser.add_argument('--out', help="Export file ('.gz' is gzipped); stdout if omitted")
+    parser.add_argument('--in', dest='input', help="Import file ('.gz' is gzipped); stdin if omitted")
+    parser.add_argument('--class-id', help='Only export users of this class')
+    parser.add_argument('--merge', action='store_true',
+                        help="Keep existing preferences the imported records don't mention")
+    parser.add_argument('--chunk-size', type=int, default=Database.TRANSFER_CHUNK_SIZE,
+                        help='Records per import transaction')
+    args = parser.parse_args()
+
+    db = Database(args.db)
+    start = time.perf_counter()
+
+    if args.command == 'export':
+        records = db.iter_user_records(args.class_id)
+        if args.out:
+            with _open(args.out, 'w') as out:
+                count = write_records(records, out)
+        else:
+            count = write_records(records, sys.stdout)
+        print(f"Exported {count} users in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        return
+
+    if args.input:
+        with _open(args.input, 'r') as lines:
+            result = db.import_user_records(read_records(lines), merge=args.merge, chunk_size=args.chunk_size)
+    else:
+        result = db.import_user_records(read_records(sys.stdin), merge=args.merge, chunk_size=args.chunk_size)
+    print(f"Imported {result['imported']} users ({result['skipped']} skipped) "
+          f"in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
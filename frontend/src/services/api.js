@@ -83,10 +83,23 @@ class ApiClient {
         return await this.get(`/changes/${classId}`);
     }
 
+    // Changes for the user's selected teachers only (pass { since } for delta sync)
+    async getFeed(deviceToken, params = {}) {
+        const query = new URLSearchParams(params).toString();
+        return await this.get(`/feed/${deviceToken}${query ? `?${query}` : ''}`);
+    }
+
     async getLiveChanges(classId) {
         return await this.get(`/changes/live/${classId}`);
     }
 
+    // Stream new changes as they are detected (EventSource resumes with Last-Event-ID)
+    subscribeToChanges(classId, onChange) {
+        const source = new EventSource(`${API_URL}/changes/stream/${classId}`);
+        source.addEventListener('change', (event) => onChange(JSON.parse(event.data)));
+        return source;
+    }
+
     async testNotification(deviceToken, title, body) {
         return await this.post('/test-notification', {
             device_token: deviceToken,